@@ -0,0 +1,368 @@
+#!/usr/bin/env python3.7
+
+"""
+Command-line guide search over many regions in a single run
+
+Accepts a BED file (chrom, start, end[, name]) or a TSV (chrom:start-end[, gene]) of regions
+and searches them all together:
+1) Finds the gRNAs within each region (find_grna.py)
+2) Dedupes the guides found in more than one (overlapping) region by their genomic location
+3) Looks the guides up in the off-target cache and aligns the rest with a single bwa call (find_offtargets.py)
+4) Scores the uncached guides in parallel processes (score_offtargets.py)
+5) Categorizes all the off-targets at once (categorize_offtargets.py)
+6) Writes the usual GuideSearchAndScore csv for each region, along with a summary of all the guides
+"""
+
+import argparse
+import binascii
+import csv
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(dir_path, "../helpers"))
+from Config import Config
+
+sys.path.append(os.path.join(dir_path, "core"))
+import categorize_offtargets
+import find_grna
+import find_offtargets
+import get_sequence
+import offtarget_cache
+import score_offtargets
+from GuideSearchAndScore import GuideSearchAndScore
+
+
+def readRegions(regionsFile):
+    """
+    given a BED or TSV file of regions, returns a list of (searchInput, gene) tuples.
+    BED coordinates are 0-based and converted to the 1-based chrom:start-end search input
+    """
+    regions = []
+    with open(regionsFile, "r") as f:
+        for line in f:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = [x.strip() for x in line.rstrip("\n").split("\t")]
+            if len(fields) >= 3 and fields[1].isdigit() and fields[2].isdigit():
+                searchInput = (
+                    fields[0] + ":" + str(int(fields[1]) + 1) + "-" + fields[2]
+                )
+                gene = fields[3] if len(fields) > 3 and fields[3] else searchInput
+            elif re.match(r"^.+:\d+-\d+$", fields[0]):
+                searchInput = fields[0]
+                gene = fields[1] if len(fields) > 1 and fields[1] else searchInput
+            else:
+                raise ValueError(
+                    f"Unrecognized region in {regionsFile}: {line.strip()}"
+                )
+            regions.append((searchInput, gene))
+
+    return regions
+
+
+def isValidRegion(searchInput):
+    """returns True if the region is within the GuideSearchAndScore size limit"""
+    start, end = map(int, searchInput.rsplit(":", 1)[1].split("-"))
+    return abs(start - end) <= 3000
+
+
+def guideKey(guide):
+    """the genomic identity of a guide, the same guide found in overlapping regions has the same key"""
+    return (
+        guide["pam_chrom"],
+        guide["strand"],
+        int(guide["guide_genomic_start"]),
+        int(guide["pam_genomic_start"]),
+        guide["guide_seq"],
+        guide["pam_seq"],
+    )
+
+
+def scoreGuides(guideDict, rgenID, genome_fa, twoBitToFa_path, genome_2bit):
+    """scores a chunk of guides in a worker process"""
+    return score_offtargets.scoreOffTargets(
+        guideDict,
+        rgenID,
+        genome_fa,
+        twoBitToFa_path,
+        genome_2bit,
+        tempfile.gettempdir(),
+    )
+
+
+def scoreInParallel(
+    guideDict, rgenID, genome_fa, twoBitToFa_path, genome_2bit, processes
+):
+    """splits the guides into a chunk per process and scores them in parallel, updating the guides in place"""
+    guideIDs = list(guideDict.keys())
+    chunks = [
+        {guideID: guideDict[guideID] for guideID in guideIDs[i::processes]}
+        for i in range(min(processes, len(guideIDs)))
+    ]
+    arguments = [
+        (chunk, rgenID, genome_fa, twoBitToFa_path, genome_2bit) for chunk in chunks
+    ]
+    if len(chunks) > 1:
+        with Pool(len(chunks)) as pool:
+            scoredChunks = pool.starmap(scoreGuides, arguments)
+    else:
+        scoredChunks = [scoreGuides(*args) for args in arguments]
+
+    # the workers return copies of the guides, copy the results back into the originals
+    for scoredChunk in scoredChunks:
+        for guideID, guide in scoredChunk.items():
+            guideDict[guideID].update(guide)
+
+    return guideDict
+
+
+def batchGuideSearch(args):
+    """runs the search for all the regions and writes the results to the output directory"""
+    batchID = binascii.b2a_hex(os.urandom(9)).decode("utf-8")
+    dbConnection = Config(args.genome)
+    genome_fa = os.path.join(
+        dbConnection.ROOT_PATH,
+        "jbrowse",
+        "data",
+        args.genome,
+        "processed",
+        args.genome + ".fa",
+    )
+    genome_2bit = os.path.join(
+        dbConnection.ROOT_PATH,
+        "jbrowse",
+        "data",
+        args.genome,
+        "processed",
+        args.genome + ".2bit",
+    )
+    twoBitToFa_path = os.path.join(dbConnection.ROOT_PATH, "bin/twoBitToFa")
+    tempfiles_path = tempfile.gettempdir()
+    maxOffTargets = None if args.maxOffTargets == -1 else args.maxOffTargets
+
+    regions = readRegions(args.regions)
+    invalid = [
+        searchInput for searchInput, gene in regions if not isValidRegion(searchInput)
+    ]
+    if invalid:
+        sys.exit(
+            "Regions must have fewer than 3000 bases, split these regions: "
+            + ", ".join(invalid)
+        )
+    os.makedirs(args.outdir, exist_ok=True)
+
+    time_0 = time.time()
+    logging.debug(f"\t\t[STARTED]\t\tFinding gRNAs in {len(regions)} regions...")
+
+    # guides found in more than one region are only searched and scored once
+    guideDict = {}
+    guideIDs = {}
+    regionGuides = []
+    for i, (searchInput, gene) in enumerate(regions):
+        chrom, start, sequence = get_sequence.read_sequence(searchInput, genome_2bit)
+        found = find_grna.find_grna_in_sequence(
+            args.rgenID, args.spacer, chrom, start, sequence
+        )
+        guides = {}
+        for regionGuideID, guide in found.items():
+            key = guideKey(guide)
+            if key not in guideIDs:
+                guideIDs[key] = str(len(guideIDs))
+                guideDict[guideIDs[key]] = guide
+            guides[regionGuideID] = guideDict[guideIDs[key]]
+        regionGuides.append(guides)
+
+    time_1 = time.time()
+    logging.debug(
+        f"\t\t[FINISHED]\tFound {len(guideDict)} unique gRNAs in {str(round(time_1-time_0,4))}s"
+    )
+    logging.debug("\t\t[STARTED]\t\tSearching for potential off target sites...")
+
+    build = offtarget_cache.genomeBuild(genome_fa)
+    cacheKeys = {
+        guideID: offtarget_cache.guideKey(
+            guide, args.genome, build, args.rgenID, maxOffTargets
+        )
+        for guideID, guide in guideDict.items()
+    }
+    uncachedGuides = offtarget_cache.fetchCachedGuides(
+        dbConnection.offTargetCache, guideDict, cacheKeys
+    )
+    if uncachedGuides:
+        # all the uncached guides are aligned together
+        uncachedGuides = find_offtargets.findOffTargets(
+            uncachedGuides,
+            args.rgenID,
+            args.genome,
+            maxOffTargets,
+            batchID,
+            genome_fa,
+            tempfiles_path,
+        )
+
+    time_2 = time.time()
+    logging.debug(
+        f"\t\t[FINISHED]\tFound offtargets of {len(uncachedGuides)} uncached gRNAs in {str(round(time_2-time_1,4))}s"
+    )
+    logging.debug("\t\t[STARTED]\t\tScoring potential off target sites and guides...")
+
+    if uncachedGuides:
+        scoreInParallel(
+            uncachedGuides,
+            args.rgenID,
+            genome_fa,
+            twoBitToFa_path,
+            genome_2bit,
+            args.processes,
+        )
+        offtarget_cache.storeGuides(
+            dbConnection.offTargetCache, uncachedGuides, cacheKeys
+        )
+
+    time_3 = time.time()
+    logging.debug(f"\t\t[FINISHED]\tScored in {str(round(time_3-time_2,4))}s")
+    logging.debug("\t\t[STARTED]\t\tCategorizing potential off target sites...")
+
+    if guideDict:
+        categorize_offtargets.categorizeOffTargets(
+            guideDict, args.rgenID, args.genome, batchID
+        )
+
+    time_4 = time.time()
+    logging.debug(f"\t\t[FINISHED]\tCategorized in {str(round(time_4-time_3,4))}s")
+    logging.debug("\t\t[STARTED]\t\tWriting CSV files...")
+
+    writeResults(args, maxOffTargets, batchID, regions, regionGuides)
+
+    time_5 = time.time()
+    logging.debug(f"\t\t[FINISHED]\tWrote CSV files in {str(round(time_5-time_4,4))}s")
+
+
+def regionCsvPath(outdir, index, gene):
+    """the csv of each region is named by its position in the input and its gene"""
+    return os.path.join(
+        outdir, str(index + 1) + "_" + re.sub(r"[^\w.-]+", "_", gene) + ".csv"
+    )
+
+
+def writeResults(args, maxOffTargets, batchID, regions, regionGuides):
+    """writes a GuideSearchAndScore csv for each region and a summary csv of every guide"""
+    summaryColumns = [
+        "Region",
+        "Gene",
+        "Location",
+        "Sequence",
+        "Off-target Counts",
+        "No mismatches in Seed",
+        "MIT",
+        "CFD",
+        "Rank",
+        "Status",
+    ]
+    with open(os.path.join(args.outdir, "summary.csv"), mode="w") as summary_file:
+        summary = csv.writer(summary_file, delimiter=",")
+        summary.writerow(summaryColumns)
+        for i, ((searchInput, gene), guides) in enumerate(zip(regions, regionGuides)):
+            if not guides:
+                summary.writerow([searchInput, gene] + ["-"] * 7 + ["No guides found"])
+                continue
+            # the region's results are formatted by the single region search
+            search = GuideSearchAndScore(
+                **{
+                    "genome": args.genome,
+                    "searchInput": searchInput,
+                    "gene": gene,
+                    "output": regionCsvPath(args.outdir, i, gene),
+                    "rgenID": args.rgenID,
+                    "guideLength": args.spacer,
+                    "maxOffTargets": maxOffTargets,
+                    "command-line": True,
+                    "guideDict": guides,
+                    "batchID": batchID,
+                }
+            )
+            for guideID, guide in guides.items():
+                if guide["max_exceeded"]:
+                    status = "Max off target sites exceeded"
+                elif guide["skip"]:
+                    status = "Skipped, multiple hits with <= 1 mismatch"
+                else:
+                    status = ""
+                summary.writerow(
+                    [
+                        searchInput,
+                        gene,
+                        search.calculateLocation(guide),
+                        search.formatSequence(guide["guide_seq"], guide["pam_seq"]),
+                        "-".join(map(str, guide["offtarget_counts"])),
+                        "-".join(map(str, guide["offtargets_seed"])),
+                        guide.get("MIT", "-"),
+                        guide.get("CFD", "-"),
+                        guide["Rank"],
+                        status,
+                    ]
+                )
+
+
+def main():
+    desc = """ Searches and scores the guides in every region of a BED or TSV file, writing a csv
+    of the results for each region (as GuideSearchAndScore.py does) and a summary csv of all the guides.
+    Guides shared by overlapping regions are only searched once and all the off-targets are found
+    with a single alignment.
+    """
+
+    parser = argparse.ArgumentParser(prog="BatchGuideSearch", description=desc)
+    parser._action_groups.pop()
+    required = parser.add_argument_group("required arguments")
+    optional = parser.add_argument_group("optional arguments")
+    required.add_argument("--genome", help="Genome database (e.g. mm10)", required=True)
+    required.add_argument(
+        "--regions",
+        help="BED file (chrom, start, end, name) or TSV (chrom:start-end, gene) of regions",
+        required=True,
+    )
+    required.add_argument(
+        "--outdir", help="Directory to write the csv files to", required=True
+    )
+    # optional flags:
+    # default RGEN to 1 (SpCas9 with unmodified rgens.json)
+    optional.add_argument("--rgenID", nargs="?", default=1, help="id of desired RGEN")
+    # default guide length (protospacer) to 20
+    optional.add_argument(
+        "--spacer",
+        nargs="?",
+        default=20,
+        type=int,
+        help="Length of protospacer (e.g. 20)",
+    )
+    # default max off targets to 1000
+    optional.add_argument(
+        "--maxOffTargets",
+        nargs="?",
+        default=1000,
+        type=int,
+        help="Maximum number of off-targets to consider for any guide. Use -1 for no max",
+    )
+    optional.add_argument(
+        "--processes",
+        nargs="?",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of processes to score the guides with (default: number of cpus)",
+    )
+    args = parser.parse_args()
+
+    logging.debug("[CLI]\t\tRunning batch guide search with parameters:")
+    logging.debug(f"\t\t{vars(args)}")
+
+    batchGuideSearch(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,18 +11,25 @@ Requires: batch id, guideID, label, and notes
 import argparse
 import cgi
 import datetime
-import json
 import os
 import sys
-import tempfile
 
 dir_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(dir_path, "../helpers"))
+import AppServer
+
+# hand the request to the application server when it's running
+if __name__ == "__main__":
+    AppServer.relayRequest(__file__)
+
 # for debugging:
 import cgitb
 
 from Config import Config
 
+sys.path.append(os.path.join(dir_path, "core"))
+import batch_results
+
 cgitb.enable()
 
 
@@ -40,7 +47,7 @@ class GuideAdd:
         self.notes = kwargs["notes"] if "notes" in kwargs else ""
 
         # fetch the stored guide info
-        self.metadata, self.guide = self.parseJSON()
+        self.metadata, self.guide = self.readBatch()
         self.rgen = self.getRGEN(str(self.metadata["rgenID"]))
         # redefine the connection to the database based on the genome
         self.dbConnection = Config(self.metadata["genome"])
@@ -263,20 +270,19 @@ class GuideAdd:
         else:
             return None
 
-    def parseJSON(self):
-        """access the batch's json file, parse the metadata for the run as well as the details of the guide of interest"""
-        with open(
-            os.path.join(tempfile.gettempdir(), self.batchID + ".json"), "r"
-        ) as json_file:
-            jsonData = json.load(json_file)
-
-        if "metadata" in jsonData:
-            if self.guideID in jsonData:
-                return jsonData["metadata"], jsonData[self.guideID]
-            else:
-                self.sendErrorHTML("Unable to find guide in batch JSON file")
+    def readBatch(self):
+        """access the batch's file, read the metadata for the run as well as the details of the guide of interest"""
+        try:
+            metadata, guide = batch_results.readGuide(self.batchID, self.guideID)
+        except FileNotFoundError:
+            self.sendErrorHTML("Unable to find the batch file of the search")
+        except ValueError:
+            self.sendErrorHTML("Invalid batch ID: " + str(self.batchID))
+
+        if guide is not None:
+            return metadata, guide
         else:
-            self.sendErrorHTML("Batch JSON file is misconfigured; no metadata found")
+            self.sendErrorHTML("Unable to find guide in batch file")
 
     def sendErrorHTML(self, errorString):
         """write error and exit the program"""
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3.7
+
+"""
+Script for downloading the off-targets found by a guide search
+Requires: batch id, and optionally a guideID
+
+Serves the gzipped tsv of the off-targets of all the batch's guides as it was written, or the
+rows of a single guide read from their own part of it
+"""
+
+import argparse
+import cgi
+import os
+import shutil
+import sys
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(dir_path, "../helpers"))
+import AppServer
+
+# hand the request to the application server when it's running
+if __name__ == "__main__":
+    AppServer.relayRequest(__file__)
+
+sys.path.append(os.path.join(dir_path, "core"))
+import batch_results
+import search_jobs
+
+
+def sendError(status, errorString):
+    """write the error response and exit the program"""
+    print(f"Status: {status}")
+    print("Content-type: text/plain\n")
+    print(errorString)
+    sys.exit()
+
+
+def sendExport(batchID, guideID=None):
+    """writes the response with the batch's off-targets, or only those of the guide if a guideID is given"""
+    if not search_jobs.batchIDFormat.match(str(batchID)):
+        sendError("400 Bad Request", "Invalid batch ID: " + str(batchID))
+    if not os.path.exists(batch_results.exportPath(batchID)):
+        sendError("404 Not Found", "The results of this search have expired")
+
+    if guideID is None:
+        print("Content-type: application/gzip")
+        print(
+            f'Content-Disposition: attachment; filename="{batchID}_offtargets.tsv.gz"\n'
+        )
+        sys.stdout.flush()
+        with open(batch_results.exportPath(batchID), "rb") as export_file:
+            shutil.copyfileobj(export_file, sys.stdout.buffer)
+    else:
+        # the guideID is part of the file name sent in the response's headers
+        if not batch_results.guideIDFormat.match(str(guideID)):
+            sendError("400 Bad Request", "Invalid guide ID: " + str(guideID))
+        lines = batch_results.readExport(batchID, guideID)
+        try:
+            heading = next(lines)
+        except FileNotFoundError:
+            sendError("404 Not Found", "The results of this search have expired")
+        except KeyError:
+            sendError("404 Not Found", "No off-targets of guide " + guideID)
+        # guideIDs are a position and a strand
+        filename = f"{batchID}_{guideID.replace('+', 'plus').replace('-', 'minus')}"
+        print("Content-type: text/tab-separated-values")
+        print(f'Content-Disposition: attachment; filename="{filename}.tsv"\n')
+        sys.stdout.write(heading)
+        sys.stdout.writelines(lines)
+    sys.stdout.flush()
+
+
+def main():
+    # check if running from web or command-line
+    if "REQUEST_METHOD" in os.environ:
+        # running from web
+        inputForm = cgi.FieldStorage()
+        if inputForm.getvalue("batchID") is None:
+            sendError("400 Bad Request", "'batchID' not set")
+        sendExport(inputForm.getvalue("batchID"), inputForm.getvalue("guideID"))
+    else:
+        desc = """ The command-line version of GuideDownload.py prints the off-targets of a searched guide, or of all the guides of the search.
+         """
+
+        parser = argparse.ArgumentParser(prog="GuideDownload", description=desc)
+        parser._action_groups.pop()
+        required = parser.add_argument_group("required arguments")
+        optional = parser.add_argument_group("optional arguments")
+        required.add_argument("--batch", help="Batch ID", required=True)
+        optional.add_argument("--guide", help="Guide ID")
+        args = parser.parse_args()
+
+        sys.stdout.writelines(batch_results.readExport(args.batch, args.guide))
+
+
+if __name__ == "__main__":
+    main()
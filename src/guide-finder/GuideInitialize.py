@@ -25,14 +25,21 @@ import os
 import re
 import sys
 
-from jinja2 import Template
-
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../helpers"))
+import AppServer
+
+# hand the request to the application server when it's running
+if __name__ == "__main__":
+    AppServer.relayRequest(__file__)
+
 # cgi debug module
 import cgitb
 
 from Config import Config
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "core"))
+import templates
+
 cgitb.enable()
 
 
@@ -94,40 +101,22 @@ class GuideSearch:
             "search_location": self.getInputHTML(),
             "available_genes": self.getOverlappingGenesHTML(),
         }
-        template_path = os.path.join(
-            self.dbConnection.ROOT_PATH,
-            "src/guide-finder/jinja2-templates/input_region.html",
-        )
-        region_template = Template(open(template_path, "rb").read().decode("utf-8"))
-        html_result = region_template.render(template_values)
-        return html_result
+        return templates.render("input_region.html", template_values)
 
     def initialHTML(self):
+        # the input row is included from input_region.html with the same values
         template_values = {
             "search_location": self.getInputHTML(),
-            "input_row": self.inputRowHTML(),
             "organism": self.getOrganismHTML(),
             "RGENS": self.getRgenHTML(),
             "guideLengths": self.getLengthsHTML(),
             "available_genes": self.getOverlappingGenesHTML(),
         }
-        template_path = os.path.join(
-            self.dbConnection.ROOT_PATH, "src/guide-finder/jinja2-templates/select.html"
-        )
-        initial_template = Template(open(template_path, "rb").read().decode("utf-8"))
-        html_result = initial_template.render(template_values)
-        return html_result
+        return templates.render("select.html", template_values)
 
     def sendErrorHTML(self, errorString):
         """format exceptions in HTML to prevent page from crashing"""
-        if not hasattr(self, "dbConnection"):
-            self.dbConnection = Config()
-        template_path = os.path.join(
-            self.dbConnection.ROOT_PATH, "src/guide-finder/jinja2-templates/error.html"
-        )
-        error_template = Template(open(template_path, "rb").read().decode("utf-8"))
-        html_result = error_template.render(errorString=errorString)
-        print(html_result)
+        print(templates.render("error.html", errorString=errorString))
         sys.exit()
 
     def getOrganismHTML(self):
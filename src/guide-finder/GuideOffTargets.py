@@ -0,0 +1,216 @@
+#!/usr/bin/env python3.7
+
+"""
+Class for fetching the off-targets of a searched guide for its modal on the result page
+Requires: batch id, guideID, and number of mismatches
+
+The result page only lists the off-target counts of each guide, the table of the off-targets
+with a given number of mismatches is rendered from the batch's file when its modal is opened
+"""
+
+import argparse
+import cgi
+import html
+import os
+import sys
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(dir_path, "../helpers"))
+import AppServer
+
+# hand the request to the application server when it's running
+if __name__ == "__main__":
+    AppServer.relayRequest(__file__)
+
+# for debugging:
+import cgitb
+
+from Config import Config
+
+sys.path.append(os.path.join(dir_path, "core"))
+import batch_results
+import search_jobs
+import templates
+
+cgitb.enable()
+
+# the most off-targets listed in each table of the modal
+MAX_SHOWN = 20
+
+
+class GuideOffTargets:
+    def __init__(self, **kwargs):
+        """class for rendering the off-target modal of a guide"""
+        # check required inputs set
+        for parameter in ["batchID", "guideID", "mismatches"]:
+            if parameter not in kwargs:
+                self.sendErrorHTML("'{parameter}' not set".format(**locals()))
+        if not search_jobs.batchIDFormat.match(str(kwargs["batchID"])):
+            self.sendErrorHTML("Invalid batch ID: " + str(kwargs["batchID"]))
+        self.batchID = kwargs["batchID"]
+        self.guideID = kwargs["guideID"]
+        try:
+            self.mismatches = int(kwargs["mismatches"])
+        except ValueError:
+            self.sendErrorHTML("Invalid number of mismatches: " + kwargs["mismatches"])
+
+        # fetch the stored guide info
+        self.dbConnection = Config()
+        self.metadata, self.guide = self.readBatch()
+        self.rgenRecord = self.getRGEN(str(self.metadata["rgenID"]))
+
+        print(self.modalHTML())
+
+    def readBatch(self):
+        """read the metadata for the run and the details of the guide of interest from the batch's file"""
+        try:
+            metadata, guide = batch_results.readGuide(self.batchID, self.guideID)
+        except FileNotFoundError:
+            self.sendErrorHTML("The results of this search have expired")
+
+        if guide is None:
+            self.sendErrorHTML("Unable to find guide " + str(self.guideID))
+        return metadata, guide
+
+    def getRGEN(self, rgenID):
+        """fetch the rgen record of the search"""
+        rgenRecord = self.dbConnection.rgenCollection.find_one({"rgenID": rgenID})
+        if rgenRecord is None:
+            self.sendErrorHTML("Invalid rgenID: " + rgenID)
+        return rgenRecord
+
+    def modalHTML(self):
+        """renders the header and body of the modal for the guide's off-targets with the number of mismatches"""
+        # the off-targets are labelled with their number of mismatches (and seed mismatches) when they're counted
+        offtarget_subset = [
+            offtarget
+            for offtarget in self.guide["offtargets"]
+            if offtarget["mismatches"] == self.mismatches
+        ]
+        sections = []
+        if len(offtarget_subset) > 0:
+            standard_offtargets, none_in_seed = self.separateOffTargets(
+                offtarget_subset
+            )
+            # those with no mismatches in the seed are listed first
+            for noneInSeed, offtarget_list in [
+                (True, none_in_seed),
+                (False, standard_offtargets),
+            ]:
+                if len(offtarget_list) > 0:
+                    sections.append(
+                        {
+                            "noneInSeed": noneInSeed,
+                            "total": len(offtarget_list),
+                            "offtargets": self.offtargetTableRows(offtarget_list),
+                        }
+                    )
+
+        template_values = {
+            "mismatches": self.mismatches,
+            "guideSeq": self.formatSequence(
+                self.guide["guide_seq"], self.guide["pam_seq"]
+            ),
+            "numOffTargets": len(offtarget_subset),
+            "sections": sections,
+        }
+        return templates.render("offtarget_modal.html", template_values)
+
+    def offtargetTableRows(self, offtarget_list):
+        """formats and sorts the first MAX_SHOWN off-targets of the list for their table"""
+
+        offtarget_list = offtarget_list[:MAX_SHOWN]
+
+        for offtarget in offtarget_list:
+            offtarget.update(
+                {
+                    "formatted_seq": self.colourLowercaseRed(
+                        self.formatSequence(offtarget["seq"], offtarget["pam"])
+                    )
+                }
+            )
+        # sort by score if available (they aren't if max_exceeded)
+        if "MIT" in offtarget_list[0]:
+            offtarget_list = sorted(
+                offtarget_list, key=lambda x: x["MIT"], reverse=True
+            )
+        elif "CFD" in offtarget_list[0]:
+            offtarget_list = sorted(
+                offtarget_list, key=lambda x: x["CFD"], reverse=True
+            )
+
+        return offtarget_list
+
+    def separateOffTargets(self, off_target_subset):
+        """given a list of filtered off-targets, separate the regular ones from those that have no mismatches in the rgen's seed region"""
+        standard_offtargets = []
+        none_in_seed = []
+        for offtarget in off_target_subset:
+            if offtarget["none_in_seed"]:
+                none_in_seed.append(offtarget)
+            else:
+                standard_offtargets.append(offtarget)
+
+        return standard_offtargets, none_in_seed
+
+    def formatSequence(self, guide_seq, pam_seq):
+        """uses the rgen record to determine which order to display the pam and sequence in"""
+        if self.rgenRecord["PamLocation"] == "upstream":
+            return pam_seq + ", " + guide_seq
+        else:
+            return guide_seq + ", " + pam_seq
+
+    def colourLowercaseRed(self, inputString):
+        """wraps the lowercase letters of a string in a span html tag that has a class to colour items within it red"""
+        result = ""
+        for letter in inputString:
+            if letter.islower():
+                result += "<span class='green'>" + letter + "</span>"
+            else:
+                result += letter
+
+        return result
+
+    def sendErrorHTML(self, errorString):
+        """write the error in the modal and exit the program"""
+        print(
+            "<div class='modal-body'>Error: {error}</div>".format(
+                error=html.escape(str(errorString))
+            )
+        )
+        sys.exit()
+
+
+def main():
+    # check if running from web or command-line
+    if "REQUEST_METHOD" in os.environ:
+        # running from web
+        print("Content-type: text/html\n")
+        inputForm = cgi.FieldStorage()
+        parameters = {}
+        for arg in ["batchID", "guideID", "mismatches"]:
+            if inputForm.getvalue(arg) is not None:
+                parameters[arg] = inputForm.getvalue(arg)
+
+        GuideOffTargets(**parameters)
+    else:
+        desc = """ The command-line version of GuideOffTargets.py prints the off-target modal of a searched guide.
+         """
+
+        parser = argparse.ArgumentParser(prog="GuideOffTargets", description=desc)
+        parser._action_groups.pop()
+        required = parser.add_argument_group("required arguments")
+        required.add_argument("--batch", help="Batch ID", required=True)
+        required.add_argument("--guide", help="Guide ID", required=True)
+        required.add_argument(
+            "--mismatches", help="Number of mismatches", type=int, required=True
+        )
+        args = parser.parse_args()
+
+        GuideOffTargets(
+            batchID=args.batch, guideID=args.guide, mismatches=args.mismatches
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,8 @@ Requires: input region, genome, rgen, and gene
 
 Steps:
 1) Gets the sequence within the search location (get_sequence.py)
-2) Finds the gRNAs within the sequence (find_grna.py)
+2) Finds the gRNAs within the sequence (find_grna.py), or fetches them from the precomputed guide table
+   if the region was precomputed by PrecomputeGuides.py, skipping steps 3 and 4 (precomputed_guides.py)
 3) Finds and counts all the off-targets in the genome for each guide (find_offtargets.py)
 4) Scores the off-targets and calculates an aggregate score for each guide (score_offtargets.py)
 5) Categorizes each off-target into 'intergenic', 'intronic', and 'exonic'
@@ -29,19 +30,29 @@ import time
 import urllib.parse
 from collections import OrderedDict
 
-from jinja2 import Template
-
 # import external classes based on relative file location
 dir_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(dir_path, "../helpers"))
+import AppServer
+
+# hand the request to the application server when it's running
+if __name__ == "__main__":
+    AppServer.relayRequest(__file__)
+
 from Config import Config
+from pymongo import ASCENDING
 
 sys.path.append(os.path.join(dir_path, "core"))
+import batch_results
 import categorize_offtargets
 import find_grna
 import find_offtargets
 import get_sequence
+import offtarget_cache
+import precomputed_guides
 import score_offtargets
+import search_jobs
+import templates
 
 today = datetime.date.today()
 log_filename = (
@@ -57,6 +68,13 @@ logging.basicConfig(
     level=logging.DEBUG,
 )
 
+# chunked searches split the region into windows of the largest region searched at once
+CHUNK_WINDOW = 3000
+# and align and score the guides of the windows in batches of at least this many
+CHUNK_GUIDES = 500
+# genomes whose stored guides this process has made sure are indexed for the result lookup
+indexedGenomes = set()
+
 
 class GuideSearchAndScore:
     def __init__(self, **kwargs):
@@ -70,6 +88,8 @@ class GuideSearchAndScore:
             import cgitb
 
             cgitb.enable()
+        # chunked searches write their results to the output csv as they complete, only the cli supports them
+        self.chunked = self.cli and kwargs.get("chunked", False)
 
         # validate searchInput
         if "searchInput" not in kwargs:
@@ -120,7 +140,24 @@ class GuideSearchAndScore:
 
         time_0 = time.time()
         logging.debug("[STARTED]\t\tPerforming guide searches...")
-        self.guideDict, self.batchID = self.performGuideSearch()
+        if "guideDict" in kwargs:
+            # the search was already run for this region (i.e. by BatchGuideSearch.py)
+            self.guideDict, self.batchID = kwargs["guideDict"], kwargs["batchID"]
+        elif self.chunked:
+            # the results were written to the output csv as each batch of guides completed
+            self.batchID, totals = self.performChunkedSearch()
+            logging.debug(
+                f"[FINISHED]\t\tPerformed chunked guide search of {totals['guides']} guides in {str(round(time.time()-time_0,4))}s"
+            )
+            if totals["guides"] == 0:
+                print("No guides found in input region")
+            logging.debug(f"TOTAL TIME ELAPSED: {round(time.time()-time_0,4)}s\n\n")
+            return
+        else:
+            # queued searches are run under the batchID they were submitted with
+            self.guideDict, self.batchID = self.performGuideSearch(
+                kwargs.get("batchID")
+            )
 
         time_1 = time.time()
         logging.debug(
@@ -148,13 +185,13 @@ class GuideSearchAndScore:
 
             if not self.cli:
                 time_6 = time.time()
-                logging.debug("[STARTED]\t\tWriting JSON file...")
+                logging.debug("[STARTED]\t\tWriting batch file...")
 
-                self.writeJsonFile()
+                self.writeBatchFile()
 
                 time_7 = time.time()
                 logging.debug(
-                    f"[FINISHED]\t\tWrote JSON file in {str(round(time_7-time_6,4))}s"
+                    f"[FINISHED]\t\tWrote batch file in {str(round(time_7-time_6,4))}s"
                 )
 
                 time_8 = time.time()
@@ -179,7 +216,7 @@ class GuideSearchAndScore:
                 )
             else:
                 print("No guides found in input region")
-        logging.debug(f"TOTAL TIME ELAPSED: {round(time_9-time_0,4)}s\n\n")
+        logging.debug(f"TOTAL TIME ELAPSED: {round(time.time()-time_0,4)}s\n\n")
 
     def setScores(self):
         # scores = set({}) # make a set
@@ -195,46 +232,12 @@ class GuideSearchAndScore:
         return available
 
     def renderTemplate(self, template_name, template_values):
-        """given the name of the template, goes to the templates folder, renders it, and returns the result"""
-        template_path = os.path.join(
-            self.dbConnection.ROOT_PATH,
-            "src/guide-finder/jinja2-templates/{template_name}".format(
-                template_name=template_name
-            ),
-        )
-        template = Template(open(template_path, "rb").read().decode("utf-8"))
-        html_result = template.render(template_values)
-        return html_result
-
-    def guideTableHTML(self):
-        """format the guide dictionary into an HTML table"""
-        template_values = {
-            "guides": self.guideDict,
-            "table_heading": self.tableHeadingHTML(),
-            "table_body": self.tableBodyHTML(),
-        }
-        return self.renderTemplate("guide_table.html", template_values)
-
-    def tableHeadingHTML(self):
-        """determine which info for the guides is available and display the headings for those"""
-
-        scoreHeading = ""
-        scoreHeaders = ""
-        if len(self.scores) > 0:
-            scoreHeading += "<th colspan='{num_scores}'>Scoring</th>".format(
-                num_scores=len(self.scores)
-            )
-            for score in self.scores:
-                scoreHeaders += "<th>{score}</th>".format(score=score)
-
-        template_values = {"score_heading": scoreHeading, "score_headers": scoreHeaders}
-
-        return self.renderTemplate("table_heading.html", template_values)
+        """given the name of the template, renders it from the shared template environment and returns the result"""
+        return templates.render(template_name, template_values)
 
-    def tableBodyHTML(self):
-        """generate HTML row containing info for each potential guide"""
+    def guideTableRows(self):
+        """sorts the guides and gathers the values displayed in each of their rows of the guide table"""
 
-        # generate OrderedDict
         if "MIT" in self.scores:
             sortedIDs = sorted(
                 self.guideDict.keys(),
@@ -247,69 +250,91 @@ class GuideSearchAndScore:
                 self.guideDict.keys(), key=lambda x: (self.guideDict[x]["Rank"])
             )
 
-        sortedGuides = OrderedDict((x, self.guideDict[x]) for x in sortedIDs)
-        bodyHTML = "<tbody>" + self.tableRowsHTML(sortedGuides) + "</tbody>"
-
-        return bodyHTML
-
-    def tableRowsHTML(self, sortedGuides):
-        """for each guide, generate the HTML for its row"""
-
-        rowsHTML = ""
+        locations = {
+            guideID: self.calculateLocation(guide)
+            for guideID, guide in self.guideDict.items()
+        }
+        storedGuides = self.fetchGuidesFromDatabase(locations)
 
-        for guideID, guide in sortedGuides.items():
-            template_values = {
-                "guideID": guideID,
-                "guide": guide,
-                "inDatabase": self.guideExistsInDatabase(guideID),
-                "guideSeq": self.formatSequence(guide["guide_seq"], guide["pam_seq"]),
-                "guideLocation": self.calculateLocation(guide),
-                "offtargetModal": self.offtargetHTML(guideID, guide),
-                "rowPopover": self.rowPopoverHTML(guideID),
-            }
-            rowsHTML += self.renderTemplate("table_row.html", template_values)
+        rows = []
+        for guideID in sortedIDs:
+            guide = self.guideDict[guideID]
+            rows.append(
+                {
+                    "guideID": guideID,
+                    "guide": guide,
+                    "inDatabase": guideID in storedGuides,
+                    "guideSeq": self.formatSequence(
+                        guide["guide_seq"], guide["pam_seq"]
+                    ),
+                    "guideLocation": locations[guideID],
+                    "offtargets": self.offtargetCell(guideID, guide),
+                    "popover": self.rowPopover(guideID, storedGuides.get(guideID)),
+                }
+            )
 
-        return rowsHTML
+        return rows
 
-    def rowPopoverHTML(self, guideID):
-        """given a guideID fetch the label and notes if it's already in the database, give the option to add it otherwise"""
+    def rowPopover(self, guideID, storedGuide):
+        """given a guideID and its database record, give its label and notes if it's already stored, the option to add it otherwise"""
 
-        button_text, label, notes = self.fetchGuideFromDatabase(guideID)
+        if storedGuide:
+            button_text, label, notes = (
+                "Update Guide",
+                storedGuide["label"],
+                storedGuide["Notes"],
+            )
+        else:
+            button_text, label, notes = "Add to Database", "", ""
 
-        template_values = {
+        return {
             "batch_guideID": str(self.batchID + "_" + guideID),
             "buttonText": button_text,
             "defaultLabel": urllib.parse.unquote(label),
             "defaultNotes": urllib.parse.unquote(notes),
         }
-        return self.renderTemplate("row_popover.html", template_values)
 
-    def fetchGuideFromDatabase(self, guideID):
-        """determine whether the given guide is in the database, return its label and notes, plus a descriptor of the available action"""
+    def fetchGuidesFromDatabase(self, locations):
+        """given the location of each guide, returns the database records of those already stored keyed by guideID"""
+        self.createGuideIndex()
+        keys = {
+            guideID: (guide["guide_seq"], guide["pam_seq"], locations[guideID])
+            for guideID, guide in self.guideDict.items()
+        }
+        # one query for all the guides, the matches are then paired up by their key
         searchQuery = {
-            "guideSeq": self.guideDict[guideID]["guide_seq"],
-            "pamSeq": self.guideDict[guideID]["pam_seq"],
-            "guideLocation": self.calculateLocation(self.guideDict[guideID]),
+            "guideSeq": {"$in": list({key[0] for key in keys.values()})},
+            "pamSeq": {"$in": list({key[1] for key in keys.values()})},
+            "guideLocation": {"$in": list({key[2] for key in keys.values()})},
         }
-        if self.dbConnection.guideCollection.count_documents(searchQuery) > 0:
-            existingGuide = self.dbConnection.guideCollection.find_one(
-                searchQuery, {"label": 1, "Notes": 1}
-            )
-            return "Update Guide", existingGuide["label"], existingGuide["Notes"]
-        else:
-            return "Add to Database", "", ""
+        projection = {
+            "guideSeq": 1,
+            "pamSeq": 1,
+            "guideLocation": 1,
+            "label": 1,
+            "Notes": 1,
+        }
+        records = {}
+        for record in self.dbConnection.guideCollection.find(searchQuery, projection):
+            key = (record["guideSeq"], record["pamSeq"], record["guideLocation"])
+            records.setdefault(key, record)
 
-    def guideExistsInDatabase(self, guideID):
-        """return true if the guide is already stored, false otherwise"""
-        searchQuery = {
-            "guideSeq": self.guideDict[guideID]["guide_seq"],
-            "pamSeq": self.guideDict[guideID]["pam_seq"],
-            "guideLocation": self.calculateLocation(self.guideDict[guideID]),
+        return {
+            guideID: records[key] for guideID, key in keys.items() if key in records
         }
-        if self.dbConnection.guideCollection.count_documents(searchQuery) > 0:
-            return True
-        else:
-            return False
+
+    def createGuideIndex(self):
+        """creates the index the lookup of stored guides uses, once per genome in each process"""
+        if self.genome in indexedGenomes:
+            return
+        self.dbConnection.guideCollection.create_index(
+            [
+                ("guideSeq", ASCENDING),
+                ("pamSeq", ASCENDING),
+                ("guideLocation", ASCENDING),
+            ]
+        )
+        indexedGenomes.add(self.genome)
 
     def formatSequence(self, guide_seq, pam_seq):
         """uses the rgen record to determine which order to display the pam and sequence in"""
@@ -346,169 +371,21 @@ class GuideSearchAndScore:
         else:
             self.sendError("Unrecognized strand for guide: " + str(guide["strand"]))
 
-    def offtargetHTML(self, guideID, guide):
-        """creates the HTML for the off-target modal of a given guide"""
-        classNameGuideID = guideID.replace("+", "plus").replace("-", "minus")
-        template_values = {
+    def offtargetCell(self, guideID, guide):
+        """gathers the values for the off-target cell of a given guide, its off-targets are fetched when their modal is opened"""
+        return {
             "guideID": guideID,
-            "guide": guide,
-            "offtargetCounts": self.offtargetCountsHTML(classNameGuideID, guide),
-            "offtargetModals": self.offtargetModalHTML(classNameGuideID, guide),
-            "csvFile": f"/download/{self.batchID}_{guideID}.csv",
+            "downloadFile": "GuideDownload.py?"
+            + urllib.parse.urlencode({"batchID": self.batchID, "guideID": guideID}),
             "totalCount": str(sum(guide["offtarget_counts"])),
         }
-        return self.renderTemplate("offtarget_cell.html", template_values)
-
-    def offtargetCountsHTML(self, guideID, guide):
-        """formats the links to the off-target modals"""
-        off_target_counts = "<div style='color: #2676ff; font-weight: bold'>"
-        for num_mismatches, num_offtargets in enumerate(guide["offtarget_counts"]):
-            off_target_counts += "<button class='btn btn-link no-padding' data-toggle='modal' data-target='#mismatch_{guideID}_{num_mismatches}'>{num_offtargets}</button>-".format(
-                **locals()
-            )
-        off_target_counts = off_target_counts[:-1]  # remove trailing dash
-        off_target_counts += "</div>"
-
-        return off_target_counts
-
-    def offtargetModalHTML(self, guideID, guide):
-        """format the modals for the off-targets"""
-        modalsHTML = ""
-        for num_mismatches, num_offtargets in enumerate(guide["offtarget_counts"]):
-            template_values = {
-                "guideID": guideID,
-                "guide": guide,
-                "mismatches": num_mismatches,
-                "guideSeq": self.formatSequence(guide["guide_seq"], guide["pam_seq"]),
-                "offTargetBody": self.offtargetModalBodyHTML(guide, num_mismatches),
-                "numOffTargets": len(self.subsetOffTargets(guide, num_mismatches)),
-            }
-            modalsHTML += self.renderTemplate("offtarget_modal.html", template_values)
-
-        return modalsHTML
-
-    def subsetOffTargets(self, guide, num_mismatches):
-        """returns the list of off-targets with the given number of mismatches"""
-        offtarget_subset = list(
-            filter(
-                lambda x: int(countLower(x["seq"])) == int(num_mismatches),
-                guide["offtargets"],
-            )
-        )
-        return offtarget_subset
-
-    def offtargetModalBodyHTML(self, guide, num_mismatches):
-        """format and print the table for the given number of off-targets"""
-        # get only the off-targets with the selected number of mismatches
-        offtarget_subset = self.subsetOffTargets(guide, num_mismatches)
-        if len(offtarget_subset) > 0:
-            # num_offtargets = len(offtarget_subset)
-            maxShown = 20
-            standard_offtargets, none_in_seed = self.separateOffTargets(
-                offtarget_subset
-            )
-            resultHTML = ""
-            if len(none_in_seed) > 0:
-                resultHTML += "<p class='tableTitle left'><b>{count}</b> With No Mismatches in Seed:</p>".format(
-                    count=len(none_in_seed)
-                )
-                resultHTML += self.offTargetTableHTML(none_in_seed, maxShown)
-                if len(standard_offtargets) > 0:
-                    resultHTML += "<p class='tableTitle left'><b>{count}</b> With Mismatches in Seed:</p>".format(
-                        count=str(len(standard_offtargets))
-                    )
-                    resultHTML += self.offTargetTableHTML(standard_offtargets, maxShown)
-            else:
-                resultHTML += "<p class='tableTitle left'><b>{count}</b> With Mismatches in Seed:</p>".format(
-                    count=str(len(standard_offtargets))
-                )
-                resultHTML += self.offTargetTableHTML(standard_offtargets, maxShown)
-
-            return resultHTML
-        else:
-            return "<p>No Off-Targets with {mismatches} Mismatches</p>".format(
-                mismatches=str(num_mismatches)
-            )
-
-    def offTargetTableHTML(self, offtarget_list, maxShown):
-        """sorts, formats and returns a table of off-targets from the offtarget list provided"""
-
-        num_offtargets = len(offtarget_list)
-        offtarget_list = offtarget_list[:maxShown]
-
-        for offtarget in offtarget_list:
-            offtarget.update(
-                {
-                    "formatted_seq": self.colourLowercaseRed(
-                        self.formatSequence(offtarget["seq"], offtarget["pam"])
-                    )
-                }
-            )
-        # sort by score if available
-        if "MIT" in self.scores and "MIT" in offtarget_list[0]:  # in case max_exceeded
-            offtarget_list = sorted(
-                offtarget_list, key=lambda x: x["MIT"], reverse=True
-            )
-        elif "CFD" in self.scores and "CFD" in offtarget_list[0]:
-            offtarget_list = sorted(
-                offtarget_list, key=lambda x: x["CFD"], reverse=True
-            )
-
-        total_count = ""
-        if num_offtargets > maxShown:
-            total_count = "<p>({max} of {total} shown)</p>".format(
-                max=str(maxShown), total=str(num_offtargets)
-            )
-
-        template_values = {"offtargetSubset": offtarget_list, "totalCount": total_count}
-
-        return self.renderTemplate("offtarget_table.html", template_values)
-
-    def separateOffTargets(self, off_target_subset):
-        """given a list of filtered off-targets, separate the regular ones from those that have no mismatches in the rgen's seed region"""
-        seedDirection = self.rgenRecord["SeedRegion"][0]
-        seedLength = int(self.rgenRecord["SeedRegion"][1:])
-        guideLength = len(off_target_subset[0]["seq"])
-        standard_offtargets = []
-        none_in_seed = []
-        for offtarget in off_target_subset:
-            if self.hasMismatchInSeed(
-                offtarget["seq"], seedDirection, seedLength, guideLength
-            ):
-                standard_offtargets.append(offtarget)
-            else:
-                none_in_seed.append(offtarget)
-
-        return standard_offtargets, none_in_seed
-
-    def hasMismatchInSeed(self, offtargetSeq, seedDirection, seedLength, guideLength):
-        """given an offtarget's guide sequence, returns true if there is a mismatch in the seed region of the rgen and false otherwise"""
-        if seedDirection == "+":
-            for idx in range(0, seedLength):
-                if offtargetSeq[idx].islower():
-                    return True
-        elif seedDirection == "-":
-            for idx in reversed(range(guideLength - seedLength, guideLength)):
-                if offtargetSeq[idx].islower():
-                    return True
-
-        return False
-
-    def colourLowercaseRed(self, inputString):
-        """wraps the lowercase letters of a string in a span html tag that has a class to colour items within it red"""
-        result = ""
-        for letter in inputString:
-            if letter.islower():
-                result += "<span class='green'>" + letter + "</span>"
-            else:
-                result += letter
-
-        return result
 
     def sendResultHTML(self):
         """take the results of the guide search and insert them into the result template"""
         template_values = {
-            "guideTable": self.guideTableHTML(),
+            "rows": self.guideTableRows(),
+            "scores": self.scores,
+            "batchID": self.batchID,
             "searchInput": self.searchInput,
             "rgen": self.rgenRecord,
             "gene": self.gene,
@@ -525,9 +402,6 @@ class GuideSearchAndScore:
 
     def sendError(self, errorString):
         """format exceptions in HTML to prevent page from crashing"""
-        if not hasattr(self, "dbConnection"):
-            self.dbConnection = Config()
-
         if self.cli:
             raise Exception(errorString)
         else:
@@ -545,78 +419,76 @@ class GuideSearchAndScore:
                 f"Incorrect number of records returned from RGEN database for rgenID: {self.rgenID}"
             )
 
+    def writeCsvGuides(self, writer, guideDict, totals):
+        """writes the command-line csv rows of the guides, adding them to the totals of the search"""
+        for guideID, guide in guideDict.items():
+            totals["guides"] += 1
+            writer.writerow([str(guideID) + ":"])
+            if guide["max_exceeded"]:
+                writer.writerow(
+                    [
+                        "Max off target sites exceeded ("
+                        + str(sum(guide["offtarget_counts"]))
+                        + " shown)"
+                    ]
+                )
+                totals["offtargets"] += 1000
+                totals["exceeded"] += 1
+            elif guide["skip"]:
+                writer.writerow(
+                    [
+                        "Multiple hits with <= 1 mismatch found in genome. Skipped finding off-targets"
+                    ]
+                )
+                totals["skipped"] += 1
+            else:
+                writer.writerow(
+                    [
+                        "Total number of potential off-target sites:"
+                        + str(sum(guide["offtarget_counts"]))
+                    ]
+                )
+                totals["offtargets"] += sum(guide["offtarget_counts"])
+            writer.writerow(
+                ["Off-target Counts: " + "-".join(map(str, guide["offtarget_counts"]))]
+            )
+            writer.writerow(
+                [
+                    "No mismatches in Seed: "
+                    + "-".join(map(str, guide["offtargets_seed"]))
+                ]
+            )
+            if guide["MIT"] and not guide["max_exceeded"]:
+                writer.writerow(["MIT Score: " + str(guide["MIT"])])
+            if guide["CFD"] and not guide["max_exceeded"]:
+                writer.writerow(["CFD Score: " + str(guide["CFD"])])
+            writer.writerow(["Location", "Sequence", "Mismatches", "Context"])
+            writer.writerow(
+                [
+                    self.calculateLocation(guide),
+                    self.formatSequence(guide["guide_seq"], guide["pam_seq"]),
+                    "0",
+                    "guide",
+                ]
+            )
+
+    def writeCsvTotals(self, writer, totals):
+        """writes the closing rows of the command-line csv"""
+        writer.writerow([str(totals["guides"]) + " GUIDES FOUND"])
+        writer.writerow([str(totals["skipped"]) + " SKIPPED"])
+        writer.writerow([str(totals["exceeded"]) + " EXCEEDED MAX OFF TARGETS"])
+        writer.writerow([str(totals["offtargets"]) + " OFF TARGETS FOUND"])
+
     def writeCsvFiles(self):
-        """for each guide, write a csv file of its off-targets to the OS temporary file directory"""
+        """write the off-targets of the guides to the output csv, or to the batch's export for the web"""
         if self.cli:
             # if cli, put all guides into same csv
             if self.output_file:  # skip if none
-                total_offtargets_processed = 0
+                totals = {"guides": 0, "skipped": 0, "exceeded": 0, "offtargets": 0}
                 with open(self.output_file, mode="w") as csv_file:
                     writer = csv.writer(csv_file, delimiter=",")
-                    num_skipped = 0
-                    num_exceeded = 0
-                    for guideID, guide in self.guideDict.items():
-                        writer.writerow([str(guideID) + ":"])
-                        if guide["max_exceeded"]:
-                            writer.writerow(
-                                [
-                                    "Max off target sites exceeded ("
-                                    + str(sum(guide["offtarget_counts"]))
-                                    + " shown)"
-                                ]
-                            )
-                            total_offtargets_processed += 1000
-                            num_exceeded += 1
-                        elif guide["skip"]:
-                            writer.writerow(
-                                [
-                                    "Multiple hits with <= 1 mismatch found in genome. Skipped finding off-targets"
-                                ]
-                            )
-                            num_skipped += 1
-                        else:
-                            writer.writerow(
-                                [
-                                    "Total number of potential off-target sites:"
-                                    + str(sum(guide["offtarget_counts"]))
-                                ]
-                            )
-                            total_offtargets_processed += sum(guide["offtarget_counts"])
-                        writer.writerow(
-                            [
-                                "Off-target Counts: "
-                                + "-".join(map(str, guide["offtarget_counts"]))
-                            ]
-                        )
-                        writer.writerow(
-                            [
-                                "No mismatches in Seed: "
-                                + "-".join(map(str, guide["offtargets_seed"]))
-                            ]
-                        )
-                        if guide["MIT"] and not guide["max_exceeded"]:
-                            writer.writerow(["MIT Score: " + str(guide["MIT"])])
-                        if guide["CFD"] and not guide["max_exceeded"]:
-                            writer.writerow(["CFD Score: " + str(guide["CFD"])])
-                        writer.writerow(
-                            ["Location", "Sequence", "Mismatches", "Context"]
-                        )
-                        writer.writerow(
-                            [
-                                self.calculateLocation(guide),
-                                self.formatSequence(
-                                    guide["guide_seq"], guide["pam_seq"]
-                                ),
-                                "0",
-                                "guide",
-                            ]
-                        )
-                    writer.writerow([str(len(self.guideDict.keys())) + " GUIDES FOUND"])
-                    writer.writerow([str(num_skipped) + " SKIPPED"])
-                    writer.writerow([str(num_exceeded) + " EXCEEDED MAX OFF TARGETS"])
-                    writer.writerow(
-                        [str(total_offtargets_processed) + " OFF TARGETS FOUND"]
-                    )
+                    self.writeCsvGuides(writer, self.guideDict, totals)
+                    self.writeCsvTotals(writer, totals)
                     """
                     # UNCOMMENT TO GET ALL THE OFF TARGETS
                     for offtarget in guide['offtargets']:
@@ -630,97 +502,63 @@ class GuideSearchAndScore:
                         writer.writerow(row)
                     """
         else:
-            for guideID, guide in self.guideDict.items():
-                csv_path = os.path.join(
-                    tempfile.gettempdir(), self.batchID + "_" + guideID + ".csv"
+            try:
+                # the index of the export is kept in the batch's file
+                self.exportIndex = batch_results.writeExport(
+                    self.batchID, self.exportHeading(), self.exportRows()
                 )
-                try:
-                    with open(csv_path, mode="w") as csv_file:
-                        writer = csv.writer(csv_file, delimiter=",")
-                        # build and write heading row
-                        column_headings = [
-                            "chromosome",
-                            "location",
-                            "strand",
-                            "protospacer sequence",
-                            "PAM",
-                            "mismatches",
-                            "context",
-                        ]
-                        if "MIT" in self.scores and not (
-                            guide["max_exceeded"] or guide["skip"]
-                        ):
-                            column_headings.append("MIT")
-                        if "CFD" in self.scores and not (
-                            guide["max_exceeded"] or guide["skip"]
-                        ):
-                            column_headings.append("CFD")
-                        writer.writerow(
-                            ["Location", "Sequence", "Mismatches", "Context"]
-                        )
-                        column_headings.append("no mismatches in seed")
-                        writer.writerow(column_headings)
-
-                        # build and write guide row
-                        guide_row = [guide["pam_chrom"]]
-                        guide_row.append(self.calculateLocation(guide).split(":")[1])
-                        guide_row.append(guide["strand"])
-                        guide_row.append(guide["guide_seq"])
-                        guide_row.append(guide["pam_seq"])
-                        guide_row.append("0")  # num mismatches
-                        guide_row.append("guide")  # context
-                        if "MIT" in self.scores and not (
-                            guide["max_exceeded"] or guide["skip"]
-                        ):
-                            guide_row.append(guide["MIT"])
-                        if "CFD" in self.scores and not (
-                            guide["max_exceeded"] or guide["skip"]
-                        ):
-                            guide_row.append(guide["CFD"])
-                        guide_row.append("")
-                        writer.writerow(guide_row)
-
-                        # initialize variables for determining whether offtarget has mismatch in seed
-                        seedDirection = self.rgenRecord["SeedRegion"][0]
-                        seedLength = int(self.rgenRecord["SeedRegion"][1:])
-                        # build and write row for each of the potential off target sites
-                        for offtarget in guide["offtargets"]:
-                            offtarget_row = offtarget["loc"].split(":")
-                            offtarget_row.append(offtarget["seq"])
-                            offtarget_row.append(offtarget["pam"])
-                            offtarget_row.append(
-                                str(
-                                    sum(
-                                        1 for base in offtarget["seq"] if base.islower()
-                                    )
-                                )
-                            )  # num mismatches
-                            try:
-                                offtarget_row.append(offtarget["context"])
-                            except Exception:
-                                offtarget_row.append("-")
-                            if "MIT" in self.scores and not (
-                                guide["max_exceeded"] or guide["skip"]
-                            ):
-                                offtarget_row.append(offtarget["MIT"])
-                            if "CFD" in self.scores and not (
-                                guide["max_exceeded"] or guide["skip"]
-                            ):
-                                offtarget_row.append(offtarget["CFD"])
-                            if self.hasMismatchInSeed(
-                                offtarget["seq"],
-                                seedDirection,
-                                seedLength,
-                                len(guide["guide_seq"]),
-                            ):
-                                offtarget_row.append("")
-                            else:
-                                offtarget_row.append("*")
-                            writer.writerow(offtarget_row)
-                except Exception as e:
-                    print(guideID)
-                    print(guide)
-                    self.sendError("Error writing off target CSV file, " + str(e))
+            except Exception as e:
+                self.sendError("Error writing off target export, " + str(e))
+
+    def exportHeading(self):
+        """returns the column headings of the off-target export"""
+        column_headings = [
+            "chromosome",
+            "location",
+            "strand",
+            "protospacer sequence",
+            "PAM",
+            "mismatches",
+            "context",
+        ]
+        for score in ["MIT", "CFD"]:
+            if score in self.scores:
+                column_headings.append(score)
+        column_headings.append("no mismatches in seed")
+        return column_headings
+
+    def exportRows(self):
+        """for each guide, yields the row of the guide followed by those of its off-targets"""
+        for guideID, guide in self.guideDict.items():
+            # scores aren't calculated for these
+            scored = not (guide["max_exceeded"] or guide["skip"])
+
+            # build guide row
+            guide_row = [guide["pam_chrom"]]
+            guide_row.append(self.calculateLocation(guide).split(":")[1])
+            guide_row.append(guide["strand"])
+            guide_row.append(guide["guide_seq"])
+            guide_row.append(guide["pam_seq"])
+            guide_row.append("0")  # num mismatches
+            guide_row.append("guide")  # context
+            for score in ["MIT", "CFD"]:
+                if score in self.scores:
+                    guide_row.append(guide[score] if scored else "")
+            guide_row.append("")
+            yield guideID, guide_row
+
+            # build row for each of the potential off target sites, their mismatches were counted in the search
+            for offtarget in guide["offtargets"]:
+                offtarget_row = offtarget["loc"].split(":")
+                offtarget_row.append(offtarget["seq"])
+                offtarget_row.append(offtarget["pam"])
+                offtarget_row.append(str(offtarget["mismatches"]))
+                offtarget_row.append(offtarget.get("context", "-"))
+                for score in ["MIT", "CFD"]:
+                    if score in self.scores:
+                        offtarget_row.append(offtarget.get(score, "") if scored else "")
+                offtarget_row.append("*" if offtarget["none_in_seed"] else "")
+                yield guideID, offtarget_row
 
     def getENSID(self):
         """given the gene symbol, return the ENSEMBL ID from the stored gene collection"""
@@ -738,119 +576,296 @@ class GuideSearchAndScore:
         else:
             return geneCollection.find_one(geneQuery)["ENSID"]
 
-    def writeJsonFile(self):
-        """for each run, write a json file of the relevant guide info for adding guides to the database"""
-        # reformat the dictionary
-        import copy
-
-        databaseDict = copy.deepcopy(self.guideDict)
-        for guideID, guide in databaseDict.items():
-            guide["guideLocation"] = self.calculateLocation(guide)
-        # add a metadata key
-        databaseDict["metadata"] = {
+    def writeBatchFile(self):
+        """for each run, write the batch's file of the relevant guide info for adding guides to the database"""
+        metadata = {
             "genome": self.genome,
             "gene": self.gene,
             "ENSID": self.getENSID(),
             "rgenID": self.rgenID,
             "inputSearchCoordinates": self.searchInput,
         }
-        with open(
-            os.path.join(tempfile.gettempdir(), self.batchID + ".json"), "w"
-        ) as json_file:
-            json.dump(databaseDict, json_file)
-
-    def performGuideSearch(self):
-        """runs the backend modules"""
-        # TODO: look into a collision-free hashing function so don't have to re-run entire pipeline if inputs don't change
-        batchID = binascii.b2a_hex(os.urandom(9)).decode("utf-8")
+        # each guide is written with its location, without copying the guide dict
+        batch_results.writeBatch(
+            self.batchID,
+            metadata,
+            (
+                (guideID, dict(guide, guideLocation=self.calculateLocation(guide)))
+                for guideID, guide in self.guideDict.items()
+            ),
+            self.exportIndex,
+        )
 
-        genome_fa = os.path.join(
+    def genomeFile(self, extension):
+        """returns the path of the genome's processed file with the given extension (e.g. .fa or .2bit)"""
+        return os.path.join(
             self.dbConnection.ROOT_PATH,
             "jbrowse",
             "data",
             self.genome,
             "processed",
-            self.genome + ".fa",
+            self.genome + extension,
         )
-        genome_2bit = os.path.join(
-            self.dbConnection.ROOT_PATH,
-            "jbrowse",
-            "data",
-            self.genome,
-            "processed",
-            self.genome + ".2bit",
+
+    def searchedGuideLength(self):
+        """returns the protospacer length searched for, the rgen's default if none was chosen"""
+        protospacer_length = getattr(
+            self, "guideLength", 0
+        )  # passing 0 indicates default should be used
+        return int(protospacer_length) or int(
+            self.rgenRecord.get("DefaultGuideLength", self.rgenRecord["MinGuideLength"])
+        )
+
+    def findGuides(self, chrom, start, sequence):
+        """
+        given the sequence of a region, returns its guides and whether they were served from the
+        precomputed guide table (and so have already been searched and scored)
+        """
+        # regions within the exons precomputed by PrecomputeGuides.py are served from its table
+        precomputedParameters = precomputed_guides.indexParameters(
+            self.rgenID,
+            self.searchedGuideLength(),
+            self.maxOffTargets,
+            self.genomeFile(".fa"),
+        )
+        guideDict = precomputed_guides.lookupRegion(
+            self.dbConnection,
+            precomputedParameters,
+            chrom,
+            start,
+            start + len(sequence) - 1,
         )
+        if guideDict is not None:
+            return guideDict, True
+
+        guideDict = find_grna.find_grna_in_sequence(
+            self.rgenID, self.searchedGuideLength(), chrom, start, sequence
+        )
+        return guideDict, False
+
+    def searchGuides(self, guideDict, batchID, precomputed=False):
+        """finds, scores, and categorizes the off-targets of the guides"""
+        genome_fa = self.genomeFile(".fa")
+        genome_2bit = self.genomeFile(".2bit")
         twoBitToFa_path = os.path.join(self.dbConnection.ROOT_PATH, "bin/twoBitToFa")
         tempfiles_path = tempfile.gettempdir()
 
         time_0 = time.time()
-        logging.debug("\t\t[STARTED]\t\tFetching sequence...")
+        logging.debug("\t\t[STARTED]\t\tLooking up guides in the off-target cache...")
 
-        get_sequence.fetch_sequence(
-            self.searchInput,
-            genome_2bit,
-            os.path.join(tempfiles_path, batchID + "_out.fa"),
-        )
+        if precomputed:
+            # the precomputed guides were already searched and scored
+            uncachedGuides = {}
+        else:
+            # only the guides that haven't been searched with the same inputs before are aligned and scored
+            build = offtarget_cache.genomeBuild(genome_fa)
+            guideKeys = {
+                guideID: offtarget_cache.guideKey(
+                    guide, self.genome, build, self.rgenID, self.maxOffTargets
+                )
+                for guideID, guide in guideDict.items()
+            }
+            uncachedGuides = offtarget_cache.fetchCachedGuides(
+                self.dbConnection.offTargetCache, guideDict, guideKeys
+            )
 
         time_1 = time.time()
         logging.debug(
-            f"\t\t[FINISHED]\tFetched sequence in {str(round(time_1-time_0,4))}s"
-        )
-        logging.debug("\t\t[STARTED]\t\tDetermining guides in search region...")
-
-        protospacer_length = getattr(
-            self, "guideLength", 0
-        )  # passing 0 indicates default should be used
-        guideDict = find_grna.find_grna(
-            self.rgenID,
-            protospacer_length,
-            os.path.join(tempfiles_path, batchID + "_out.fa"),
+            f"\t\t[FINISHED]\tFound {len(guideDict)-len(uncachedGuides)} of {len(guideDict)} guides in the cache in {str(round(time_1-time_0,4))}s"
         )
-
-        time_2 = time.time()
-        logging.debug(f"\t\t[FINISHED]\tFound gRNAs in {str(round(time_2-time_1,4))}s")
         logging.debug("\t\t[STARTED]\t\tSearching for potential off target sites...")
 
-        guideDict = find_offtargets.findOffTargets(
-            guideDict,
-            self.rgenID,
-            self.genome,
-            self.maxOffTargets,
-            batchID,
-            genome_fa,
-            tempfiles_path,
-        )
+        if uncachedGuides:
+            uncachedGuides = find_offtargets.findOffTargets(
+                uncachedGuides,
+                self.rgenID,
+                self.genome,
+                self.maxOffTargets,
+                batchID,
+                genome_fa,
+                tempfiles_path,
+            )
 
-        time_3 = time.time()
+        time_2 = time.time()
         logging.debug(
-            f"\t\t[FINISHED]\tFound offtargets in {str(round(time_3-time_2,4))}s"
+            f"\t\t[FINISHED]\tFound offtargets in {str(round(time_2-time_1,4))}s"
         )
         logging.debug(
             "\t\t[STARTED]\t\tScoring potential off target sites and guides..."
         )
 
-        guideDict = score_offtargets.scoreOffTargets(
-            guideDict,
-            self.rgenID,
-            genome_fa,
-            twoBitToFa_path,
-            genome_2bit,
-            tempfiles_path,
-        )
+        if uncachedGuides:
+            uncachedGuides = score_offtargets.scoreOffTargets(
+                uncachedGuides,
+                self.rgenID,
+                genome_fa,
+                twoBitToFa_path,
+                genome_2bit,
+                tempfiles_path,
+            )
+            offtarget_cache.storeGuides(
+                self.dbConnection.offTargetCache, uncachedGuides, guideKeys
+            )
 
-        time_4 = time.time()
-        logging.debug(f"\t\t[FINISHED]\tScored in {str(round(time_4-time_3,4))}s")
+        time_3 = time.time()
+        logging.debug(f"\t\t[FINISHED]\tScored in {str(round(time_3-time_2,4))}s")
         logging.debug("\t\t[STARTED]\t\tCategorizing potential off target sites...")
 
         guideDict = categorize_offtargets.categorizeOffTargets(
             guideDict, self.rgenID, self.genome, batchID
         )
 
-        time_5 = time.time()
-        logging.debug(f"\t\t[FINISHED]\tCategorized in {str(round(time_5-time_4,4))}s")
+        time_4 = time.time()
+        logging.debug(f"\t\t[FINISHED]\tCategorized in {str(round(time_4-time_3,4))}s")
+
+        return guideDict
+
+    def performGuideSearch(self, batchID=None):
+        """runs the backend modules"""
+        if batchID is None:
+            batchID = binascii.b2a_hex(os.urandom(9)).decode("utf-8")
+
+        time_0 = time.time()
+        logging.debug("\t\t[STARTED]\t\tFetching sequence...")
+
+        try:
+            chrom, start, sequence = get_sequence.read_sequence(
+                self.searchInput, self.genomeFile(".2bit")
+            )
+        except (KeyError, ValueError) as e:
+            self.sendError(
+                "Unable to fetch the sequence of the search region, " + str(e)
+            )
+        if not sequence:
+            self.sendError("The sequence of the search region is empty")
+
+        time_1 = time.time()
+        logging.debug(
+            f"\t\t[FINISHED]\tFetched sequence in {str(round(time_1-time_0,4))}s"
+        )
+        logging.debug("\t\t[STARTED]\t\tDetermining guides in search region...")
+
+        guideDict, precomputed = self.findGuides(chrom, start, sequence)
+
+        time_2 = time.time()
+        logging.debug(
+            f"\t\t[FINISHED]\tFound {'precomputed ' if precomputed else ''}gRNAs in {str(round(time_2-time_1,4))}s"
+        )
+
+        guideDict = self.searchGuides(guideDict, batchID, precomputed)
 
         return guideDict, batchID
 
+    def performChunkedSearch(self):
+        """
+        searches a region of any size in overlapping windows, aligning and scoring its guides in batches
+        and appending the results of each batch to the output csv as it completes, so only one batch of
+        guides is held in memory at a time. Returns the batch ID and the totals of the search
+        """
+        batchID = binascii.b2a_hex(os.urandom(9)).decode("utf-8")
+        genome_2bit = self.genomeFile(".2bit")
+        chrom, coordinates = self.searchInput.rsplit(":", 1)
+        regionStart, regionEnd = sorted(map(int, coordinates.split("-")))
+        # the windows overlap by one base less than a guide and its PAM so each site is in exactly one window
+        siteLength = len(self.rgenRecord["PAM"]) + self.searchedGuideLength()
+        step = max(CHUNK_WINDOW - siteLength + 1, 1)
+
+        totals = {"guides": 0, "skipped": 0, "exceeded": 0, "offtargets": 0}
+        pendingGuides = {}
+        precomputedIDs = set()
+        with open(self.output_file, mode="w") as csv_file:
+            for windowStart in range(regionStart, regionEnd + 1, step):
+                windowEnd = min(windowStart + CHUNK_WINDOW - 1, regionEnd)
+                time_0 = time.time()
+                logging.debug(
+                    f"\t\t[STARTED]\t\tSearching window {chrom}:{windowStart}-{windowEnd}..."
+                )
+
+                try:
+                    chrom, start, sequence = get_sequence.read_sequence(
+                        f"{chrom}:{windowStart}-{windowEnd}", genome_2bit
+                    )
+                except (KeyError, ValueError) as e:
+                    self.sendError(
+                        "Unable to fetch the sequence of the search region, " + str(e)
+                    )
+                guideDict, precomputed = self.findGuides(chrom, start, sequence)
+                # key the guides by their position in the whole region, as a single search of it would
+                for guide in guideDict.values():
+                    guideID = (
+                        str(int(guide["pam_genomic_start"]) - regionStart)
+                        + guide["strand"]
+                    )
+                    pendingGuides[guideID] = guide
+                    if precomputed:
+                        precomputedIDs.add(guideID)
+
+                if windowEnd == regionEnd:
+                    self.searchChunk(
+                        pendingGuides, precomputedIDs, batchID, csv_file, totals
+                    )
+                elif len(pendingGuides) >= CHUNK_GUIDES:
+                    # the guides of the next window can come before the pending guides in the overlap,
+                    # hold those back so the guides are written in the order a single search finds them
+                    nextStart = windowStart + step
+                    readyGuides = {
+                        guideID: guide
+                        for guideID, guide in pendingGuides.items()
+                        if precomputed_guides.pamExtent(guide)[0] < nextStart
+                    }
+                    pendingGuides = {
+                        guideID: guide
+                        for guideID, guide in pendingGuides.items()
+                        if guideID not in readyGuides
+                    }
+                    self.searchChunk(
+                        readyGuides, precomputedIDs, batchID, csv_file, totals
+                    )
+                    precomputedIDs.difference_update(readyGuides)
+
+                time_1 = time.time()
+                logging.debug(
+                    f"\t\t[FINISHED]\tSearched window, {totals['guides']} guides written in {str(round(time_1-time_0,4))}s"
+                )
+                if windowEnd == regionEnd:
+                    break
+
+            if totals["guides"] > 0:
+                self.writeCsvTotals(csv.writer(csv_file, delimiter=","), totals)
+
+        return batchID, totals
+
+    def searchChunk(self, guideDict, precomputedIDs, batchID, csv_file, totals):
+        """searches a batch of the guides of a chunked search and appends their results to the csv"""
+        if not guideDict:
+            return
+        liveGuides = {
+            guideID: guide
+            for guideID, guide in guideDict.items()
+            if guideID not in precomputedIDs
+        }
+        precomputedGuides = {
+            guideID: guide
+            for guideID, guide in guideDict.items()
+            if guideID in precomputedIDs
+        }
+        if liveGuides:
+            self.searchGuides(liveGuides, batchID)
+        if precomputedGuides:
+            self.searchGuides(precomputedGuides, batchID, precomputed=True)
+
+        # the PAM sites are written in order of position, the '+' strand first at each position
+        sortedIDs = sorted(
+            guideDict.keys(),
+            key=lambda x: (
+                precomputed_guides.pamExtent(guideDict[x])[0],
+                guideDict[x]["strand"] == "-",
+            ),
+        )
+        sortedGuides = OrderedDict((x, guideDict[x]) for x in sortedIDs)
+        self.writeCsvGuides(csv.writer(csv_file, delimiter=","), sortedGuides, totals)
+        csv_file.flush()
+
     def isValidInput(self, inputSeq):
         # TODO: code this. some validation done on front end but not for the chr number/letter
         if len(inputSeq) == 0:
@@ -859,7 +874,7 @@ class GuideSearchAndScore:
         if inputSeq.count(":") == 1 and inputSeq.count("-") == 1:
             # chrm = inputSeq.split(":")[0]
             start, end = list(map(int, (inputSeq.split(":")[1]).split("-")))
-            if abs(start - end) > 3000:
+            if abs(start - end) > CHUNK_WINDOW and not self.chunked:
                 self.sendError(
                     "Please enter an input sequence with fewer than 3000 bases"
                 )
@@ -880,12 +895,33 @@ def countLower(string):
     return count
 
 
+def sendJobResponse(action, batchID):
+    """prints the status of a queued search as json, or its resulting html once it's finished"""
+    try:
+        status = search_jobs.readStatus(batchID)
+    except ValueError:
+        status = None
+    if action == "status":
+        print("Content-type: application/json\n")
+        print(json.dumps(status if status else {"state": "unknown"}))
+    else:
+        print("Content-type: text/html\n")
+        result = search_jobs.readResult(batchID) if status else None
+        if result is None:
+            print("Error: the results of this search are not available")
+        else:
+            print(result)
+
+
 def main():
     # check if running from web or command-line
     if "REQUEST_METHOD" in os.environ:
         # running from web
-        print("Content-type: text/html\n")
         inputForm = cgi.FieldStorage()
+        action = inputForm.getvalue("action")
+        if action in ["status", "result"]:
+            sendJobResponse(action, inputForm.getvalue("batchID"))
+            return
         parameters = {}
         parameters["command-line"] = False
 
@@ -907,6 +943,22 @@ def main():
             parameters["maxOffTargets"] if parameters["setMax"] == "true" else None
         )
 
+        if action == "submit":
+            # queue the search for the workers and return its id for the page to poll, unless
+            # no workers are running, in which case the page falls back to waiting on the search
+            print("Content-type: application/json\n")
+            batchID = None
+            if search_jobs.workersRunning():
+                batchID = binascii.b2a_hex(os.urandom(9)).decode("utf-8")
+                search_jobs.submitJob(batchID, parameters)
+                logging.debug(
+                    f"[WEB]\t\tQueued guide search {batchID} with parameters:"
+                )
+                logging.debug(f"\t\t{parameters}")
+            print(json.dumps({"batchID": batchID}))
+            return
+
+        print("Content-type: text/html\n")
         logging.debug("[WEB]\t\tRunning guide search and score with parameters:")
         logging.debug(f"\t\t{parameters}")
 
@@ -952,6 +1004,11 @@ def main():
             type=int,
             help="Maximum number of off-targets to consider for any guide. Use -1 for no max",
         )
+        optional.add_argument(
+            "--chunked",
+            action="store_true",
+            help="Search the region in windows, writing the results of each batch of guides as it completes. Allows regions over 3000 bases",
+        )
         args = parser.parse_args()
 
         parameters = {
@@ -965,6 +1022,7 @@ def main():
             if args.maxOffTargets == -1
             else args.maxOffTargets,  # convert -1 to False for CLI
             "command-line": True,
+            "chunked": args.chunked,
         }
 
         logging.debug("[CLI]\t\tRunning guide search and score with parameters:")
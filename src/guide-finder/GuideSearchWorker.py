@@ -0,0 +1,125 @@
+#!/usr/bin/env python3.7
+
+"""
+Pool of background workers for the guide searches submitted through GuideSearchAndScore.py
+
+Each worker process claims the oldest queued search (search_jobs.py), runs it exactly as the
+web request would have, and writes the HTML it produces as the job's result. The progress of
+the search is recorded from the stage timings it logs. Since the workers are long-lived, the
+genome readers and segment indexes loaded by one search are reused by the next. Each worker
+marks itself as running from its own thread, so it isn't considered stopped during a long search.
+
+Usage: GuideSearchWorker.py [number of workers]
+    defaults to SEARCH_WORKERS in paths.conf
+"""
+
+import io
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+from multiprocessing import Process
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(dir_path, "../helpers"))
+import AppServer
+from Config import Config
+
+sys.path.append(os.path.join(dir_path, "core"))
+import batch_results
+import score_offtargets
+import search_jobs
+from GuideSearchAndScore import GuideSearchAndScore
+
+# how often (in seconds) an idle worker checks the queue
+POLL_INTERVAL = 0.5
+# how often (in seconds) a worker marks itself as running
+HEARTBEAT_INTERVAL = search_jobs.WORKER_TIMEOUT / 3
+
+
+def runJob(batchID, parameters):
+    """runs a queued search, recording its stages and writing the html it prints as the job's result"""
+    status = search_jobs.readStatus(batchID) or {"submitted": time.time()}
+    status.update(
+        {
+            "state": "running",
+            "started": time.time(),
+            "worker": os.getpid(),
+            "stages": [],
+        }
+    )
+    search_jobs.writeStatus(batchID, status)
+    stageHandler = search_jobs.StageLogHandler(batchID, status)
+    logging.getLogger().addHandler(stageHandler)
+    # the workers outlive the day they were started, so the log file is opened per search
+    logHandler = AppServer.datedLogHandler()
+    logging.getLogger().addHandler(logHandler)
+
+    html = io.StringIO()
+    try:
+        with redirect_stdout(html):
+            GuideSearchAndScore(**dict(parameters, batchID=batchID))
+        status["state"] = "done"
+    except SystemExit:
+        # sendError prints the error page then exits
+        status["state"] = "done"
+    except Exception as e:
+        logging.exception(f"Guide search {batchID} failed")
+        status["state"] = "failed"
+        html.write(f"Error: {e}")
+    finally:
+        logging.getLogger().removeHandler(stageHandler)
+        logging.getLogger().removeHandler(logHandler)
+        logHandler.close()
+
+    search_jobs.finishJob(batchID, status, html.getvalue())
+
+
+def heartbeat(workerID):
+    """marks the worker as running every HEARTBEAT_INTERVAL seconds, runs in its own thread"""
+    while True:
+        try:
+            search_jobs.markWorker(workerID)
+        except OSError:
+            logging.exception(f"Unable to mark guide search worker {workerID}")
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def work(workerID):
+    """claims and runs queued searches until stopped"""
+    threading.Thread(target=heartbeat, args=(workerID,), daemon=True).start()
+    while True:
+        job = search_jobs.claimJob()
+        if job:
+            runJob(*job)
+        else:
+            time.sleep(POLL_INTERVAL)
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else Config().SEARCH_WORKERS
+    search_jobs.makeDirectory(search_jobs.JOB_DIRECTORY)
+    # replaced by the handler of each search's day
+    AppServer.removeDatedLogHandlers()
+    # the workers share the model loaded before they're started
+    score_offtargets.inDelphiModel()
+
+    pool = [Process(target=work, args=(i,), daemon=True) for i in range(workers)]
+    for worker in pool:
+        worker.start()
+    while True:
+        # any worker that died is replaced, then the jobs it was running are marked failed, and
+        # finished jobs and the files of expired searches are cleaned up
+        for i, worker in enumerate(pool):
+            if not worker.is_alive():
+                pool[i] = Process(target=work, args=(i,), daemon=True)
+                pool[i].start()
+        search_jobs.removeExpiredJobs()
+        batch_results.removeExpiredBatches()
+        time.sleep(60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3.7
+
+"""
+Offline precomputation of the guides in every exon of a genome
+
+For each RGEN, searches the exons (plus a flank on either side) of the genome's current annotation
+the same way GuideSearchAndScore.py searches a region and stores the results in the genome's
+precomputed guide table, which GuideSearchAndScore.py then serves covered regions from:
+1) Merges the flanked exons of the segments file into search regions
+2) Finds the gRNAs within each region (find_grna.py)
+3) Looks the guides up in the off-target cache and aligns the rest in batches (find_offtargets.py)
+4) Scores the uncached guides in parallel processes (score_offtargets.py)
+5) Stores the guides and then the regions in the table (precomputed_guides.py)
+
+Regions already in the table are skipped, so an interrupted run can be restarted.
+"""
+
+import argparse
+import binascii
+import logging
+import os
+import sys
+import tempfile
+import time
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(dir_path, "../helpers"))
+from Config import Config
+
+sys.path.append(os.path.join(dir_path, "core"))
+import find_grna
+import find_offtargets
+import get_sequence
+import offtarget_cache
+import precomputed_guides
+from BatchGuideSearch import scoreInParallel
+
+
+def readExons(segmentsFile):
+    """given the segments.bed file of a genome, returns a dict of the (0-based) exons on each chromosome"""
+    exons = {}
+    with open(segmentsFile, "r") as bed:
+        for line in bed:
+            chrom, start, end, label = line.rstrip("\n").split("\t")[0:4]
+            if label == "exonic":
+                exons.setdefault(chrom, []).append((int(start), int(end)))
+
+    return exons
+
+
+def searchRegions(exons, chromSizes, flank):
+    """
+    given the exons on each chromosome, returns a list of the (chrom, start, end) regions to search (1-based, inclusive).
+    Each exon is extended by the flank and overlapping or adjacent exons are merged into one region
+    """
+    regions = []
+    for chrom in sorted(exons):
+        if chrom not in chromSizes:
+            continue
+        merged = []
+        for start, end in sorted(exons[chrom]):
+            start, end = max(start - flank + 1, 1), min(end + flank, chromSizes[chrom])
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        regions.extend((chrom, start, end) for start, end in merged)
+
+    return regions
+
+
+def precomputeBatch(args, dbConnection, paths, rgenID, parameters, regions):
+    """searches and scores the guides of a batch of regions, then stores them in the precomputed guide table"""
+    genome_fa, genome_2bit, twoBitToFa_path = paths
+    batchID = binascii.b2a_hex(os.urandom(9)).decode("utf-8")
+
+    guideDict = {}
+    for chrom, start, end in regions:
+        sequence = get_sequence.open_genome(genome_2bit).fetch(chrom, start - 1, end)
+        found = find_grna.find_grna_in_sequence(
+            rgenID, parameters["guideLength"], chrom, start, sequence
+        )
+        # the merged regions don't overlap so each guide is only found once
+        for guide in found.values():
+            guideDict[str(len(guideDict))] = guide
+
+    cacheKeys = {
+        guideID: offtarget_cache.guideKey(
+            guide, args.genome, parameters["build"], rgenID, args.maxOffTargets
+        )
+        for guideID, guide in guideDict.items()
+    }
+    uncachedGuides = offtarget_cache.fetchCachedGuides(
+        dbConnection.offTargetCache, guideDict, cacheKeys
+    )
+    if uncachedGuides:
+        uncachedGuides = find_offtargets.findOffTargets(
+            uncachedGuides,
+            rgenID,
+            args.genome,
+            args.maxOffTargets,
+            batchID,
+            genome_fa,
+            tempfile.gettempdir(),
+        )
+        scoreInParallel(
+            uncachedGuides,
+            rgenID,
+            genome_fa,
+            twoBitToFa_path,
+            genome_2bit,
+            args.processes,
+        )
+        offtarget_cache.storeGuides(
+            dbConnection.offTargetCache, uncachedGuides, cacheKeys
+        )
+
+    precomputed_guides.storeRegions(
+        dbConnection, parameters, regions, guideDict.values()
+    )
+
+    return len(guideDict)
+
+
+def precomputeGuides(args):
+    """precomputes the guides of every exon for each of the RGENs"""
+    dbConnection = Config(args.genome)
+    processed_path = os.path.join(
+        dbConnection.ROOT_PATH, "jbrowse", "data", args.genome, "processed"
+    )
+    genome_fa = os.path.join(processed_path, args.genome + ".fa")
+    genome_2bit = os.path.join(processed_path, args.genome + ".2bit")
+    twoBitToFa_path = os.path.join(dbConnection.ROOT_PATH, "bin/twoBitToFa")
+    paths = (genome_fa, genome_2bit, twoBitToFa_path)
+
+    exons = readExons(os.path.join(processed_path, args.genome + ".segments.bed"))
+    regions = searchRegions(
+        exons, get_sequence.open_genome(genome_2bit).chrom_sizes(), args.flank
+    )
+    print(
+        f"Precomputing guides in {len(regions)} regions of {args.genome} release {dbConnection.release}"
+    )
+
+    if args.rgenID:
+        rgenIDs = args.rgenID
+    else:
+        rgenIDs = [
+            rgen["rgenID"]
+            for rgen in dbConnection.rgenCollection.find({}, {"rgenID": 1})
+        ]
+
+    precomputed_guides.createIndexes(dbConnection)
+    for rgenID in rgenIDs:
+        time_0 = time.time()
+        logging.debug(f"[STARTED]\t\tPrecomputing guides for RGEN {rgenID}...")
+
+        # the table is keyed on the length actually searched, not the 0 placeholder for the default
+        pam, defaultLength, pamLocation = find_grna.get_rgen_info(rgenID)
+        guideLength = args.spacer if args.spacer else int(defaultLength)
+        parameters = precomputed_guides.indexParameters(
+            rgenID, guideLength, args.maxOffTargets, genome_fa
+        )
+        precomputed_guides.clearStale(dbConnection, parameters)
+        covered = precomputed_guides.coveredRegions(dbConnection, parameters)
+        remaining = [region for region in regions if region not in covered]
+
+        # regions are searched in batches of roughly batchSize bases
+        guideCount = 0
+        batch = []
+        batchBases = 0
+        for i, region in enumerate(remaining):
+            batch.append(region)
+            batchBases += region[2] - region[1] + 1
+            if batchBases >= args.batchSize or i == len(remaining) - 1:
+                guideCount += precomputeBatch(
+                    args, dbConnection, paths, rgenID, parameters, batch
+                )
+                print(
+                    f"RGEN {rgenID}: searched {i + 1} of {len(remaining)} regions, {guideCount} guides"
+                )
+                batch = []
+                batchBases = 0
+
+        time_1 = time.time()
+        logging.debug(
+            f"[FINISHED]\t\tPrecomputed {guideCount} guides in {len(remaining)} regions for RGEN {rgenID} in {str(round(time_1-time_0,4))}s"
+        )
+
+
+def main():
+    desc = """ Precomputes the guides in every exon (plus a flank) of the genome for each RGEN and
+    stores them in the genome's precomputed guide table. Searches with the same RGEN, protospacer
+    length and max off-targets in a precomputed region are then served from the table.
+    """
+
+    parser = argparse.ArgumentParser(prog="PrecomputeGuides", description=desc)
+    parser._action_groups.pop()
+    required = parser.add_argument_group("required arguments")
+    optional = parser.add_argument_group("optional arguments")
+    required.add_argument("--genome", help="Genome database (e.g. mm10)", required=True)
+    # optional flags:
+    optional.add_argument(
+        "--rgenID",
+        nargs="*",
+        help="ids of the RGENs to precompute (default: every RGEN)",
+    )
+    # default guide length (protospacer) to the RGEN's default
+    optional.add_argument(
+        "--spacer",
+        nargs="?",
+        default=0,
+        type=int,
+        help="Length of protospacer (default: the RGEN's default length)",
+    )
+    # default max off targets to 1000, the web search's default
+    optional.add_argument(
+        "--maxOffTargets",
+        nargs="?",
+        default=1000,
+        type=int,
+        help="Maximum number of off-targets to consider for any guide. Use -1 for no max",
+    )
+    optional.add_argument(
+        "--flank",
+        nargs="?",
+        default=100,
+        type=int,
+        help="Number of bases on either side of each exon to include (default: 100)",
+    )
+    optional.add_argument(
+        "--batchSize",
+        nargs="?",
+        default=50000,
+        type=int,
+        help="Number of bases of regions to search and align together (default: 50000)",
+    )
+    optional.add_argument(
+        "--processes",
+        nargs="?",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of processes to score the guides with (default: number of cpus)",
+    )
+    args = parser.parse_args()
+    args.maxOffTargets = None if args.maxOffTargets == -1 else args.maxOffTargets
+
+    logging.debug("[CLI]\t\tPrecomputing guides with parameters:")
+    logging.debug(f"\t\t{vars(args)}")
+
+    precomputeGuides(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3.7
+
+"""
+Long-lived bwa alignment worker for the off-target search.
+
+Each bwa aln/samse run has to read the genome's BWT and suffix array, which is the largest cost
+of a guide search when they aren't in the page cache. The worker keeps the index files of every
+genome it has aligned against mapped and periodically touched so they stay in the page cache, and
+runs the alignments submitted by find_offtargets over a unix socket, streaming the samse output
+back. Each alignment is still a separate bwa aln and samse process that loads the index into its
+own memory (bwa shm is only used by bwa mem), the worker saves reading it from disk.
+
+The worker runs as the web server's user and its socket is only accessible to the web server's
+group (SOCKET_GROUP). Only fasta files in the temp directory can be aligned against installed
+genomes, and bwa is run on the worker's own copy of the fasta, read through a single descriptor,
+with the sai written to the worker's own temporary file.
+
+Usage: align_server.py [genome_fa ...]
+    starts the worker, pre-loading the indexes of the genome fasta files given (if any)
+"""
+
+import grp
+import json
+import logging
+import mmap
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+from stat import S_ISREG
+from subprocess import PIPE, Popen, run
+from tempfile import TemporaryFile
+
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), "forcast_bwa.sock")
+# the group allowed to connect to the worker, the cgi scripts run as the web server's user
+SOCKET_GROUP = os.environ.get("FORCAST_SOCKET_GROUP", "www-data")
+# the genomes are installed in ROOT/jbrowse/data/<genome>/processed/<genome>.fa
+ROOT_PATH = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+# the final line the worker sends for each alignment, followed by its json encoded result
+STATUS_PREFIX = "#status\t"
+INDEX_EXTENSIONS = [".bwt", ".sa", ".pac", ".ann", ".amb"]
+# how often (in seconds) the loaded indexes are touched to keep them in the page cache
+REFRESH_INTERVAL = 600
+
+
+def alignFasta(genome_fa, fastaPath, threads=2, saiPath=None):
+    """
+    run bwa aln on a fasta file of guides with the given number of threads, returns the path of
+    the resulting sai file (next to the fasta file unless a path is given)
+    """
+    if saiPath is None:
+        saiPath = os.path.splitext(fastaPath)[0] + ".sai"
+    with open(saiPath, "w") as sai:
+        p = run(
+            [
+                "bwa",
+                "aln",
+                "-n",
+                "4",
+                "-l",
+                "0",
+                "-o",
+                "0",
+                "-t",
+                str(threads),
+                "-N",
+                genome_fa,
+                fastaPath,
+            ],
+            stdout=sai,
+            stderr=PIPE,
+            encoding="utf-8",
+        )
+    if p.returncode != 0:
+        raise Exception(
+            "Error at bwa aln step, check bwa index or input fasta: " + p.stderr
+        )
+
+    return saiPath
+
+
+def samseLines(genome_fa, fastaPath, saiPath):
+    """generator over the lines of bwa samse's output, read straight from its stdout rather than a sam file"""
+    with TemporaryFile(mode="w+") as errors:
+        p = Popen(
+            ["bwa", "samse", "-n", "50000", genome_fa, saiPath, fastaPath],
+            stdout=PIPE,
+            stderr=errors,
+            encoding="utf-8",
+        )
+        try:
+            for line in p.stdout:
+                yield line
+            p.stdout.close()
+            if p.wait() != 0:
+                errors.seek(0)
+                raise Exception("Error at bwa samse step: " + errors.read())
+        finally:
+            # stop bwa if the consumer gave up on the stream early
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+
+
+def connect(socketPath=SOCKET_PATH):
+    """returns a connection to the alignment worker, or None if it isn't running"""
+    if not os.path.exists(socketPath):
+        return None
+    worker = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        worker.connect(socketPath)
+    except OSError:
+        worker.close()
+        return None
+    return worker
+
+
+def submitAlignment(worker, genome_fa, fastaPath, threads=2):
+    """
+    given a connection to the worker, sends it a fasta file of guides to align against the genome
+    and returns a generator over the lines of the samse output it streams back
+    """
+    with worker:
+        worker.sendall(
+            (
+                json.dumps(
+                    {"genome_fa": genome_fa, "fasta": fastaPath, "threads": threads}
+                )
+                + "\n"
+            ).encode("utf-8")
+        )
+        with worker.makefile("r", encoding="utf-8") as stream:
+            for line in stream:
+                if line.startswith(STATUS_PREFIX):
+                    status = json.loads(line[len(STATUS_PREFIX) :])
+                    if status["error"]:
+                        raise Exception(status["error"])
+                    return
+                yield line
+    raise Exception("Alignment worker closed the connection before finishing")
+
+
+class IndexCache:
+    """keeps the bwa index files of each genome mapped in memory and touched so they stay in the page cache"""
+
+    def __init__(self):
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def load(self, genome_fa):
+        """maps the index files of the genome (once) and reads them through the page cache"""
+        with self.lock:
+            if genome_fa in self.indexes:
+                return
+            maps = []
+            for extension in INDEX_EXTENSIONS:
+                indexFile = genome_fa + extension
+                if os.path.exists(indexFile) and os.path.getsize(indexFile) > 0:
+                    with open(indexFile, "rb") as f:
+                        maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            self.indexes[genome_fa] = maps
+        self.touch(maps)
+
+    @staticmethod
+    def touch(maps):
+        """reads a byte of every page of the mapped files"""
+        for m in maps:
+            for offset in range(0, len(m), mmap.PAGESIZE):
+                m[offset]
+
+    def refresh(self):
+        """periodically touch all the loaded indexes, runs in its own thread"""
+        while True:
+            threading.Event().wait(REFRESH_INTERVAL)
+            with self.lock:
+                loaded = list(self.indexes.values())
+            for maps in loaded:
+                self.touch(maps)
+
+
+def installedGenome(genome_fa):
+    """returns the real path of the genome fasta if it's an installed and indexed genome, otherwise None"""
+    genome_fa = os.path.realpath(str(genome_fa))
+    genome = os.path.basename(genome_fa)[: -len(".fa")]
+    expected = os.path.join(
+        os.path.realpath(ROOT_PATH),
+        "jbrowse",
+        "data",
+        genome,
+        "processed",
+        genome + ".fa",
+    )
+    if (
+        not genome
+        or genome_fa != expected
+        or not os.path.isfile(genome_fa)
+        or not os.path.isfile(genome_fa + ".bwt")
+    ):
+        return None
+    return genome_fa
+
+
+def tempFasta(fastaPath):
+    """
+    returns the real path of the fasta file if it's a regular file in the temp directory, otherwise
+    None. Only a check of the path, the worker reads the file through copyFasta
+    """
+    fastaPath = os.path.realpath(str(fastaPath))
+    if os.path.dirname(fastaPath) != os.path.realpath(tempfile.gettempdir()):
+        return None
+    try:
+        stat = os.stat(fastaPath)
+    except OSError:
+        return None
+    # a hard link would let another file be read through the temp directory
+    if not os.path.isfile(fastaPath) or stat.st_nlink != 1:
+        return None
+    return fastaPath
+
+
+def copyFasta(fastaPath, copy):
+    """
+    copies the fasta file in the temp directory to the worker's own (open) temporary file, returns
+    False if it isn't a regular file there. The file is opened once, without following symlinks,
+    and checked through its descriptor, so it can't be swapped after it's checked
+    """
+    if tempFasta(fastaPath) is None:
+        return False
+    try:
+        fd = os.open(fastaPath, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except OSError:
+        return False
+    with os.fdopen(fd, "rb") as fasta:
+        stat = os.fstat(fd)
+        # a hard link would let another file be read through the temp directory
+        if not S_ISREG(stat.st_mode) or stat.st_nlink != 1:
+            return False
+        shutil.copyfileobj(fasta, copy)
+    copy.flush()
+    return True
+
+
+class AlignmentHandler(socketserver.StreamRequestHandler):
+    """aligns the fasta file of a single request and streams the samse output back"""
+
+    wbufsize = 1 << 16
+
+    def handle(self):
+        error = ""
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            genome_fa = installedGenome(request["genome_fa"])
+            if genome_fa is None:
+                raise Exception("Not an installed genome: " + str(request["genome_fa"]))
+            with tempfile.NamedTemporaryFile(
+                suffix=".fa"
+            ) as fasta, tempfile.NamedTemporaryFile(suffix=".sai") as sai:
+                # bwa reads the worker's copy, not the path the client gave
+                if not copyFasta(str(request["fasta"]), fasta):
+                    raise Exception(
+                        "Not a fasta file in the temp directory: "
+                        + str(request["fasta"])
+                    )
+                self.server.indexCache.load(genome_fa)
+                alignFasta(
+                    genome_fa, fasta.name, int(request.get("threads", 2)), sai.name
+                )
+                for line in samseLines(genome_fa, fasta.name, sai.name):
+                    self.wfile.write(line.encode("utf-8"))
+        except BrokenPipeError:
+            # the client stopped reading
+            return
+        except Exception as e:
+            error = str(e) or repr(e)
+        self.wfile.write(
+            (STATUS_PREFIX + json.dumps({"error": error}) + "\n").encode("utf-8")
+        )
+
+
+class AlignmentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, indexCache):
+        self.indexCache = indexCache
+        if os.path.exists(socketPath):
+            # left behind by a worker that wasn't shut down cleanly
+            os.remove(socketPath)
+        # created without any access for others, rather than restricted once it exists
+        umask = os.umask(0o117)
+        try:
+            super().__init__(socketPath, AlignmentHandler)
+        finally:
+            os.umask(umask)
+        try:
+            os.chown(socketPath, -1, grp.getgrnam(SOCKET_GROUP).gr_gid)
+        except KeyError:
+            logging.warning(
+                f"No group {SOCKET_GROUP}, only the worker's own group can connect"
+            )
+        os.chmod(socketPath, 0o660)
+
+
+def main():
+    indexCache = IndexCache()
+    for genome_fa in sys.argv[1:]:
+        indexCache.load(genome_fa)
+    threading.Thread(target=indexCache.refresh, daemon=True).start()
+
+    server = AlignmentServer(SOCKET_PATH, indexCache)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(SOCKET_PATH)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3.7
+
+"""
+Store of the guides found by a web search, read back when guides are added to the database
+(GuideAdd.py) or when their off-targets are shown (GuideOffTargets.py), and the export of their
+off-targets downloaded from the result page (GuideDownload.py)
+
+Each batch is a SQLite file with one row per guide keyed by its guideID, so a guide is read by
+its key without loading the rest of the batch. The guides are serialized one at a time as
+they're written, so the search's guide dict isn't copied. The off-targets of all the guides are
+exported together into a single gzipped tsv with the guideID in its first column. The heading
+and the rows of each guide are compressed as separate gzip members, which concatenated are
+still one gzip file, and the offset and length of each member are kept in the batch's file, so
+a guide's rows are read by seeking to its member rather than decompressing the whole export.
+Both files are written under a temporary name and moved into place, so they're never read half
+written, and are removed after BATCH_TTL.
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from itertools import groupby
+
+import search_jobs
+
+# batch files are removed after this many seconds
+BATCH_TTL = 24 * 60 * 60
+
+# the files written for a batch (including the per-guide csv and json files of earlier versions)
+batchFile = re.compile(r"^[0-9a-f]{18}(\.sqlite|\.tsv\.gz|\.json|_.+\.csv)$")
+# the guideIDs of a search, the position of the guide's PAM and its strand
+guideIDFormat = re.compile(r"^[0-9]+[+-]\Z")
+
+
+def batchPath(batchID):
+    """returns the path of the batch's file, raises ValueError if the batchID isn't valid"""
+    if not search_jobs.batchIDFormat.match(str(batchID)):
+        raise ValueError(f"Invalid batch ID: {batchID}")
+    return os.path.join(tempfile.gettempdir(), str(batchID) + ".sqlite")
+
+
+def exportPath(batchID):
+    """returns the path of the batch's off-target export, raises ValueError if the batchID isn't valid"""
+    if not search_jobs.batchIDFormat.match(str(batchID)):
+        raise ValueError(f"Invalid batch ID: {batchID}")
+    return os.path.join(tempfile.gettempdir(), str(batchID) + ".tsv.gz")
+
+
+def writeBatch(batchID, metadata, guides, exportIndex=None):
+    """
+    given the batchID, the metadata of the search, an iterable of (guideID, guide), and the index
+    of the batch's export returned by writeExport (if any), writes the batch's file
+    """
+    path = batchPath(batchID)
+    tempPath = path + "." + str(os.getpid()) + ".tmp"
+    if os.path.exists(tempPath):
+        os.remove(tempPath)
+
+    connection = sqlite3.connect(tempPath)
+    try:
+        with connection:
+            connection.execute("CREATE TABLE metadata (metadata TEXT)")
+            connection.execute(
+                "CREATE TABLE guides (guideID TEXT PRIMARY KEY, guide TEXT)"
+            )
+            connection.execute(
+                "INSERT INTO metadata VALUES (?)", (json.dumps(metadata),)
+            )
+            connection.executemany(
+                "INSERT INTO guides VALUES (?, ?)",
+                ((guideID, json.dumps(guide)) for guideID, guide in guides),
+            )
+            connection.execute(
+                "CREATE TABLE export (guideID TEXT PRIMARY KEY, offset INTEGER, length INTEGER)"
+            )
+            connection.executemany(
+                "INSERT INTO export VALUES (?, ?, ?)",
+                (
+                    (guideID, offset, length)
+                    for guideID, (offset, length) in (exportIndex or {}).items()
+                ),
+            )
+    finally:
+        connection.close()
+    # the web server reads the batches written by the search workers
+    os.chmod(tempPath, 0o644)
+    os.replace(tempPath, path)
+
+
+def readGuide(batchID, guideID):
+    """
+    returns the metadata of the batch and the guide with the given guideID (or None if the batch
+    doesn't have it), raises FileNotFoundError if there's no such batch and ValueError if the
+    batchID isn't valid
+    """
+    path = batchPath(batchID)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+
+    # read only, so readers don't need to be able to write to the file or its directory
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        (metadata,) = connection.execute("SELECT metadata FROM metadata").fetchone()
+        row = connection.execute(
+            "SELECT guide FROM guides WHERE guideID = ?", (str(guideID),)
+        ).fetchone()
+    finally:
+        connection.close()
+
+    return json.loads(metadata), json.loads(row[0]) if row else None
+
+
+def compressRows(rows):
+    """returns the tsv of the rows as a gzip member"""
+    tsv = io.StringIO()
+    writer = csv.writer(tsv, delimiter="\t", lineterminator="\n")
+    writer.writerows(rows)
+    return gzip.compress(tsv.getvalue().encode("utf-8"), compresslevel=6)
+
+
+def writeExport(batchID, heading, rows):
+    """
+    given the batchID, the column headings and an iterable of (guideID, row) with each guide's rows
+    together, writes the batch's export one guide at a time. Returns the index of the export, the
+    (offset, length) of each guide's member keyed by its guideID, and of the heading's keyed by ""
+    """
+    path = exportPath(batchID)
+    tempPath = path + "." + str(os.getpid()) + ".tmp"
+    exportIndex = {}
+    with open(tempPath, "wb") as export_file:
+
+        def writeMember(memberID, memberRows):
+            member = compressRows(memberRows)
+            exportIndex[memberID] = (export_file.tell(), len(member))
+            export_file.write(member)
+
+        writeMember("", [["guideID"] + heading])
+        for guideID, guideRows in groupby(rows, key=lambda row: row[0]):
+            writeMember(guideID, ([guideID] + row for _, row in guideRows))
+    os.chmod(tempPath, 0o644)
+    os.replace(tempPath, path)
+    return exportIndex
+
+
+def readExport(batchID, guideID=None):
+    """
+    yields the lines of the batch's export, only the heading and the guide's rows if a guideID
+    is given. Raises FileNotFoundError if there's no such batch, ValueError if the batchID isn't
+    valid and KeyError if the export has no rows for the guide
+    """
+    if guideID is None:
+        with gzip.open(exportPath(batchID), "rt", newline="") as export_file:
+            yield from export_file
+        return
+
+    path = batchPath(batchID)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        members = connection.execute(
+            "SELECT offset, length FROM export WHERE guideID IN ('', ?) ORDER BY offset",
+            (str(guideID),),
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # written before the export was indexed
+        raise FileNotFoundError(path)
+    finally:
+        connection.close()
+    # the heading's member is always there, the guide's only if it has off-targets
+    if len(members) < 2:
+        raise KeyError(guideID)
+
+    with open(exportPath(batchID), "rb") as export_file:
+        for offset, length in members:
+            export_file.seek(offset)
+            member = gzip.decompress(export_file.read(length)).decode("utf-8")
+            yield from io.StringIO(member, newline="")
+
+
+def removeExpiredBatches():
+    """removes the batch files written more than BATCH_TTL seconds ago"""
+    directory = tempfile.gettempdir()
+    for filename in os.listdir(directory):
+        if not batchFile.match(filename):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            if time.time() - os.path.getmtime(path) > BATCH_TTL:
+                os.remove(path)
+        except OSError:
+            # removed by another process, or written by another user
+            continue
@@ -9,29 +9,152 @@ Categorizes the off-targets into intergenic, intronic, and exonic using the segm
 
 import os
 import sys
-import tempfile
-from subprocess import PIPE, Popen
+
+import numpy as np
 
 sys.path.append(
     os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../helpers")
 )
 from Config import Config
 
+# segments are binned by length (powers of this) so their overlaps can be found by binary search on the starts
+SEGMENT_BIN_SCALE = 4
+# segment indexes loaded by this process, by path
+_segment_indexes = {}
+
 
-def getRgenRecord(rgenID, dbConnection):
+class SegmentIndex:
     """
-    Based on the rgenID, fetch the rgen record
+    in-process interval index over the segments.bed file of a genome. For each chromosome, the segments
+    are split into bins of similar length, each sorted by start along with the segments' ends and their
+    line number in the file (so overlaps are reported in file order, as bedtools intersect did).
+    The context of each line is stored as a code into a table of the distinct contexts
     """
-    rgenCollection = dbConnection.rgenCollection
-    rgenRecord = rgenCollection.find({"rgenID": str(rgenID)})
-    if rgenRecord.count() == 1:
-        return rgenRecord.next()
-    else:
-        raise Exception(
-            "Invalid number of records returned from RGEN database for rgenID "
-            + str(rgenID)
+
+    def __init__(self, chromosomes, labelCodes, labelTable):
+        # chromosome -> list of (starts, ends, lines, max length) for each length bin
+        self.chromosomes = chromosomes
+        self.labelCodes = labelCodes
+        self.labelTable = labelTable
+
+    @classmethod
+    def fromBed(cls, segmentsFile):
+        """parses a segments.bed file (chrom, start, end, context) into an index"""
+        segments = {}
+        labelCodes = []
+        labelTable = {}
+        with open(segmentsFile, "r") as bed:
+            for line in bed:
+                chm, start, end, label = line.rstrip("\n").split("\t")[0:4]
+                segments.setdefault(chm, ([], [], []))
+                segments[chm][0].append(int(start))
+                segments[chm][1].append(int(end))
+                segments[chm][2].append(len(labelCodes))
+                labelCodes.append(labelTable.setdefault(label, len(labelTable)))
+
+        chromosomes = {}
+        for chm, (starts, ends, lines) in segments.items():
+            chromosomes[chm] = cls.binSegments(
+                np.array(starts, dtype=np.int64),
+                np.array(ends, dtype=np.int64),
+                np.array(lines, dtype=np.int64),
+            )
+        return cls(
+            chromosomes, np.array(labelCodes, dtype=np.int32), list(labelTable.keys())
         )
-        return
+
+    @classmethod
+    def fromNpz(cls, indexFile):
+        """loads an index saved by save (i.e. the segments.npz written at genome setup)"""
+        with np.load(indexFile, allow_pickle=False) as index:
+            chromosomes = {}
+            for c, chm in enumerate(index["chromosomes"].tolist()):
+                chromosomes[chm] = [
+                    (
+                        index[f"c{c}_b{b}_starts"],
+                        index[f"c{c}_b{b}_ends"],
+                        index[f"c{c}_b{b}_lines"],
+                        int(maxLength),
+                    )
+                    for b, maxLength in enumerate(index[f"c{c}_maxLengths"])
+                ]
+            return cls(chromosomes, index["labelCodes"], index["labelTable"].tolist())
+
+    def save(self, indexFile):
+        """saves the index's arrays to an (uncompressed) npz file"""
+        arrays = {
+            "chromosomes": np.array(list(self.chromosomes.keys()), dtype=str),
+            "labelCodes": self.labelCodes,
+            "labelTable": np.array(self.labelTable, dtype=str),
+        }
+        for c, bins in enumerate(self.chromosomes.values()):
+            arrays[f"c{c}_maxLengths"] = np.array(
+                [maxLength for starts, ends, lines, maxLength in bins], dtype=np.int64
+            )
+            for b, (starts, ends, lines, maxLength) in enumerate(bins):
+                arrays[f"c{c}_b{b}_starts"] = starts
+                arrays[f"c{c}_b{b}_ends"] = ends
+                arrays[f"c{c}_b{b}_lines"] = lines
+        with open(indexFile, "wb") as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def binSegments(starts, ends, lines):
+        """splits the segments of a chromosome into length bins, each sorted by start"""
+        lengths = np.maximum(ends - starts, 1)
+        bins = np.floor(np.log(lengths) / np.log(SEGMENT_BIN_SCALE)).astype(np.int64)
+        binned = []
+        for b in np.unique(bins):
+            inBin = np.flatnonzero(bins == b)
+            inBin = inBin[np.argsort(starts[inBin], kind="mergesort")]
+            binned.append(
+                (starts[inBin], ends[inBin], lines[inBin], int(lengths[inBin].max()))
+            )
+        return binned
+
+    def overlapping(self, chm, starts, ends):
+        """
+        given a chromosome and the (half-open) locations on it, returns the labels of the segments
+        overlapping each location, in the order of the segments file
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        hits = [[] for i in range(len(starts))]
+        for binStarts, binEnds, binLines, maxLength in self.chromosomes.get(chm, []):
+            # a segment can only overlap a location if it starts within maxLength before its end
+            first = np.searchsorted(binStarts, starts - maxLength, "right")
+            last = np.searchsorted(binStarts, ends, "left")
+            for i in np.flatnonzero(first < last):
+                candidates = slice(first[i], last[i])
+                hits[i].extend(
+                    binLines[candidates][binEnds[candidates] > starts[i]].tolist()
+                )
+        return [
+            [self.labelTable[code] for code in self.labelCodes[sorted(lines)].tolist()]
+            for lines in hits
+        ]
+
+
+def segmentIndexPath(segmentsFile):
+    """the binary index of a segments.bed file is written alongside it as segments.npz"""
+    return os.path.splitext(segmentsFile)[0] + ".npz"
+
+
+def getSegmentIndex(segmentsFile):
+    """
+    returns the index of the segments file, loading it the first time it's used by this process.
+    The binary index written at setup is used if it's up to date, otherwise the bed file is parsed
+    """
+    if segmentsFile not in _segment_indexes:
+        indexFile = segmentIndexPath(segmentsFile)
+        if os.path.exists(indexFile) and (
+            not os.path.exists(segmentsFile)
+            or os.path.getmtime(indexFile) >= os.path.getmtime(segmentsFile)
+        ):
+            _segment_indexes[segmentsFile] = SegmentIndex.fromNpz(indexFile)
+        else:
+            _segment_indexes[segmentsFile] = SegmentIndex.fromBed(segmentsFile)
+    return _segment_indexes[segmentsFile]
 
 
 def categorizeOffTargets(guideDict, rgenID, genome, batchID):
@@ -43,31 +166,35 @@ def categorizeOffTargets(guideDict, rgenID, genome, batchID):
     # connect to database and get the rgen variables from id
     dbConnection = Config(genome)
     # rgen = getRgenRecord(rgenID, dbConnection)
-    # construct bed intersect command
     segmentsFile = os.path.join(
         dbConnection.ROOT_PATH,
         "jbrowse/data/" + genome,
         "processed",
         genome + ".segments.bed",
     )
-    extendedBed = os.path.join(tempfile.gettempdir(), str(batchID) + "_extended.bed")
-    bedCommand = ["bedtools", "intersect", "-a", extendedBed, "-b", segmentsFile, "-wb"]
-    p = Popen(bedCommand, stdin=PIPE, stdout=PIPE, stderr=PIPE, encoding="utf-8")
-    out, err = p.communicate()
-    if err:
-        sys.exit(err)
-
-    # categorized = []
-    for line in out.splitlines():
-        # assign every intersection to its off-target
-        intersect = line.split("\t")
-        guideID, location = intersect[3].split("_")
-        if guideDict[guideID]["max_exceeded"]:
+    segmentIndex = getSegmentIndex(segmentsFile)
+
+    # group the off-targets by chromosome so each is looked up in the index together
+    offTargetsByChrom = {}
+    for guideID, guide in guideDict.items():
+        if guide["max_exceeded"]:
             # don't care about categorizing these
             continue
-        for offTarget in guideDict[guideID]["offtargets"]:
-            if offTarget["loc"] == location:
-                contextString = str(intersect[-1])
+        for offTarget in guide["offtargets"]:
+            chm, pos, strand = offTarget["loc"].split(":")
+            start, end = pos.split("-")
+            offTargetsByChrom.setdefault(chm, []).append(
+                (offTarget, int(start), int(end))
+            )
+
+    for chm, offTargets in offTargetsByChrom.items():
+        intersections = segmentIndex.overlapping(
+            chm,
+            [start for o, start, end in offTargets],
+            [end for o, start, end in offTargets],
+        )
+        for (offTarget, start, end), contexts in zip(offTargets, intersections):
+            for contextString in contexts:
                 # start the context string or append to the existing one
                 offTarget["context"] = (
                     formatContext("", contextString)
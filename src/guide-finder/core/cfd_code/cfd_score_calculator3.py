@@ -11,6 +11,14 @@ import os
 import pickle
 import re
 
+# order of the bases in the position x mismatch lookup table
+BASES = "ACGT"
+BASE_INDEX = {base: idx for idx, base in enumerate(BASES)}
+
+# score tables are unpickled once per process, see get_mm_pam_scores()
+_mm_pam_scores = None
+_mm_lookup = None
+
 
 def get_parser():
     parser = argparse.ArgumentParser(description="Calculates CFD score")
@@ -27,35 +35,77 @@ def revcom(s):
     return "".join(letters)
 
 
-# Unpickle mismatch scores and PAM scores
+# Unpickle mismatch scores and PAM scores (only the first call reads from disk)
 def get_mm_pam_scores():
+    global _mm_pam_scores
+    if _mm_pam_scores is not None:
+        return _mm_pam_scores
     try:
         dir_path = os.path.dirname(os.path.abspath(__file__))
-        mm_scores = pickle.load(
-            open(os.path.join(dir_path, "mismatch_score.pkl"), "rb")
-        )
-        pam_scores = pickle.load(open(os.path.join(dir_path, "pam_scores.pkl"), "rb"))
-        return (mm_scores, pam_scores)
+        with open(os.path.join(dir_path, "mismatch_score.pkl"), "rb") as f:
+            mm_scores = pickle.load(f)
+        with open(os.path.join(dir_path, "pam_scores.pkl"), "rb") as f:
+            pam_scores = pickle.load(f)
     except Exception:
         raise Exception("Could not find file with mismatch scores or PAM scores")
+    _mm_pam_scores = (mm_scores, pam_scores)
+    return _mm_pam_scores
+
+
+# Precompute the mismatch scores as a position x (wt base x off-target base) table
+# lookup[i][BASE_INDEX[wt]][BASE_INDEX[off]] is the factor for position i (0 based),
+# matches score 1 and mismatches missing from the pickle are left as None
+def get_mm_lookup():
+    global _mm_lookup
+    if _mm_lookup is not None:
+        return _mm_lookup
+    mm_scores, pam_scores = get_mm_pam_scores()
+    num_positions = max(int(key.split(",")[1]) for key in mm_scores)
+    lookup = []
+    for i in range(num_positions):
+        position = []
+        for wt_base in BASES:
+            row = []
+            for off_base in BASES:
+                if wt_base == off_base:
+                    row.append(1)
+                else:
+                    key = (
+                        "r"
+                        + wt_base.replace("T", "U")
+                        + ":d"
+                        + revcom(off_base)
+                        + ","
+                        + str(i + 1)
+                    )
+                    row.append(mm_scores.get(key))
+            position.append(row)
+        lookup.append(position)
+    _mm_lookup = lookup
+    return _mm_lookup
 
 
 # Calculates CFD score
 def calc_cfd(wt, sg, pam):
+    return calc_cfd_many(wt, [(sg, pam)])[0]
+
+
+# Calculates the CFD score of every (off-target sgRNA, PAM) pair against the same WT sgRNA
+def calc_cfd_many(wt, offtargets):
     mm_scores, pam_scores = get_mm_pam_scores()
-    score = 1
-    sg = sg.replace("T", "U")
-    wt = wt.replace("T", "U")
-    s_list = list(sg)
-    wt_list = list(wt)
-    for i, sl in enumerate(s_list):
-        if wt_list[i] == sl:
-            score *= 1
-        else:
-            key = "r" + wt_list[i] + ":d" + revcom(sl) + "," + str(i + 1)
-            score *= mm_scores[key]
-    score *= pam_scores[pam]
-    return score
+    lookup = get_mm_lookup()
+    wt_idx = [BASE_INDEX[base] for base in wt.replace("U", "T")]
+    scores = []
+    for sg, pam in offtargets:
+        score = 1
+        for i, sl in enumerate(sg.replace("U", "T")):
+            factor = lookup[i][wt_idx[i]][BASE_INDEX[sl]]
+            if factor is None:
+                raise KeyError("No mismatch score for position " + str(i + 1))
+            score *= factor
+        score *= pam_scores[pam]
+        scores.append(score)
+    return scores
 
 
 if __name__ == "__main__":
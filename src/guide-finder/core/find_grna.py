@@ -1,7 +1,8 @@
+import heapq
 import os.path
-import pprint
 import re
 import sys
+from functools import lru_cache
 
 from pymongo import MongoClient
 
@@ -9,6 +10,27 @@ forward_nuc = "ATGC"
 reverse_nuc = "TACG"
 translate_code = str.maketrans(forward_nuc, reverse_nuc)
 
+ambiguity_to_nuc = {
+    "A": "A",
+    "T": "T",
+    "G": "G",
+    "C": "C",
+    "R": ["A", "G"],
+    "Y": ["C", "T"],
+    "S": ["G", "C"],
+    "W": ["A", "T"],
+    "K": ["G", "T"],
+    "M": ["A", "C"],
+    "B": ["C", "G", "T"],
+    "D": ["A", "G", "T"],
+    "H": ["A", "C", "T"],
+    "V": ["A", "C", "G"],
+    "N": ["A", "C", "G", "T"],
+}
+
+# one connection per process, reused by every lookup
+_mongo_clients = {}
+
 
 def get_rgen_info(rgen_id):
     """
@@ -19,7 +41,10 @@ def get_rgen_info(rgen_id):
     """
 
     assert int(rgen_id) >= 1, "rgen_id must be 1 or above"
-    mongo_client = MongoClient("mongodb://localhost:27017")
+    mongo_client = _mongo_clients.get(os.getpid())
+    if mongo_client is None:
+        mongo_client = MongoClient("mongodb://localhost:27017")
+        _mongo_clients[os.getpid()] = mongo_client
     if mongo_client is None:
         sys.exit("Cannot connect to Mongodb")
 
@@ -54,7 +79,7 @@ def process_fasta_file(fasta_file):
 
     """
 
-    sequence_to_return = ""
+    sequence_lines = []
     with open(fasta_file, "r") as fasta_fh:
         for line in fasta_fh:
             if line.startswith(">"):
@@ -67,7 +92,8 @@ def process_fasta_file(fasta_file):
                     header_match.group(3),
                 )
             else:
-                sequence_to_return = sequence_to_return + line.strip("\n").upper()
+                sequence_lines.append(line.strip("\n"))
+    sequence_to_return = "".join(sequence_lines).upper()
 
     return (chrom, start_pos, end_pos, sequence_to_return)
 
@@ -81,24 +107,6 @@ def return_all_pams(pam):
 
     """
 
-    ambiguity_to_nuc = {
-        "A": "A",
-        "T": "T",
-        "G": "G",
-        "C": "C",
-        "R": ["A", "G"],
-        "Y": ["C", "T"],
-        "S": ["G", "C"],
-        "W": ["A", "T"],
-        "K": ["G", "T"],
-        "M": ["A", "C"],
-        "B": ["C", "G", "T"],
-        "D": ["A", "G", "T"],
-        "H": ["A", "C", "T"],
-        "V": ["A", "C", "G"],
-        "N": ["A", "C", "G", "T"],
-    }
-
     forward_pam_motifs = [nuc for nuc in ambiguity_to_nuc[pam[0]]]
     for pam_nuc in pam[1:]:
         tmp_motifs = []
@@ -118,6 +126,119 @@ def return_all_pams(pam):
     return all_pam_motifs
 
 
+@lru_cache(maxsize=None)
+def compile_pam(pam):
+    """
+
+    This function will compile a PAM motif with IUPAC ambiguity codes into a pair of regular
+    expressions matching the motif on the '+' strand and its reverse complement on the '-' strand.
+    The motifs are wrapped in lookaheads so overlapping PAM sites are all found in one pass
+
+    """
+
+    forward_classes = [
+        "[" + "".join(ambiguity_to_nuc[pam_nuc]) + "]" for pam_nuc in pam.upper()
+    ]
+    reverse_classes = [
+        "[" + "".join(ambiguity_to_nuc[pam_nuc]).translate(translate_code) + "]"
+        for pam_nuc in reversed(pam.upper())
+    ]
+
+    return (
+        re.compile("(?=" + "".join(forward_classes) + ")"),
+        re.compile("(?=" + "".join(reverse_classes) + ")"),
+    )
+
+
+def scan_pams(input_sequence, pam, pam_location, grna_len):
+    """
+
+    This function will find every PAM site on both strands of a sequence (str or bytes) and yield
+    (pam_pos, strand, pam_seq, guide_seq, guide_pos) for the ones with a complete gRNA next to them,
+    in order of position. Positions are 0-based within the sequence. A site matching the PAM on
+    both strands (i.e. a palindromic PAM) is reported once for each strand
+
+    """
+
+    if isinstance(input_sequence, (bytes, bytearray)):
+        input_sequence = input_sequence.decode("ascii")
+    input_sequence = input_sequence.upper()
+    forward_regex, reverse_regex = compile_pam(pam)
+
+    # merge the sites of both strands by position as they're found, the '+' strand first at the same position
+    sites = heapq.merge(
+        ((match.start(), "+") for match in forward_regex.finditer(input_sequence)),
+        ((match.start(), "-") for match in reverse_regex.finditer(input_sequence)),
+    )
+
+    for i, strand in sites:
+        guide_seq = None
+        guide_pos = None
+        substring_to_search = input_sequence[i : i + len(pam)]
+        if strand == "+":
+            pam_pos = i
+            pam_seq = substring_to_search
+            if pam_location == "downstream":
+                if pam_pos - grna_len >= 0:
+                    guide_seq = input_sequence[pam_pos - grna_len : pam_pos]
+                    guide_pos = pam_pos - grna_len
+            elif pam_location == "upstream":
+                if pam_pos + len(pam) + grna_len <= len(input_sequence):
+                    guide_seq = input_sequence[
+                        pam_pos + len(pam) : pam_pos + len(pam) + grna_len
+                    ]
+                    guide_pos = pam_pos + len(pam)
+        else:
+            pam_pos = i + len(pam) - 1
+            pam_seq = "".join(list(reversed(substring_to_search))).translate(
+                translate_code
+            )
+            if pam_location == "downstream":
+                if pam_pos + 1 + grna_len <= len(input_sequence):
+                    guide_seq = input_sequence[pam_pos + 1 : pam_pos + 1 + grna_len]
+                    guide_pos = pam_pos + grna_len
+            elif pam_location == "upstream":
+                if pam_pos - len(pam) - grna_len + 1 >= 0:
+                    guide_seq = input_sequence[
+                        pam_pos - len(pam) - grna_len + 1 : pam_pos - len(pam) + 1
+                    ]
+                    guide_pos = pam_pos - len(pam)
+
+            if guide_seq is not None:
+                guide_seq = "".join(list(reversed(guide_seq))).translate(translate_code)
+
+        if guide_seq is not None and len(guide_seq) == grna_len:
+            yield pam_pos, strand, pam_seq, guide_seq, guide_pos
+
+
+def find_grna_in_sequence(rgen_id, grna_len, chrom, start_pos, input_sequence):
+    """
+
+    This function will return the PAM motifs along with the associated gRNA information in a
+    sequence (str or bytes) starting at start_pos (1-based) on chrom, in the same format as find_grna
+
+    """
+
+    pam, default_grna_len, pam_location = get_rgen_info(rgen_id)
+    grna_len = int(default_grna_len) if int(grna_len) == 0 else int(grna_len)
+
+    pams_in_input = {}
+    for pam_pos, strand, pam_seq, guide_seq, guide_pos in scan_pams(
+        input_sequence, pam, pam_location, grna_len
+    ):
+        pams_in_input[str(pam_pos) + strand] = {
+            "pam_chrom": chrom,
+            "pam_location": pam_location,
+            "pam_seq": pam_seq,
+            "guide_seq": guide_seq,
+            "strand": strand,
+            "pam_genomic_start": int(start_pos) + int(pam_pos),
+            "guide_genomic_start": int(start_pos) + int(guide_pos),
+        }
+
+    return pams_in_input
+
+
 def find_grna(rgen_id, grna_len, fasta_file):
     """
 
@@ -129,9 +250,6 @@ def find_grna(rgen_id, grna_len, fasta_file):
 
     """
 
-    pam, default_grna_len, pam_location = get_rgen_info(rgen_id)
-    grna_len = int(default_grna_len) if int(grna_len) == 0 else int(grna_len)
-
     if not os.path.exists(fasta_file):
         sys.exit("File " + fasta_file + "doesn't exist. Please enter a valid path.")
 
@@ -140,76 +258,7 @@ def find_grna(rgen_id, grna_len, fasta_file):
     if len(input_sequence) == 0:
         sys.exit("input sequence is empty in the fasta file " + fasta_file)
 
-    # first, get all possible pam motif sequences given the pattern
-
-    all_pam_motifs = return_all_pams(pam)
-
-    """
-        Now that we have all possible pam motif sequences, search for all of them in the sequence
-        Extract subsequences from the input sequence that are the same length as the PAM motif and 
-        look for that subsequence in the list of all possible pam motifs generated above. If it is 
-        found record the position of the subsequence based on the direction. 
-        
-        Once a PAM is found, based on the guide sequence properties i.e. the location of PAM W.R.T
-        guide sequence and the guide sequence length, extract the guide sequence adjacent to the 
-        PAM.
-    """
-
-    pams_in_input = {}
-    for i in range(0, len(input_sequence) - len(pam) + 1):
-        substring_to_search = input_sequence[i : i + len(pam)]
-        if substring_to_search in all_pam_motifs:
-            guide_seq = None
-            guide_pos = None
-            if all_pam_motifs[substring_to_search] == "+":
-                pam_pos = i
-                pam_seq = substring_to_search
-                if pam_location == "downstream":
-                    if pam_pos - grna_len >= 0:
-                        guide_seq = input_sequence[pam_pos - grna_len : pam_pos]
-                        guide_pos = pam_pos - grna_len
-                elif pam_location == "upstream":
-                    if pam_pos + len(pam) + grna_len <= len(input_sequence):
-                        guide_seq = input_sequence[
-                            pam_pos + len(pam) : pam_pos + len(pam) + grna_len
-                        ]
-                        guide_pos = pam_pos + len(pam)
-            else:
-                pam_pos = i + len(pam) - 1
-                pam_seq = "".join(list(reversed(substring_to_search))).translate(
-                    translate_code
-                )
-                if pam_location == "downstream":
-                    if pam_pos + 1 + grna_len <= len(input_sequence):
-                        guide_seq = input_sequence[pam_pos + 1 : pam_pos + 1 + grna_len]
-                        guide_pos = pam_pos + grna_len
-                elif pam_location == "upstream":
-                    if pam_pos - len(pam) - grna_len + 1 >= 0:
-                        guide_seq = input_sequence[
-                            pam_pos - len(pam) - grna_len + 1 : pam_pos - len(pam) + 1
-                        ]
-                        guide_pos = pam_pos - len(pam)
-
-                if guide_seq is not None:
-                    guide_seq = "".join(list(reversed(guide_seq))).translate(
-                        translate_code
-                    )
-
-            if guide_seq is not None and len(guide_seq) == grna_len:
-                pams_in_input[
-                    str(pam_pos) + str(all_pam_motifs[substring_to_search])
-                ] = {
-                    "pam_chrom": chrom,
-                    "pam_location": pam_location,
-                    "pam_seq": pam_seq,
-                    "guide_seq": guide_seq,
-                    "strand": all_pam_motifs[substring_to_search],
-                    "pam_genomic_start": int(start_pos) + int(pam_pos),
-                    "guide_genomic_start": int(start_pos) + int(guide_pos),
-                }
-
-    return pams_in_input
-    pprint.pprint(pams_in_input)
+    return find_grna_in_sequence(rgen_id, grna_len, chrom, start_pos, input_sequence)
 
 
 # main program
@@ -11,14 +11,19 @@ import binascii
 import datetime
 import logging
 import os
+import queue
+import re
 import sys
+import threading
 import time
-from subprocess import DEVNULL, PIPE, Popen, run
 
 dir_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(dir_path, "../../helpers"))
-from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, product
 
+import align_server
+import get_sequence
 from Config import Config
 
 today = datetime.date.today()
@@ -53,6 +58,15 @@ nucleotide_codes = {
     "N": ["A", "C", "G", "T"],
 }
 
+# the sharded alignments hand their samse lines over in chunks of this many lines, with at most
+# SHARD_QUEUE_SIZE chunks waiting to be parsed (bwa is paused while the queue is full)
+SHARD_CHUNK_LINES = 64
+SHARD_QUEUE_SIZE = 16
+
+# cigar operations and the XA alternative hits (chr,pos,CIGAR,NM;) in bwa samse output
+cigarOperations = re.compile(r"(\d+)([MIDNSHP=X])")
+alternativeHit = re.compile(r"([^,;]+),([-+]\d+),([^,]+),(\d+);")
+
 
 def getRgenRecord(rgenID):
     dbConnection = Config()
@@ -117,6 +131,22 @@ def writeFasta(batchID, guides, tempfile_directory):
     return fasta
 
 
+def writeFastaShards(batchID, guides, tempfile_directory, shards):
+    """given a dict of guides, split them into (at most) the number of shards and write a fasta file for each"""
+    guideIDs = [guideID for guideID, guide in guides.items() if "skip" not in guide]
+    shardSize = max(1, -(-len(guideIDs) // shards))
+    fastaFiles = []
+    for shard, first in enumerate(range(0, len(guideIDs), shardSize)):
+        shardGuides = {
+            guideID: guides[guideID] for guideID in guideIDs[first : first + shardSize]
+        }
+        fastaFiles.append(
+            writeFasta(str(batchID) + "_" + str(shard), shardGuides, tempfile_directory)
+        )
+
+    return fastaFiles
+
+
 def revSeq(seq):
     """given a sequence returns the complement (preserving direction, i.e. 5'->3' is converted to 5'->3' on opposite strand)"""
     complement = {
@@ -272,11 +302,18 @@ def processOffTarget(guideDict, rgen, offTargetLoc, offTargetSeq):
 
     # change case of the off-target sequence based on the mismatched bases (lowercase)
     offTargetGuide = changeCase(guideDict["guide_seq"], offTargetGuide)
-    # add the off-target attributes to the guide dict
+    # add the off-target attributes to the guide dict, along with the mismatch count it's listed under
+    # and whether it has no mismatches in the seed
     if "offtargets" not in guideDict:
         guideDict["offtargets"] = []
     guideDict["offtargets"].append(
-        {"seq": offTargetGuide, "pam": offTargetPAM, "loc": offTargetLoc}
+        {
+            "seq": offTargetGuide,
+            "pam": offTargetPAM,
+            "loc": offTargetLoc,
+            "mismatches": mismatches,
+            "none_in_seed": noneInSeed,
+        }
     )
 
     return guideDict
@@ -315,9 +352,10 @@ def changeCase(guide, offtarget_guide):
     return resultGuide
 
 
-def countOffTargets(batchID, potentialGuides, rgen, maxOffTargets, tempfile_directory):
+def countOffTargets(potentialGuides, rgen, maxOffTargets, offTargetRecords, genome_fa):
     """
-    Given a batchID, list of potential guides, and an rgen, parse the extended fastas and get dict of off-targets.
+    Given a list of potential guides, an rgen, and the extended off-target records of the guides, fetch the sequence
+    of each off-target from the genome and get dict of off-targets.
     Using the rgen, remove all the matches that aren't adjacent to a PAM motif
     """
     offTargetMotifs = getMotifs(
@@ -325,191 +363,234 @@ def countOffTargets(batchID, potentialGuides, rgen, maxOffTargets, tempfile_dire
     )  # NB: OffTargetPAMS should also include the classical PAM for the rgen
     pamLocation = rgen["PamLocation"]
     # rgenSeed = rgen['SeedRegion']
+    genome = get_sequence.open_genome(genome_fa)
 
-    # initialize the counts, offtarget list, and max_exceeded flag
+    # initialize the counts, offtarget list, and max_exceeded flag (and the repeat flag, which is
+    # set while the alignments are streamed in, so it's reset before the records are consumed)
     for guideID, guide in potentialGuides.items():
+        guide["skip"] = False
         guide["offtarget_counts"] = [0] * 5
         guide["offtargets_seed"] = [0] * 5
         guide["max_exceeded"] = False
         guide["offtargets"] = []
 
-    # open the extended fasta
-    with open(
-        os.path.join(tempfile_directory, str(batchID) + "_extended.fa"), "r"
-    ) as f:
-        for line in f:
-            if line.startswith(">"):
-                guideID, location = line.strip().split(
-                    "_"
-                )  # parse out label and location
-                guideID = guideID[1:]  # remove > marker
-                if (
-                    potentialGuides[guideID]["max_exceeded"]
-                    or potentialGuides[guideID]["skip"]
-                ):
-                    continue
-                seq = next(f).strip()  # seq is next line after label
-                strand = location[-1]
-                # only add off-target to guide's dict if it has the motif
-                if hasMotif(offTargetMotifs, pamLocation, strand, seq):
-                    if maxOffTargets and sum(
-                        potentialGuides[guideID]["offtarget_counts"]
-                    ) >= int(maxOffTargets):
-                        # don't track any more
-                        potentialGuides[guideID]["max_exceeded"] = True
-                    else:
-                        potentialGuides[guideID] = processOffTarget(
-                            potentialGuides[guideID], rgen, location, seq
-                        )
+    for guideID, chm, start, end, strand in offTargetRecords:
+        if potentialGuides[guideID]["max_exceeded"] or potentialGuides[guideID]["skip"]:
+            continue
+        seq = genome.fetch(chm, start, end)
+        location = chm + ":" + str(start) + "-" + str(end) + ":" + strand
+        # only add off-target to guide's dict if it has the motif
+        if hasMotif(offTargetMotifs, pamLocation, strand, seq):
+            if maxOffTargets and sum(
+                potentialGuides[guideID]["offtarget_counts"]
+            ) >= int(maxOffTargets):
+                # don't track any more
+                potentialGuides[guideID]["max_exceeded"] = True
+            else:
+                potentialGuides[guideID] = processOffTarget(
+                    potentialGuides[guideID], rgen, location, seq
+                )
 
     return potentialGuides
 
 
-def convertExtendedBedToFasta(batchID, genome, genome_fa, tempfile_directory):
-    """uses bedtools to convert the extended bed to fasta"""
-    # template command
-    extendedBed = os.path.join(tempfile_directory, str(batchID) + "_extended.bed")
-    extendedFasta = os.path.join(tempfile_directory, str(batchID) + "_extended.fa")
-
-    bashCommand = [
-        "bedtools",
-        "getfasta",
-        "-fi",
-        genome_fa,
-        "-bed",
-        extendedBed,
-        "-name",
-        "-fo",
-        extendedFasta,
-    ]
-    p = run(bashCommand, stderr=PIPE)
-    if p.stderr and not p.stderr.startswith(b"Warning"):
-        # raise errors, ignore warnings
-        raise Exception("Error in bedtools getfasta command: " + str(p.stderr))
+def runAlignment(genome, fastaFile, genome_fa, tempfile_directory, threads=2):
+    """
+    align the guides' fasta file with bwa, returns a generator over the lines of the samse output.
+    If the alignment worker (align_server.py) is running, the alignment is submitted to it so the
+    genome's index is already in memory, otherwise bwa is run here
+    """
+    # the worker only aligns fasta files in the temp directory against installed genomes
+    worker = None
+    if align_server.installedGenome(genome_fa) and align_server.tempFasta(
+        fastaFile.name
+    ):
+        worker = align_server.connect()
+    if worker:
+        return align_server.submitAlignment(worker, genome_fa, fastaFile.name, threads)
+
+    saiFile = align_server.alignFasta(genome_fa, fastaFile.name, threads)
+    return align_server.samseLines(genome_fa, fastaFile.name, saiFile)
+
 
+def runShardedAlignment(genome, fastaFiles, genome_fa, tempfile_directory, threads=2):
+    """
+    align the fasta files of a sharded batch of guides concurrently with at most the given number
+    of bwa threads between them, returns a generator over the lines of the shards' samse output as
+    they arrive. Each guide's record is a single line, so the shards' lines can be interleaved
     """
-	twoBitTwoFaCommand = ["twoBitToFa", os.path.join(dir_path,"../../../jbrowse/data/mm10/processed/mm10.2bit"),"-bed="+extendedBed, extendedFasta]
-	p = run(twoBitTwoFaCommand,stderr=PIPE)
-	if p.stderr:
-		raise Exception("Error in twoBitToFa: "+str(p.stderr))
-	"""
+    shards = min(len(fastaFiles), threads)
+    shardThreads = max(1, threads // shards)
+    chunks = queue.Queue(maxsize=SHARD_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def handOver(chunk):
+        """queue a chunk of lines for the parser, returns False if it has stopped reading"""
+        while not stopped.is_set():
+            try:
+                chunks.put(chunk, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-    return
+    def alignShard(fastaFile):
+        samLines = None
+        try:
+            samLines = runAlignment(
+                genome, fastaFile, genome_fa, tempfile_directory, shardThreads
+            )
+            for chunk in iter(lambda: list(islice(samLines, SHARD_CHUNK_LINES)), []):
+                if not handOver(chunk):
+                    return
+        finally:
+            # stops bwa if the parser gave up on the stream early
+            if samLines is not None:
+                samLines.close()
+            # marks the end of the shard
+            handOver(None)
+
+    executor = ThreadPoolExecutor(max_workers=shards)
+    futures = [executor.submit(alignShard, fastaFile) for fastaFile in fastaFiles]
+
+    def mergedLines():
+        try:
+            remaining = len(futures)
+            while remaining:
+                chunk = chunks.get()
+                if chunk is None:
+                    remaining -= 1
+                    continue
+                yield from chunk
+            # raise the error of any shard that failed
+            for future in futures:
+                future.result()
+        finally:
+            stopped.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
+    return mergedLines()
+
+
+def parseSamTags(fields):
+    """given the fields of a sam record, returns its optional tags as a dict (excluding the XA alternative locations)"""
+    tags = {}
+    for field in fields[11:]:
+        tag, value = field.strip().split(":", 1)
+        if tag != "XA":
+            tags[tag] = value
+    return tags
+
+
+def isRepetetive(tags):
+    """given the tags of a guide's primary alignment, returns True if bwa flagged it as repetetive"""
+    if "XT" in tags and tags["XT"].endswith(":R"):
+        # repeat flag set by bwa for guide hits
+        return True
+    elif "X1" in tags and int(tags["X1"].split(":")[1]) > 50000:
+        # skip if more than 50k suboptimal hits (they won't be reported by bwa)
+        return True
+    return False
+
+
+def screenRepetetive(potentialGuides, guideID, tags):
+    """marks a guide whose primary alignment bwa flagged as repetetive so it's screened out of the off-target search"""
+    potentialGuides[guideID]["skip"] = isRepetetive(tags)
+    return potentialGuides[guideID]["skip"]
+
+
+def cigarReferenceLength(cigar):
+    """given a cigar string, returns the number of reference bases it spans (as bedtools bamtobed counts them)"""
+    return sum(
+        int(length) for length, op in cigarOperations.findall(cigar) if op in "MDN=X"
+    )
 
 
-def extendBed(batchID, potentialGuides, genome, rgen, tempfile_directory):
-    """extend the locations in the guide's bed file to include the PAM"""
+def parseAlignments(samLines, potentialGuides, samIndex):
+    """
+    generator over the records of bwa samse's output, yields (guideID, chromosome, start, end, strand) for the
+    primary alignment and every XA alternative hit of each guide, in the order xa2multi + bamtobed wrote them.
+    The tags of each guide's primary record are kept in samIndex and the guide is screened for repeats
+    as soon as it's seen, so no hits are yielded for repetetive guides. Since the hits are consumed as
+    they're yielded, the rest of a guide's alternative hits are skipped (unparsed) as soon as it's
+    marked as having exceeded the max number of off-targets
+    """
+    for line in samLines:
+        if line.startswith("@"):
+            continue
+        fields = line.rstrip("\n").split("\t")
+        guideID = fields[0]
+        if guideID in samIndex:
+            # samse writes one record per read, so this is a duplicated guide in the fasta
+            logging.warning(
+                f"More than one primary alignment for guide {guideID}, keeping the first"
+            )
+            continue
+        samIndex[guideID] = parseSamTags(fields)
+        if screenRepetetive(potentialGuides, guideID, samIndex[guideID]):
+            continue
+        flag = int(fields[1])
+        if flag & 0x4:
+            # unmapped, bamtobed doesn't report these
+            continue
+        start = int(fields[3]) - 1
+        strand = "-" if flag & 0x10 else "+"
+        yield guideID, fields[2], start, start + cigarReferenceLength(fields[5]), strand
+        for field in fields[11:]:
+            if field.startswith("XA:Z:"):
+                for hit in alternativeHit.finditer(field, 5):
+                    if potentialGuides[guideID].get("max_exceeded"):
+                        break
+                    chm, pos, cigar, nm = hit.groups()
+                    start = abs(int(pos)) - 1
+                    strand = "-" if pos.startswith("-") else "+"
+                    yield guideID, chm, start, start + cigarReferenceLength(
+                        cigar
+                    ), strand
+
+
+def extendOffTargets(alignedHits, potentialGuides, genome, rgen):
+    """
+    generator extending the locations of the aligned hits to include the PAM, yields
+    (guideID, chromosome, start, end, strand) records for the ones that stay within the chromosome
+    """
     # store relevant rgen attributes
     pamLocation = rgen["PamLocation"]
     pamLength = len(rgen["PAM"])
     # connect to the genome db (to check chrom lengths later)
     dbConnection = Config(genome)
-    # bed files name/location
-    bedFile = os.path.join(tempfile_directory, str(batchID) + ".bed")
-    extendedBed = os.path.join(tempfile_directory, str(batchID) + "_extended.bed")
-    # track repetetive guides to prevent writing their off-targets
-    skipped_guides = []
-    if os.path.isfile(bedFile):
-        # rewrite every line of original bed into extended bed
-        originalBed = open(bedFile, "r")
-        extendedBed = open(extendedBed, "w+")
-        for line in originalBed.readlines():
-            chm, start, end, label, score, strand = [
-                x.strip() for x in line.split("\t")[0:6]
-            ]
-            if label in skipped_guides:
-                continue
-            elif potentialGuides[label]["skip"]:
-                skipped_guides.append(label)
-            start, end = map(int, [start, end])
-            assert start < end, str(bedFile) + " chr locations out of order"
-            # calculate extension
-            if (pamLocation == "downstream" and strand == "+") or (
-                pamLocation == "upstream" and strand == "-"
-            ):
-                end = int(end) + pamLength
-            elif (pamLocation == "downstream" and strand == "-") or (
-                pamLocation == "upstream" and strand == "+"
-            ):
-                start = int(start) - pamLength
-            else:
-                raise Exception(
-                    "Unexpected pamLocation ("
-                    + str(pamLocation)
-                    + ") and/or strand ("
-                    + str(strand)
-                    + ")"
-                )
-
-            # ensure that the extension doesn't create an illegal location, skip writing if so
-            if start < 0 or end > dbConnection.chromSizes[chm]:
-                continue
-
-            # rewrite the line, and put the location in the label (for use in fasta)
-            newLabel = (
-                label.split("_")[0]
-                + "_"
-                + chm
-                + ":"
-                + str(start)
-                + "-"
-                + str(end)
-                + ":"
-                + strand
-            )
-            extendedBed.write(
-                "\t".join(map(str, [chm, start, end, newLabel, score, strand])) + "\n"
+    for guideID, chm, start, end, strand in alignedHits:
+        # don't keep the off-targets of repetetive guides or ones that are over the max
+        if potentialGuides[guideID]["skip"] or potentialGuides[guideID].get(
+            "max_exceeded"
+        ):
+            continue
+        assert start < end, guideID + " chr locations out of order"
+        # calculate extension
+        if (pamLocation == "downstream" and strand == "+") or (
+            pamLocation == "upstream" and strand == "-"
+        ):
+            end = int(end) + pamLength
+        elif (pamLocation == "downstream" and strand == "-") or (
+            pamLocation == "upstream" and strand == "+"
+        ):
+            start = int(start) - pamLength
+        else:
+            raise Exception(
+                "Unexpected pamLocation ("
+                + str(pamLocation)
+                + ") and/or strand ("
+                + str(strand)
+                + ")"
             )
 
-        originalBed.close()
-        extendedBed.close()
-    else:
-        raise FileNotFoundError("Extended Bed File Not Found")
-
-    return extendedBed
-
-
-def runAlignment(genome, fastaFile, genome_fa, tempfile_directory):
-    """execute a shell script to perform bwa alignment on a fasta file"""
-    # if troubleshooting the bwa step, replace the stdout and stderr variables with PIPE to see output
-    p = Popen(
-        [
-            os.path.join(dir_path, "bwa_align.sh"),
-            genome_fa,
-            os.path.basename(fastaFile.name),
-            tempfile_directory,
-        ],
-        stdin=PIPE,
-        stdout=DEVNULL,
-        stderr=DEVNULL,
-        encoding="utf-8",
-    )
-    out, err = p.communicate()
-    if err:
-        print(err)
-
-    return
-
-
-def screenRepetetive(batchID, potentialGuides, tempfile_directory):
-    """marks guides with a 'repetetive' flag in their sam file so they're screened out of the off-target search"""
-    sam_file = os.path.join(tempfile_directory, str(batchID) + ".sam")
-
-    if os.path.exists(sam_file):
-        for guideID, guide in potentialGuides.items():
-            p = run(["grep", "-m", "1", "-e", guideID, sam_file], stdout=PIPE)
-            # grab the tags (excluding the last one containing the locations)
-            hit_tags = p.stdout.decode("utf-8").strip().split("\t")[11:-1]
-            # TODO if not hit_tags -> investigate
-            tags = {x.split(":", 1)[0]: x.strip().split(":", 1)[1] for x in hit_tags}
-            if "XT" in tags and tags["XT"].endswith(":R"):
-                # repeat flag set by bwa for guide hits
-                potentialGuides[guideID]["skip"] = True
-            elif "X1" in tags and int(tags["X1"].split(":")[1]) > 50000:
-                # skip if more than 50k suboptimal hits (they won't be reported by bwa)
-                potentialGuides[guideID]["skip"] = True
-            else:
-                potentialGuides[guideID]["skip"] = False
+        # ensure that the extension doesn't create an illegal location, skip if so
+        if start < 0 or end > dbConnection.chromSizes[chm]:
+            continue
+
+        yield guideID, chm, start, end, strand
 
 
 def findOffTargets(
@@ -534,7 +615,15 @@ def findOffTargets(
     )
     logging.debug("\t\t\t\t[STARTED]\t\tWriting fasta file...")
 
-    fastaFile = writeFasta(batchID, potentialGuides, tempfile_directory)
+    # large batches can be split into shards that are aligned concurrently
+    settings = Config()
+    sharded = settings.BWA_SHARDS > 1 and len(potentialGuides) > 1
+    if sharded:
+        fastaFiles = writeFastaShards(
+            batchID, potentialGuides, tempfile_directory, settings.BWA_SHARDS
+        )
+    else:
+        fastaFile = writeFasta(batchID, potentialGuides, tempfile_directory)
 
     time_2 = time.time()
     logging.debug(
@@ -542,44 +631,33 @@ def findOffTargets(
     )
     logging.debug("\t\t\t\t[STARTED]\t\tRunning bwa alignment...")
 
-    runAlignment(genome, fastaFile, genome_fa, tempfile_directory)
+    if sharded:
+        samLines = runShardedAlignment(
+            genome, fastaFiles, genome_fa, tempfile_directory, settings.BWA_THREADS
+        )
+    else:
+        samLines = runAlignment(
+            genome, fastaFile, genome_fa, tempfile_directory, settings.BWA_THREADS
+        )
 
     time_3 = time.time()
     logging.debug(
         f"\t\t\t\t[FINISHED]\tRan bwa alignment in {str(round(time_3-time_2,4))}s"
     )
-    logging.debug("\t\t\t\t[STARTED]\t\tScreening repeats...")
-
-    screenRepetetive(batchID, potentialGuides, tempfile_directory)
-
-    time_4 = time.time()
-    logging.debug(
-        f"\t\t\t\t[FINISHED]\tScreened repeats in {str(round(time_4-time_3,4))}s"
-    )
-    logging.debug("\t\t\t\t[STARTED]\t\tExtending beds...")
-    extendBed(batchID, potentialGuides, genome, rgen, tempfile_directory)
-
-    time_5 = time.time()
-    logging.debug(
-        f"\t\t\t\t[FINISHED]\tExtended beds in {str(round(time_5-time_4,4))}s"
-    )
-    logging.debug("\t\t\t\t[STARTED]\t\tConverting bed coordinates to fasta...")
-
-    convertExtendedBedToFasta(batchID, genome, genome_fa, tempfile_directory)
-
-    time_6 = time.time()
-    logging.debug(
-        f"\t\t\t\t[FINISHED]\tConverted bed coordinates to fasta in {str(round(time_6-time_5,4))}s"
-    )
-    logging.debug("\t\t\t\t[STARTED]\t\tCounting off-targets...")
+    logging.debug("\t\t\t\t[STARTED]\t\tScreening repeats and counting off-targets...")
 
+    # the samse output is streamed through repeat screening, PAM extension, and the
+    # motif and mismatch checks one record at a time, nothing is written to disk
+    samIndex = {}
+    alignedHits = parseAlignments(samLines, potentialGuides, samIndex)
+    offTargetRecords = extendOffTargets(alignedHits, potentialGuides, genome, rgen)
     potentialGuides = countOffTargets(
-        batchID, potentialGuides, rgen, maxOffTargets, tempfile_directory
+        potentialGuides, rgen, maxOffTargets, offTargetRecords, genome_fa
     )
 
-    time_7 = time.time()
+    time_4 = time.time()
     logging.debug(
-        f"\t\t\t\t[FINISHED]\tCounted off-targets in {str(round(time_7-time_6,4))}s"
+        f"\t\t\t\t[FINISHED]\tScreened repeats and counted off-targets in {str(round(time_4-time_3,4))}s"
     )
 
     return potentialGuides
@@ -1,19 +1,210 @@
 #!/usr/bin/env python3.7
 
+import mmap
 import os
 import re
+import struct
 import subprocess
 import sys
+from array import array
+from bisect import bisect_right
 
 """
 
     This program will create a fasta file based on an input genomic twoBit file.
     Requirements: fastaToTwoBit tool, a twoBit genome file
 
+    It also provides in-process random access to a genome, either through a fasta file
+    and its samtools .fai index or through a .2bit file. Both are memory mapped so only
+    the pages of the requested windows are read.
+
 """
 
 dir_path = os.path.dirname(os.path.abspath(__file__))
 
+# readers are opened once per process, keyed by the genome path
+open_genomes = {}
+
+
+class IndexedFasta:
+    """random access to the sequences of a fasta file using its samtools faidx (.fai) index"""
+
+    def __init__(self, fasta_path, fai_path=None):
+        fai_path = fai_path if fai_path else fasta_path + ".fai"
+        if not os.path.exists(fai_path):
+            raise FileNotFoundError("Fasta index " + fai_path + " not found")
+
+        # name, length, byte offset, bases per line, bytes per line
+        self.index = {}
+        with open(fai_path, "r") as fai:
+            for line in fai:
+                name, length, offset, line_bases, line_width = line.split("\t")[0:5]
+                self.index[name] = tuple(
+                    map(int, (length, offset, line_bases, line_width))
+                )
+
+        self.fasta_file = open(fasta_path, "rb")
+        self.fasta = mmap.mmap(self.fasta_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def chrom_sizes(self):
+        """return a dict of every sequence in the fasta along with its length"""
+        return {name: entry[0] for name, entry in self.index.items()}
+
+    def fetch(self, chrom, start, end):
+        """return the sequence of chrom from start to end (0-based, end exclusive, as in bed files)"""
+        if chrom not in self.index:
+            raise KeyError("Sequence " + str(chrom) + " not found in fasta index")
+        length, offset, line_bases, line_width = self.index[chrom]
+        if start < 0 or end > length or start > end:
+            raise ValueError(
+                "Invalid interval %s:%s-%s for sequence of length %s"
+                % (chrom, start, end, length)
+            )
+
+        first = offset + (start // line_bases) * line_width + start % line_bases
+        last = offset + (end // line_bases) * line_width + end % line_bases
+        raw = self.fasta[first:last]
+        return raw.replace(b"\n", b"").replace(b"\r", b"").decode("ascii")
+
+
+class TwoBit:
+    """random access to the sequences of a UCSC .2bit file"""
+
+    # 2 bits per base, most significant bits first
+    BYTE_TO_BASES = [
+        "".join("TCAG"[(byte >> shift) & 3] for shift in (6, 4, 2, 0))
+        for byte in range(256)
+    ]
+
+    def __init__(self, twobit_path):
+        self.twobit_file = open(twobit_path, "rb")
+        self.twobit = mmap.mmap(self.twobit_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature = struct.unpack_from("<I", self.twobit, 0)[0]
+        if signature == 0x1A412743:
+            self.endian = "<"
+        elif signature == 0x4327411A:
+            self.endian = ">"
+        else:
+            raise ValueError(twobit_path + " is not a 2bit file")
+        version, seq_count = struct.unpack_from(self.endian + "II", self.twobit, 4)
+        offset_format = self.endian + ("Q" if version == 1 else "I")
+
+        # sequence name -> file offset of its record
+        self.offsets = {}
+        pos = 16
+        for _ in range(seq_count):
+            name_size = self.twobit[pos]
+            name = self.twobit[pos + 1 : pos + 1 + name_size].decode("ascii")
+            pos += 1 + name_size
+            self.offsets[name] = struct.unpack_from(offset_format, self.twobit, pos)[0]
+            pos += struct.calcsize(offset_format)
+
+        # sequence name -> (size, N blocks, mask blocks, offset of the packed dna)
+        self.records = {}
+
+    def read_blocks(self, pos):
+        """read a count followed by that many starts and sizes, return (starts, ends, next position)"""
+        count = struct.unpack_from(self.endian + "I", self.twobit, pos)[0]
+        pos += 4
+        starts, sizes = array("I"), array("I")
+        starts.frombytes(self.twobit[pos : pos + 4 * count])
+        sizes.frombytes(self.twobit[pos + 4 * count : pos + 8 * count])
+        if (self.endian == "<") != (sys.byteorder == "little"):
+            starts.byteswap()
+            sizes.byteswap()
+        ends = [start + size for start, size in zip(starts, sizes)]
+        return list(starts), ends, pos + 8 * count
+
+    def record(self, chrom):
+        """parse (and cache) the header of a sequence record"""
+        if chrom not in self.records:
+            if chrom not in self.offsets:
+                raise KeyError("Sequence " + str(chrom) + " not found in 2bit file")
+            pos = self.offsets[chrom]
+            size = struct.unpack_from(self.endian + "I", self.twobit, pos)[0]
+            n_blocks = self.read_blocks(pos + 4)
+            mask_blocks = self.read_blocks(n_blocks[2])
+            # skip the reserved word before the packed dna
+            self.records[chrom] = (size, n_blocks, mask_blocks, mask_blocks[2] + 4)
+        return self.records[chrom]
+
+    def chrom_sizes(self):
+        """return a dict of every sequence in the 2bit file along with its length"""
+        return {name: self.record(name)[0] for name in self.offsets}
+
+    def fetch(self, chrom, start, end, mask=True):
+        """
+        return the sequence of chrom from start to end (0-based, end exclusive), N blocks are written as N and,
+        like twoBitToFa, soft-masked blocks are lowercase unless mask is False
+        """
+        size, n_blocks, mask_blocks, dna_offset = self.record(chrom)
+        if start < 0 or end > size or start > end:
+            raise ValueError(
+                "Invalid interval %s:%s-%s for sequence of length %s"
+                % (chrom, start, end, size)
+            )
+
+        packed = self.twobit[dna_offset + start // 4 : dna_offset + (end + 3) // 4]
+        bases = "".join(self.BYTE_TO_BASES[byte] for byte in packed)
+        seq = list(bases[start % 4 : start % 4 + end - start])
+
+        for block_start, block_end in self.overlapping(n_blocks, start, end):
+            seq[block_start - start : block_end - start] = "N" * (
+                block_end - block_start
+            )
+        if mask:
+            for block_start, block_end in self.overlapping(mask_blocks, start, end):
+                seq[block_start - start : block_end - start] = "".join(
+                    seq[block_start - start : block_end - start]
+                ).lower()
+
+        return "".join(seq)
+
+    @staticmethod
+    def overlapping(blocks, start, end):
+        """clip the sorted, non-overlapping blocks that overlap start-end to the interval"""
+        starts, ends = blocks[0], blocks[1]
+        idx = max(bisect_right(starts, start) - 1, 0)
+        while idx < len(starts) and starts[idx] < end:
+            if ends[idx] > start:
+                yield max(starts[idx], start), min(ends[idx], end)
+            idx += 1
+
+
+def open_genome(genome_path):
+    """return a reader for a .2bit or an indexed fasta genome, opened once per process"""
+    if genome_path not in open_genomes:
+        if genome_path.endswith(".2bit"):
+            open_genomes[genome_path] = TwoBit(genome_path)
+        else:
+            open_genomes[genome_path] = IndexedFasta(genome_path)
+    return open_genomes[genome_path]
+
+
+def read_sequence(chrom_coord, genome_path):
+    """
+    given chromosomal coordinates (chrom:start-end, 1-based and inclusive) return the chromosome, start,
+    and sequence of the region from the genome, read in-process instead of through a fasta file
+    """
+    chrom_match = re.match(r"(.+):(\d+)-(\d+)", chrom_coord)
+    if chrom_match is None:
+        raise ValueError("Chromosomal coordinate must be in the format chrom:start-end")
+
+    chrom, start, end = chrom_match.group(1), chrom_match.group(2), chrom_match.group(3)
+    sequence = open_genome(genome_path).fetch(chrom, int(start) - 1, int(end))
+
+    return chrom, int(start), sequence
+
+
+def read_sequences(regions, genome_path):
+    """
+    given a list of (chrom, start, end) regions (1-based and inclusive), return a list of their sequences
+    read in-process from the genome, soft-masked as twoBitToFa would write them
+    """
+    genome = open_genome(genome_path)
+    return [genome.fetch(chrom, start - 1, end) for chrom, start, end in regions]
+
 
 def fetch_sequence(chrom_coord, genome_twobit, output_fasta):
     """
@@ -3,7 +3,7 @@ from __future__ import division
 import copy
 import os
 import pickle
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 import numpy as np
 import pandas as pd
@@ -17,6 +17,23 @@ normalizer = None
 rate_model = None
 bp_model = None
 CELLTYPE = None
+DEFAULT_KEY = None
+
+# the trained parameters of a model for one cell type, passed to predict
+Model = namedtuple(
+    "Model",
+    [
+        "celltype",
+        "nn_params",
+        "nn2_params",
+        "normalizer",
+        "rate_model",
+        "bp_model",
+        "mhless_scores",
+    ],
+)
+# registry of the loaded models, keyed by (run_iter, param_iter, celltype)
+models = {}
 
 
 ##
@@ -120,50 +137,28 @@ def provide_warnings(seq, cutsite):
 ##
 # Private prediction methods
 ##
-def __predict_dels(seq, cutsite):
+def __predict_dels(features, mh_scores, model):
     ################################################################
     #####
     ##### Predict MH and MH-less deletions
     #####
     # Predict MH deletions
+    # from the sequence's features and the NN scores of its microhomologies
+    # (evaluated together with those of the other sequences in the batch)
 
-    mh_len, gc_frac, gt_pos, del_len = __featurize(seq, cutsite)
-
-    # Form inputs
-    pred_input = np.array([mh_len, gc_frac]).T
+    mh_len, gc_frac, gt_pos, del_len = features
     del_lens = np.array(del_len).T
 
-    # Predict
-    mh_scores = __nn_function(nn_params, pred_input)
     mh_scores = mh_scores.reshape(mh_scores.shape[0], 1)
     Js = del_lens.reshape(del_lens.shape[0], 1)
     unfq = np.exp(mh_scores - 0.25 * Js)
 
     # Add MH-less contribution at full MH deletion lengths
-    mh_vector = np.array(mh_len)
-    mhfull_contribution = np.zeros(mh_vector.shape)
-    for jdx in range(len(mh_vector)):
-        if del_lens[jdx] == mh_vector[jdx]:
-            dl = del_lens[jdx]
-            mhless_score = __nn_function(nn2_params, np.array(dl))
-            mhless_score = np.exp(mhless_score - 0.25 * dl)
-            mask = np.concatenate(
-                [
-                    np.zeros(
-                        jdx,
-                    ),
-                    np.ones(
-                        1,
-                    )
-                    * mhless_score,
-                    np.zeros(
-                        len(mh_vector) - jdx - 1,
-                    ),
-                ]
-            )
-            mhfull_contribution = mhfull_contribution + mask
-    mhfull_contribution = mhfull_contribution.reshape(-1, 1)
-    unfq = unfq + mhfull_contribution
+    # (the MH-less score only depends on the deletion length, so they're precomputed)
+    mhless_scores = model.mhless_scores
+    for jdx in range(len(mh_len)):
+        if del_len[jdx] == mh_len[jdx]:
+            unfq[jdx] += mhless_scores[del_len[jdx]]
 
     # Store predictions to combine with mh-less deletion preds
     pred_del_len = copy.copy(del_len)
@@ -174,8 +169,6 @@ def __predict_dels(seq, cutsite):
     ##### Predict MH and MH-less deletions
     #####
     # Predict MH-less deletions
-    mh_len, gc_frac, gt_pos, del_len = __featurize(seq, cutsite)
-
     unfq = list(unfq)
 
     # pred_mhless_d = defaultdict(list)
@@ -191,12 +184,8 @@ def __predict_dels(seq, cutsite):
         else:
             nonfull_dls.append(dl)
 
-    mh_vector = np.array(mh_len)
     for dl in nonfull_dls:
-        mhless_score = __nn_function(nn2_params, np.array(dl))
-        mhless_score = np.exp(mhless_score - 0.25 * dl)
-
-        unfq.append(mhless_score)
+        unfq.append(mhless_scores[dl])
         pred_gt_pos.append("e")
         pred_del_len.append(dl)
 
@@ -216,16 +205,18 @@ def __predict_dels(seq, cutsite):
     return pred_del_df, total_phi_score
 
 
-def __predict_ins(seq, cutsite, pred_del_df, total_phi_score):
+def __onebp_features(seq, cutsite, pred_del_df, total_phi_score, model):
     ################################################################
     #####
     ##### Predict Insertions
     #####
-    # Predict 1 bp insertions
+    # Featurize for the 1 bp insertion rate model
+    # (evaluated together with the other sequences in the batch)
+    lengths = pred_del_df["Length"].values
+    freqs = pred_del_df["Predicted frequency"].values
     dlpred = []
     for dl in range(1, 28 + 1):
-        crit = pred_del_df["Length"] == dl
-        dlpred.append(sum(pred_del_df[crit]["Predicted frequency"]))
+        dlpred.append(sum(freqs[lengths == dl]))
     dlpred = np.array(dlpred) / sum(dlpred)
     norm_entropy = entropy(dlpred) / np.log(len(dlpred))
     precision = 1 - norm_entropy
@@ -251,19 +242,22 @@ def __predict_ins(seq, cutsite, pred_del_df, total_phi_score):
         + [precision]
         + [log_phi_score]
     )
+    normalizer = model.normalizer
     for idx in range(len(onebp_features)):
         val = onebp_features[idx]
         onebp_features[idx] = (val - normalizer[idx][0]) / normalizer[idx][1]
-    onebp_features = np.array(onebp_features).reshape(1, -1)
-    rate_1bpins = float(rate_model.predict(onebp_features))
+    return onebp_features
 
+
+def __predict_ins(seq, cutsite, pred_del_df, rate_1bpins, model):
     # Predict 1 bp genotype frequencies
     pred_1bpins_d = defaultdict(list)
     negfivebase = seq[cutsite - 2]
     negfourbase = seq[cutsite - 1]
     negthreebase = seq[cutsite]
 
-    if CELLTYPE in ["mESC", "U2OS"]:
+    bp_model = model.bp_model
+    if model.celltype in ["mESC", "U2OS"]:
         for ins_base in bp_model[negfivebase][negfourbase][negthreebase]:
             freq = bp_model[negfivebase][negfourbase][negthreebase][ins_base]
             freq *= rate_1bpins / (1 - rate_1bpins)
@@ -271,7 +265,7 @@ def __predict_ins(seq, cutsite, pred_del_df, total_phi_score):
             pred_1bpins_d["Length"].append(1)
             pred_1bpins_d["Inserted Bases"].append(ins_base)
             pred_1bpins_d["Predicted frequency"].append(freq)
-    elif CELLTYPE in ["HEK293", "HCT116", "K562"]:
+    elif model.celltype in ["HEK293", "HCT116", "K562"]:
         for ins_base in bp_model[negfourbase]:
             freq = bp_model[negfourbase][ins_base]
             freq *= rate_1bpins / (1 - rate_1bpins)
@@ -348,33 +342,77 @@ def __build_stats(seq, cutsite, pred_df, total_phi_score):
 ##
 # Main public-facing prediction
 ##
-def predict(seq, cutsite):
+def predict(seq, cutsite, model=None):
     # Predict 1 bp insertions and all deletions (MH and MH-less)
+    # with the model returned by load_model (by default, the one set by init_model)
     #
     # If no errors, returns a tuple (pred_df, stats)
     # where pred_df is a dataframe and stats is a dict
     #
     # If errors, returns a string
     #
-    if init_flag == False:
-        init_model()
+    return predict_batch([(seq, cutsite)], model)[0]
+
+
+def predict_batch(queries, model=None):
+    # Predict each of a list of (seq, cutsite) pairs as predict does,
+    # featurizing each sequence once and evaluating the networks and
+    # the insertion rate model on the inputs of every sequence at once
+    #
+    # Returns a list of predict's result (a tuple or an error string) for each pair
+    #
+    if model is None:
+        if init_flag == False:
+            init_model()
+        model = models[DEFAULT_KEY]
 
     # Sanitize input
-    seq = seq.upper()
-    flag, error = error_catching(seq, cutsite)
-    if flag:
-        return error
-    provide_warnings(seq, cutsite)
+    results = [None] * len(queries)
+    valid = []
+    for idx, (seq, cutsite) in enumerate(queries):
+        seq = seq.upper()
+        flag, error = error_catching(seq, cutsite)
+        if flag:
+            results[idx] = error
+            continue
+        provide_warnings(seq, cutsite)
+        valid.append((idx, seq, cutsite))
+
+    # Score the microhomologies of every sequence together
+    features = [__featurize(seq, cutsite) for idx, seq, cutsite in valid]
+    mh_lens, gc_fracs, offsets = [], [], [0]
+    for mh_len, gc_frac, gt_pos, del_len in features:
+        mh_lens.extend(mh_len)
+        gc_fracs.extend(gc_frac)
+        offsets.append(len(mh_lens))
+    mh_scores = __nn_function(model.nn_params, np.array([mh_lens, gc_fracs]).T)
+
+    # Make deletion predictions
+    pred_dels = []
+    onebp_features = []
+    for jdx, (idx, seq, cutsite) in enumerate(valid):
+        pred_del_df, total_phi_score = __predict_dels(
+            features[jdx], mh_scores[offsets[jdx] : offsets[jdx + 1]], model
+        )
+        pred_dels.append((pred_del_df, total_phi_score))
+        onebp_features.append(
+            __onebp_features(seq, cutsite, pred_del_df, total_phi_score, model)
+        )
 
-    # Make predictions
-    pred_del_df, total_phi_score = __predict_dels(seq, cutsite)
-    pred_df = __predict_ins(seq, cutsite, pred_del_df, total_phi_score)
-    pred_df["Predicted frequency"] *= 100
+    # Make insertion predictions and build stats
+    if valid:
+        rates_1bpins = model.rate_model.predict(np.array(onebp_features))
+    for jdx, (idx, seq, cutsite) in enumerate(valid):
+        pred_del_df, total_phi_score = pred_dels[jdx]
+        pred_df = __predict_ins(
+            seq, cutsite, pred_del_df, float(rates_1bpins[jdx]), model
+        )
+        pred_df["Predicted frequency"] *= 100
 
-    # Build stats
-    stats = __build_stats(seq, cutsite, pred_df, total_phi_score)
+        stats = __build_stats(seq, cutsite, pred_df, total_phi_score)
+        results[idx] = (pred_df, stats)
 
-    return pred_df, stats
+    return results
 
 
 ##
@@ -573,12 +611,12 @@ def add_mhless_genotypes(pred_df, stats, length_cutoff=None):
 ##
 # Init
 ##
-def init_model(run_iter="aax", param_iter="aag", celltype="mESC"):
-    global init_flag
-    if init_flag != False:
-        return
-
-    # print('Initializing model %s/%s, %s...' % (run_iter, param_iter, celltype))
+def load_model(run_iter="aax", param_iter="aag", celltype="mESC"):
+    # Returns the model for the cell type, unpickling its parameters
+    # the first time it's requested and reusing them afterwards
+    key = (run_iter, param_iter, celltype)
+    if key in models:
+        return models[key]
 
     model_dir = os.path.dirname(os.path.realpath(__file__))
     if sklearn.__version__ == "0.18.1":
@@ -596,20 +634,18 @@ def init_model(run_iter="aax", param_iter="aag", celltype="mESC"):
         else:
             return pickle.load(f, encoding="latin1")
 
-    global CELLTYPE
-    CELLTYPE = celltype
-
-    global nn_params
-    global nn2_params
-    with open("%s/%s_%s_nn.pkl" % (model_dir, run_iter, param_iter), "rb") as f:
-        # load in python3.6 a pickle that was dumped from python2.7
-        nn_params = version_sensitive_pickle_load(f)
-    with open("%s/%s_%s_nn2.pkl" % (model_dir, run_iter, param_iter), "rb") as f:
-        nn2_params = version_sensitive_pickle_load(f)
+    # the NN parameters don't depend on the cell type, share them if they're loaded
+    for (run, param, other), loaded in models.items():
+        if (run, param) == (run_iter, param_iter):
+            nn_params, nn2_params = loaded.nn_params, loaded.nn2_params
+            break
+    else:
+        with open("%s/%s_%s_nn.pkl" % (model_dir, run_iter, param_iter), "rb") as f:
+            # load in python3.6 a pickle that was dumped from python2.7
+            nn_params = version_sensitive_pickle_load(f)
+        with open("%s/%s_%s_nn2.pkl" % (model_dir, run_iter, param_iter), "rb") as f:
+            nn2_params = version_sensitive_pickle_load(f)
 
-    global normalizer
-    global rate_model
-    global bp_model
     with open("%s/bp_model_%s.pkl" % (model_dir, celltype), "rb") as f:
         bp_model = version_sensitive_pickle_load(f)
     with open("%s/rate_model_%s.pkl" % (model_dir, celltype), "rb") as f:
@@ -617,7 +653,37 @@ def init_model(run_iter="aax", param_iter="aag", celltype="mESC"):
     with open("%s/Normalizer_%s.pkl" % (model_dir, celltype), "rb") as f:
         normalizer = version_sensitive_pickle_load(f)
 
-    init_flag = True
+    # the MH-less score of each deletion length (1-59) only depends on the NN
+    mhless_scores = [None]
+    for dl in range(1, 60):
+        mhless_score = __nn_function(nn2_params, np.array(dl))
+        mhless_scores.append(np.exp(mhless_score - 0.25 * dl))
+
+    models[key] = Model(
+        celltype,
+        nn_params,
+        nn2_params,
+        normalizer,
+        rate_model,
+        bp_model,
+        mhless_scores,
+    )
+    return models[key]
+
 
-    # print('Done')
+def init_model(run_iter="aax", param_iter="aag", celltype="mESC"):
+    # Sets the model predict uses by default (and the module's globals)
+    global init_flag, DEFAULT_KEY
+    global CELLTYPE, nn_params, nn2_params, normalizer, rate_model, bp_model
+
+    model = load_model(run_iter, param_iter, celltype)
+    DEFAULT_KEY = (run_iter, param_iter, celltype)
+    CELLTYPE = model.celltype
+    nn_params = model.nn_params
+    nn2_params = model.nn2_params
+    normalizer = model.normalizer
+    rate_model = model.rate_model
+    bp_model = model.bp_model
+
+    init_flag = True
     return
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3.7
+
+"""
+Caches the off-target search and scoring results of guides in the genome's database
+so guides that were found in an earlier search aren't re-aligned and re-scored.
+
+Each guide's entry is keyed on a hash of everything its results depend on: the genome build
+(the bwa index), the rgen, the guide and PAM sequences, the guide's location (its own site
+isn't counted as an off-target), the maximum number of off-targets, and the version of the
+search/scoring code and the CFD and MIT tables. Rebuilding the genome or changing any of these
+changes the keys, so stale entries are never read. Entries are stamped with the time they're
+stored and a TTL index removes them after CACHE_TTL, which also drops the stale ones.
+clearCache drops them all for a genome. A guide whose entry would exceed MongoDB's document size
+limit (e.g. tens of thousands of off-targets with no maxOffTargets) isn't cached.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sys
+
+import bson
+from bson.errors import InvalidDocument
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(dir_path, "../../helpers"))
+from Config import Config
+from pymongo import ReplaceOne
+from pymongo.errors import PyMongoError
+from score_offtargets import MIT_ALT_PAMS, MIT_WEIGHTS
+
+# bump when a change to find_offtargets or score_offtargets changes the results for a guide
+CACHE_VERSION = 3
+
+# cache entries are removed this many seconds after they're stored
+CACHE_TTL = 90 * 24 * 60 * 60
+
+# the largest document MongoDB stores
+MAX_DOCUMENT_SIZE = 16 * 1024 * 1024
+
+_scoring_version = None
+
+# the cache collections whose TTL index exists, created once per process
+indexedCaches = set()
+
+
+def scoringVersion():
+    """returns a hash of the cache version along with the CFD score tables and MIT weights"""
+    global _scoring_version
+    if _scoring_version is None:
+        version = hashlib.sha1(str(CACHE_VERSION).encode("utf-8"))
+        for table in ["mismatch_score.pkl", "pam_scores.pkl"]:
+            with open(os.path.join(dir_path, "cfd_code", table), "rb") as f:
+                version.update(f.read())
+        version.update(
+            repr((MIT_WEIGHTS, sorted(MIT_ALT_PAMS.items()))).encode("utf-8")
+        )
+        _scoring_version = version.hexdigest()
+    return _scoring_version
+
+
+def genomeBuild(genome_fa):
+    """identifies the build of the genome by the size and modification time of its bwa index"""
+    indexFile = genome_fa + ".bwt" if os.path.exists(genome_fa + ".bwt") else genome_fa
+    stat = os.stat(indexFile)
+    return str(stat.st_size) + ":" + str(stat.st_mtime_ns)
+
+
+def guideKey(guide, genome, build, rgenID, maxOffTargets):
+    """given a guide and the parameters of the search, returns the key of its cache entry"""
+    key = [
+        scoringVersion(),
+        genome,
+        build,
+        str(rgenID),
+        str(maxOffTargets) if maxOffTargets else "",
+        str(guide["guide_seq"]).upper(),
+        str(guide["pam_seq"]).upper(),
+        guide["pam_chrom"],
+        guide["strand"],
+        int(guide["guide_genomic_start"]),
+        int(guide["pam_genomic_start"]),
+    ]
+    return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def fetchCachedGuides(cacheCollection, guideDict, guideKeys):
+    """
+    given the cache collection, a dict of guides, and their keys, fills in the results of the
+    guides that are in the cache and returns a dict of the ones that aren't
+    """
+    try:
+        cached = {
+            entry["_id"]: entry["guide"]
+            for entry in cacheCollection.find(
+                {"_id": {"$in": list(guideKeys.values())}}
+            )
+        }
+    except PyMongoError as e:
+        # the search still works without the cache, it's just slower
+        logging.warning(f"Unable to read the off-target cache: {e}")
+        cached = {}
+
+    misses = {}
+    for guideID, guide in guideDict.items():
+        if guideKeys[guideID] in cached:
+            guide.update(cached[guideKeys[guideID]])
+        else:
+            misses[guideID] = guide
+
+    return misses
+
+
+def fitsInDocument(document):
+    """returns whether the document is within MongoDB's document size limit"""
+    try:
+        return len(bson.encode(document)) <= MAX_DOCUMENT_SIZE
+    except InvalidDocument:
+        return False
+
+
+def createCacheIndex(cacheCollection):
+    """creates the TTL index that removes expired entries, once per cache collection in each process"""
+    if cacheCollection.full_name in indexedCaches:
+        return
+    cacheCollection.create_index("stored", expireAfterSeconds=CACHE_TTL)
+    indexedCaches.add(cacheCollection.full_name)
+
+
+def storeGuides(cacheCollection, guideDict, guideKeys):
+    """given the cache collection and a dict of searched and scored guides, adds their results to the cache"""
+    stored = datetime.datetime.utcnow()
+    entries = []
+    for guideID, guide in guideDict.items():
+        entry = {"_id": guideKeys[guideID], "guide": guide, "stored": stored}
+        if not fitsInDocument(entry):
+            # the guide is searched again the next time it's found
+            logging.warning(f"Guide {guideID} is too large for the off-target cache")
+            continue
+        entries.append(ReplaceOne({"_id": entry["_id"]}, entry, upsert=True))
+    if not entries:
+        return
+    try:
+        createCacheIndex(cacheCollection)
+        cacheCollection.bulk_write(entries, ordered=False)
+    except (PyMongoError, InvalidDocument) as e:
+        logging.warning(f"Unable to write to the off-target cache: {e}")
+
+
+def clearCache(genome):
+    """drops all the cached off-target results for the genome"""
+    dbConnection = Config(genome)
+    dbConnection.offTargetCache.drop()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Requires a genome, clears the cached off-target results for the genome")
+    else:
+        clearCache(sys.argv[1])
+
+
+if __name__ == "__main__":
+    main()
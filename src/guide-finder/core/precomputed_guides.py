@@ -0,0 +1,188 @@
+#!/usr/bin/env python3.7
+
+"""
+Lookup table of guides precomputed by PrecomputeGuides.py, stored in the genome's database.
+
+Every guide found in a precomputed region is stored as a record holding its searched and scored
+results, indexed by the rgen, protospacer length, max off-targets and its position on the genome.
+The regions themselves are stored separately once all their guides are written, so a search
+region is only served from the table if it lies entirely within a precomputed region (and so
+all of its guides are present). Records are tagged with the genome build and scoring version
+of the off-target cache, a rebuilt genome or updated scoring falls back to the live search.
+A guide whose record would exceed MongoDB's document size limit isn't stored, and neither are
+the regions containing it, so they're always searched live.
+"""
+
+import logging
+import os
+import sys
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(dir_path, "../../helpers"))
+import offtarget_cache
+from Config import Config
+from pymongo import ASCENDING, InsertOne
+from pymongo.errors import PyMongoError
+
+
+def indexParameters(rgenID, guideLength, maxOffTargets, genome_fa):
+    """given the search inputs, returns the fields identifying the guides precomputed with them"""
+    return {
+        "rgenID": str(rgenID),
+        "guideLength": int(guideLength),
+        "maxOffTargets": str(maxOffTargets) if maxOffTargets else "",
+        "build": offtarget_cache.genomeBuild(genome_fa),
+        "version": offtarget_cache.scoringVersion(),
+    }
+
+
+def pamExtent(guide):
+    """returns the first and last (1-based) positions of the guide's PAM"""
+    pamStart = int(guide["pam_genomic_start"])
+    if guide["strand"] == "+":
+        return pamStart, pamStart + len(guide["pam_seq"]) - 1
+    # on the '-' strand the genomic start is the rightmost base
+    return pamStart - len(guide["pam_seq"]) + 1, pamStart
+
+
+def siteExtent(guide):
+    """returns the first and last (1-based) positions of the guide and its PAM together"""
+    guideStart = int(guide["guide_genomic_start"])
+    if guide["strand"] == "+":
+        guideEnd = guideStart + len(guide["guide_seq"]) - 1
+    else:
+        guideStart, guideEnd = guideStart - len(guide["guide_seq"]) + 1, guideStart
+    pamStart, pamEnd = pamExtent(guide)
+    return min(guideStart, pamStart), max(guideEnd, pamEnd)
+
+
+def createIndexes(dbConnection):
+    """creates the indexes the region lookups use"""
+    position = [
+        ("rgenID", ASCENDING),
+        ("guideLength", ASCENDING),
+        ("maxOffTargets", ASCENDING),
+        ("chrom", ASCENDING),
+        ("start", ASCENDING),
+    ]
+    dbConnection.precomputedGuides.create_index(position)
+    dbConnection.precomputedRegions.create_index(position)
+
+
+def clearStale(dbConnection, parameters):
+    """drops the records of the rgen, protospacer length, and max off-targets from other builds or scoring versions"""
+    query = {
+        "rgenID": parameters["rgenID"],
+        "guideLength": parameters["guideLength"],
+        "maxOffTargets": parameters["maxOffTargets"],
+        "$or": [
+            {"build": {"$ne": parameters["build"]}},
+            {"version": {"$ne": parameters["version"]}},
+        ],
+    }
+    dbConnection.precomputedRegions.delete_many(query)
+    dbConnection.precomputedGuides.delete_many(query)
+
+
+def coveredRegions(dbConnection, parameters):
+    """returns the set of (chrom, start, end) regions already precomputed with the parameters"""
+    return {
+        (region["chrom"], region["start"], region["end"])
+        for region in dbConnection.precomputedRegions.find(
+            parameters, {"chrom": 1, "start": 1, "end": 1}
+        )
+    }
+
+
+def storeRegions(dbConnection, parameters, regions, guides):
+    """
+    given the regions (chrom, start, end) that were searched and all their searched and scored guides,
+    stores a record for each guide followed by the regions
+    """
+    records = []
+    unstored = []
+    for guide in guides:
+        start, end = siteExtent(guide)
+        record = dict(parameters)
+        record.update(
+            {
+                "chrom": guide["pam_chrom"],
+                "start": start,
+                "end": end,
+                "guide": guide,
+            }
+        )
+        if offtarget_cache.fitsInDocument(record):
+            records.append(InsertOne(record))
+        else:
+            unstored.append((guide["pam_chrom"], start, end))
+    if records:
+        dbConnection.precomputedGuides.bulk_write(records, ordered=False)
+
+    # the regions are written last, a region is never served before all of its guides are stored
+    regionRecords = []
+    for chrom, start, end in regions:
+        if any(
+            guideChrom == chrom and guideStart <= end and start <= guideEnd
+            for guideChrom, guideStart, guideEnd in unstored
+        ):
+            logging.warning(
+                f"Region {chrom}:{start}-{end} has guides too large to store, it's searched live"
+            )
+            continue
+        record = dict(parameters)
+        record.update({"chrom": chrom, "start": start, "end": end})
+        regionRecords.append(record)
+    if regionRecords:
+        dbConnection.precomputedRegions.insert_many(regionRecords)
+
+
+def lookupRegion(dbConnection, parameters, chrom, start, end):
+    """
+    given the parameters of a search and its region (1-based, inclusive), returns the guides in the region
+    keyed and ordered as find_grna_in_sequence would have, or None if the region hasn't been precomputed
+    """
+    try:
+        query = dict(parameters)
+        query.update({"chrom": chrom, "start": {"$lte": start}, "end": {"$gte": end}})
+        if dbConnection.precomputedRegions.find_one(query, {"_id": 1}) is None:
+            return None
+
+        query = dict(parameters)
+        query.update({"chrom": chrom, "start": {"$gte": start}, "end": {"$lte": end}})
+        records = list(dbConnection.precomputedGuides.find(query, {"guide": 1}))
+    except PyMongoError as e:
+        # the live search doesn't need the table
+        logging.warning(f"Unable to read the precomputed guides: {e}")
+        return None
+
+    # the PAM sites are scanned from the start of the region with the '+' strand first at each position
+    guides = sorted(
+        (record["guide"] for record in records),
+        key=lambda guide: (pamExtent(guide)[0], guide["strand"] == "-"),
+    )
+    guideDict = {}
+    for guide in guides:
+        guideDict[str(int(guide["pam_genomic_start"]) - start) + guide["strand"]] = (
+            guide
+        )
+
+    return guideDict
+
+
+def clearTable(genome):
+    """drops all the precomputed guides and regions of the genome"""
+    dbConnection = Config(genome)
+    dbConnection.precomputedRegions.drop()
+    dbConnection.precomputedGuides.drop()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Requires a genome, clears the precomputed guides of the genome")
+    else:
+        clearTable(sys.argv[1])
+
+
+if __name__ == "__main__":
+    main()
@@ -7,22 +7,61 @@ Accepts a dictionary of potential guides and their off-targets along with the rg
 depending on the rgen and appends each off-target with its score. Also adds the cumulative scores to the guide record in the dictionaries.
 
 The code to calculate the CFD score (for Cas9 RGEN) is contained within the cfd_code folder and comes directly from the authors' paper.
+
+The MIT and CFD scores of a guide's off-targets are calculated together by encoding the off-targets as an (N x L) uint8 matrix.
 """
 
 import os
 import sys
 
+import numpy as np
+
 dir_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(dir_path, "../../helpers"))
 import cfd_code.cfd_score_calculator3 as cfd
 from Config import Config
 
 sys.path.append(os.path.join(dir_path, "inDelphi-model"))
-import time
-
 import get_sequence
 import inDelphi
 
+# MIT mismatch position weights (Hsu, 2013)
+MIT_WEIGHTS = [
+    0,
+    0,
+    0.014,
+    0,
+    0,
+    0.395,
+    0.317,
+    0,
+    0.389,
+    0.079,
+    0.445,
+    0.508,
+    0.613,
+    0.851,
+    0.732,
+    0.828,
+    0.615,
+    0.804,
+    0.685,
+    0.583,
+]
+
+# MIT activity ratios of the alternative pams, keyed by their last 2 bases
+MIT_ALT_PAMS = {"AG": 0.26, "CG": 0.11, "GA": 0.07}
+
+# maps the ascii code of a base to its index in the CFD lookup table, N and any other character
+# (e.g. the IUPAC codes of some assemblies) are 4
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+BASE_CODES[np.frombuffer(cfd.BASES.encode("ascii"), dtype=np.uint8)] = range(4)
+
+# cell type of the inDelphi model the guides are scored with
+INDELPHI_CELLTYPE = "mESC"
+
+_cfd_lookup = None
+
 
 def getRgenRecord(rgenID):
     dbConnection = Config()
@@ -38,9 +77,12 @@ def getRgenRecord(rgenID):
         return
 
 
-def inDelphiScore(
-    guideDict, genome_fa, twoBitToFa_path, genome_2bit, tempfiles_path, cleaves
-):
+def inDelphiModel():
+    """returns the inDelphi model, loaded once per process and kept in inDelphi's model registry"""
+    return inDelphi.load_model(celltype=INDELPHI_CELLTYPE)
+
+
+def inDelphiScore(guideDict, genome_2bit, cleaves):
     """
     Given a dict of guides, calculate the inDelphi score of each guide and adds this information to the dictionary
 
@@ -51,8 +93,11 @@ def inDelphiScore(
     """
     import math
 
-    inDelphi.init_model(celltype="mESC")
+    model = inDelphiModel()
 
+    cleavePos = int(str(cleaves)[2:-2])
+    # the region around the cutsite of each guide, fetched together once they're all known
+    regions = {}
     for guideID, guide in guideDict.items():
         if guide["max_exceeded"]:
             guide["Precision"] = "0"
@@ -64,74 +109,148 @@ def inDelphiScore(
             guide["Frameshift Frequency"] = "-1"
             guide["MH Strength"] = "0"
 
-        # TODO: NEED TO REPLACE NEXT LINE
-        # the last term should be replaced with ~20 bps after the cutsite
-        # get this via the get_sequence code
-        # print(guide['guide_seq'])
-
-        cleavePos = int(str(cleaves)[2:-2])
-        # print(cleavePos)
-        # get strand
-        # print(guide['strand'])
-        # apply strand logic to coordinates before submitting to get_sequence.py
+        # apply strand logic to the coordinates of the sequence (1-based, inclusive)
         if guide["strand"] == "+":
-            coords = str(
-                "%s:%s-%s"
-                % (
-                    guide["pam_chrom"],
-                    guide["guide_genomic_start"],
-                    (guide["pam_genomic_start"] + cleavePos + 20),
-                )
+            regions[guideID] = (
+                guide["pam_chrom"],
+                int(guide["guide_genomic_start"]),
+                int(guide["pam_genomic_start"]) + cleavePos + 20,
             )
         elif guide["strand"] == "-":
-            coords = str(
-                "%s:%s-%s"
-                % (
-                    guide["pam_chrom"],
-                    (guide["pam_genomic_start"] - len(guide["guide_seq"]) + 3),
-                    (guide["pam_genomic_start"] + 1 + cleavePos + 22),
-                )
+            regions[guideID] = (
+                guide["pam_chrom"],
+                int(guide["pam_genomic_start"]) - len(guide["guide_seq"]) + 3,
+                int(guide["pam_genomic_start"]) + 1 + cleavePos + 22,
             )
-        # coords=str("%s:%s-%s"%(guide['pam_chrom'],guide['guide_genomic_start'],(guide['pam_genomic_start']+cleavePos+20)))
-
-        # print(coords)
 
-        timestr = time.strftime("%Y%m%d-%H%M%S")
-        get_sequence.fetch_sequence(
-            coords, genome_2bit, os.path.join(tempfiles_path, timestr + "_out.fa")
-        )
-        # print(os.path.join(tempfiles_path,timestr+'_out.fa'))
-
-        # get flanking sequence before and after cutsite
-        fullSeq = ""
-        with open(os.path.join(tempfiles_path, timestr + "_out.fa"), "r") as f:
-            for line in f:
-                if line.startswith(">"):
-                    location = line.strip()
-                    location = location[1:]  # remove > marker
-                    continue
-                else:
-                    fullSeq = fullSeq + line.strip("\n")  # seq is next line after label
-
-        # set up strand complementation
-        forward_nuc = "ATGC"
-        reverse_nuc = "TACG"
-        translate_code = str.maketrans(forward_nuc, reverse_nuc)
-        if guide["strand"] == "+":
-            fullSeq = fullSeq
-        elif guide["strand"] == "-":
+    # get flanking sequence before and after cutsite
+    sequences = get_sequence.read_sequences(list(regions.values()), genome_2bit)
+
+    # set up strand complementation
+    forward_nuc = "ATGC"
+    reverse_nuc = "TACG"
+    translate_code = str.maketrans(forward_nuc, reverse_nuc)
+    queries = []
+    for guideID, fullSeq in zip(regions, sequences):
+        guide = guideDict[guideID]
+        if guide["strand"] == "-":
             fullSeq = "".join(list(reversed(fullSeq))).translate(translate_code)
 
         cutsite = len(guide["guide_seq"]) + cleavePos
-        # print(fullSeq)
+        queries.append((fullSeq, cutsite))
 
-        pred_df, stats = inDelphi.predict(fullSeq, cutsite)
+    # predict the outcomes of every guide together
+    predictions = inDelphi.predict_batch(queries, model)
+    for guideID, prediction in zip(regions, predictions):
+        guide = guideDict[guideID]
+        pred_df, stats = prediction
         guide["Precision"] = round(stats["Precision"], 2)
         guide["Frameshift Frequency"] = round(stats["Frameshift frequency"], 2)
         # from inDelphi GitHub: natural log of phi refers to microhomology strength
         guide["MH Strength"] = round(math.log(stats["Phi"]), 2)
 
 
+def encodeSequences(sequences, length):
+    """given a list of sequences of the same length, returns their upper case ascii codes as an (N x length) uint8 matrix"""
+    if not sequences:
+        return np.zeros((0, length), dtype=np.uint8)
+    for seq in sequences:
+        assert len(seq) == length, "Guide and Off-target are different lengths"
+    encoded = "".join(sequences).upper().encode("ascii")
+    return np.frombuffer(encoded, dtype=np.uint8).reshape(len(sequences), length)
+
+
+def getCfdLookup():
+    """returns the CFD position x mismatch table as a (positions x 4 x 4) array, unscored mismatches are nan"""
+    global _cfd_lookup
+    if _cfd_lookup is None:
+        lookup = cfd.get_mm_lookup()
+        _cfd_lookup = np.array(
+            [[[np.nan if x is None else x for x in row] for row in p] for p in lookup],
+            dtype=np.float64,
+        )
+    return _cfd_lookup
+
+
+def cfdOffTargetScores(guideSeq, offtargets):
+    """
+    returns the CFD score of each off-target of the guide, or None for off-targets containing Ns (or other ambiguous bases).
+    The mismatch factors are multiplied one position at a time so the scores are identical to cfd.calc_cfd
+    """
+    mm_scores, pam_scores = cfd.get_mm_pam_scores()
+    lookup = getCfdLookup()
+    guideCodes = BASE_CODES[encodeSequences([guideSeq], len(guideSeq))[0]]
+    offCodes = BASE_CODES[
+        encodeSequences([x["seq"] for x in offtargets], len(guideSeq))
+    ]
+    hasN = (offCodes == 4).any(axis=1)
+    if hasN.all():
+        return [None] * len(offtargets)
+    if (guideCodes > 3).any():
+        raise KeyError("Unrecognized base in guide sequence")
+    # Ns are swapped for the guide's base so the lookup works, those off-targets aren't scored
+    offCodes = np.where(offCodes == 4, guideCodes, offCodes)
+
+    scores = np.ones(len(offtargets), dtype=np.float64)
+    for i in range(len(guideSeq)):
+        factors = lookup[i, guideCodes[i], offCodes[:, i]]
+        if np.isnan(factors[~hasN]).any():
+            raise KeyError("No mismatch score for position " + str(i + 1))
+        scores *= factors
+    # only requires last 2 bases of pam
+    scores *= np.array(
+        [
+            1.0 if n else pam_scores[x["pam"][-2:].upper()]
+            for x, n in zip(offtargets, hasN)
+        ]
+    )
+
+    return [None if n else score for score, n in zip(scores.tolist(), hasN)]
+
+
+def mitOffTargetScores(guideSeq, pamSeq, offtargets):
+    """returns the MIT score of each off-target of the guide, with the reduction for alternative pams applied"""
+    length = len(guideSeq)
+    guideCodes = np.frombuffer(guideSeq.encode("ascii"), dtype=np.uint8)
+    mismatches = encodeSequences([x["seq"] for x in offtargets], length) != guideCodes
+
+    # multiply the weights position by position, in the same order as the per-base loop did
+    weight = np.ones(len(offtargets), dtype=np.float64)
+    for i in range(length):
+        weight[mismatches[:, i]] *= 1 - MIT_WEIGHTS[i]
+
+    # mean distance between subsequent mismatches is (last - first) / (count - 1)
+    count = mismatches.sum(axis=1)
+    first = mismatches.argmax(axis=1)
+    last = length - 1 - mismatches[:, ::-1].argmax(axis=1)
+    distance = np.zeros(len(offtargets), dtype=np.float64)
+    several = count > 1
+    distance[several] = (last[several] - first[several]) / (count[several] - 1)
+
+    # calculate term to multiply weight by
+    multiplier = ((19 - distance) / float(19) * 4) + 1
+    multiplier = 1.0 / multiplier
+    multiplier = multiplier * (1.0 / np.maximum(count, 1) ** 2)
+    scores = weight * multiplier * 100
+
+    # reduce scores for alternative PAMS
+    guidePam = str(pamSeq[-2:]).upper()
+    result = []
+    for offtarget, score, numMismatches in zip(
+        offtargets, scores.tolist(), count.tolist()
+    ):
+        offPam = offtarget["pam"][-2:].upper()
+        if numMismatches == 0:
+            score = 1  # no mismatches gets score of 1
+        if guidePam != offPam:
+            if offPam not in MIT_ALT_PAMS:
+                raise ValueError("Unrecognized PAM sequence")
+            score = score * MIT_ALT_PAMS[offPam]
+        result.append(score)
+
+    return result
+
+
 def cfdScore(guideDict):
     """
     Given a dict of guides, calculates the CFD score of each of the off-targets as well as the cumulative CFD score
@@ -140,7 +259,6 @@ def cfdScore(guideDict):
     Method: Doench, 2016 (https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4744125)
     Code Included in Supplementary Materials
     """
-    mm_scores, pam_scores = cfd.get_mm_pam_scores()
     for guideID, guide in guideDict.items():
         if guide["max_exceeded"]:
             # don't report aggregated CFD score if off target list was truncated
@@ -149,17 +267,14 @@ def cfdScore(guideDict):
         elif guide["skip"]:
             guide["CFD"] = "-1"  # show below max_exceeded
 
-        guideSeq = str(guide["guide_seq"])
+        # cfd scores can't be calculated for offtargets with Ns
         cumulative_score = []
-        for offtarget in guide["offtargets"]:
-            if "N" in offtarget["seq"].upper():
-                offtarget["CFD"] = None
-                continue  # cfd scores can't be calculated for offtargets with Ns
-            offSeq = offtarget["seq"].upper()
-            offPam = offtarget["pam"][-2:].upper()  # only requires last 2 bases of pam
-            sub_score = cfd.calc_cfd(guideSeq, offSeq, offPam)
-            offtarget["CFD"] = str(round(sub_score, 2))
-            cumulative_score.append(sub_score)
+        offtargets = guide["offtargets"]
+        scores = cfdOffTargetScores(str(guide["guide_seq"]), offtargets)
+        for offtarget, sub_score in zip(offtargets, scores):
+            offtarget["CFD"] = None if sub_score is None else str(round(sub_score, 2))
+            if sub_score is not None:
+                cumulative_score.append(sub_score)
 
         aggregate_score = 100 / (100 + sum(cumulative_score))
         aggregate_score = int(round(aggregate_score * 100))
@@ -176,29 +291,6 @@ def mitScore(guideDict, rgenRecod):
     Values and scoring formula from: https://web.archive.org/web/20160825081629/http://crispr.mit.edu/about
     Using sgRNA activity ratios for alternative pams from: https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4744125
     """
-    M = [
-        0,
-        0,
-        0.014,
-        0,
-        0,
-        0.395,
-        0.317,
-        0,
-        0.389,
-        0.079,
-        0.445,
-        0.508,
-        0.613,
-        0.851,
-        0.732,
-        0.828,
-        0.615,
-        0.804,
-        0.685,
-        0.583,
-    ]
-
     for guideID, guide in guideDict.items():
         if guide["max_exceeded"]:
             # don't calculate MIT score if off target list was truncated
@@ -208,56 +300,12 @@ def mitScore(guideDict, rgenRecod):
             guide["MIT"] = "-1"  # show below max_exceeded
             continue
 
-        guideSeq = str(guide["guide_seq"])
-        cumulative_score = []
-        for offtarget in guide["offtargets"]:
-            offSeq = offtarget["seq"].upper()
-            offPam = offtarget["pam"].upper()
-            assert len(guideSeq) == len(
-                offSeq
-            ), "Guide and Off-target are different lengths"
-            score = 0
-            mismatches = []
-            weight = 1.0
-            for i in range(0, len(guideSeq)):
-                if str(guideSeq[i]) != str(offSeq[i]):
-                    mismatches.append(i)
-                    weight *= 1 - M[i]
-
-            if len(mismatches) == 0:
-                # no mismatches gets score of 1
-                score = 1
-            else:
-                # calculate mean distance between subsequent mismatches
-                try:
-                    distance = sum(
-                        [b - a for a, b in zip(mismatches, mismatches[1:])]
-                    ) / (len(mismatches) - 1)
-                except ZeroDivisionError:
-                    # handle only one mismatch
-                    distance = 0
-
-                # calculate term to multiply weight by
-                multiplier = ((19 - distance) / float(19) * 4) + 1
-                multiplier = 1.0 / multiplier
-                multiplier = multiplier * (1.0 / (len(mismatches) ** 2))
-
-                score = weight * multiplier * 100
-
-            # reduce scores for alternative PAMS
-            if str(guide["pam_seq"][-2:]).upper() != offPam[-2:].upper():
-                if offPam[-2:].upper() == "AG":
-                    score = score * 0.26
-                elif offPam[-2:].upper() == "CG":
-                    score = score * 0.11
-                elif offPam[-2:].upper() == "GA":
-                    score = score * 0.07
-                else:
-                    raise ValueError("Unrecognized PAM sequence")
-
-            # guide['offtargets'][i]['MIT'] = str(score)
+        offtargets = guide["offtargets"]
+        cumulative_score = mitOffTargetScores(
+            str(guide["guide_seq"]), guide["pam_seq"], offtargets
+        )
+        for offtarget, score in zip(offtargets, cumulative_score):
             offtarget["MIT"] = str(round(score, 2))  # store shorter
-            cumulative_score.append(score)
 
         aggregate_score = 100 / (100 + sum(cumulative_score))
         aggregate_score = int(round(aggregate_score * 100))
@@ -296,14 +344,7 @@ def scoreOffTargets(
         if "CFD" in scores:
             cfdScore(guideDict)
         if "inDelphi" in scores:
-            inDelphiScore(
-                guideDict,
-                genome_fa,
-                twoBitToFa_path,
-                genome_2bit,
-                tempfiles_path,
-                cleaves,
-            )
+            inDelphiScore(guideDict, genome_2bit, cleaves)
 
     defaultRank(guideDict)
     return guideDict
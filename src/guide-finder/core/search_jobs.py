@@ -0,0 +1,277 @@
+#!/usr/bin/env python3.7
+
+"""
+Spool of the guide search jobs run in the background by GuideSearchWorker.py
+
+A search submitted through GuideSearchAndScore.py is written to its own directory, named by its
+batchID, and queued. A worker claims it by moving its queue entry into the job's directory (a
+rename, so only one worker can claim each job), runs the search, and writes the resulting HTML.
+While the search runs, the [STARTED]/[FINISHED] timings it logs are recorded as its stages in
+the job's status, which GuideSearchAndScore.py reports to the page polling for the results.
+The status of a claimed or running job records the pid of its worker, so a job whose worker
+died is marked as failed rather than left running, and jobs that never finish are removed after
+JOB_TTL like finished ones.
+
+The workers run as the web server's user, so the spool is only accessible to that user and its
+group. An existing spool directory is only used if it's owned by the user (not one created by
+another to plant links in), and files are written through new temporary files, never by
+following an existing name.
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from stat import S_ISDIR
+
+JOB_DIRECTORY = os.path.join(tempfile.gettempdir(), "forcast_jobs")
+QUEUE_DIRECTORY = os.path.join(JOB_DIRECTORY, "queue")
+WORKER_DIRECTORY = os.path.join(JOB_DIRECTORY, "workers")
+# a worker that hasn't marked itself as running within this many seconds is considered stopped
+WORKER_TIMEOUT = 30
+# finished jobs, and jobs submitted this many seconds ago that never finished, are removed
+JOB_TTL = 24 * 60 * 60
+
+stageMessage = re.compile(r"^(\t*)\[(STARTED|FINISHED)\]\t+(.*)$")
+batchIDFormat = re.compile(r"^[0-9a-f]{18}\Z")
+
+
+def jobPath(batchID, filename=""):
+    """returns the path of the job's directory, or of the given file in it"""
+    if not batchIDFormat.match(str(batchID)):
+        raise ValueError(f"Invalid job ID: {batchID}")
+    return os.path.join(JOB_DIRECTORY, batchID, filename)
+
+
+def makeDirectory(path):
+    """
+    creates a directory of the spool for the web server's user and group, raises OSError if the
+    path exists but isn't a directory owned by the user
+    """
+    try:
+        os.mkdir(path, 0o770)
+    except FileExistsError:
+        pass
+    stat = os.lstat(path)
+    if not S_ISDIR(stat.st_mode) or stat.st_uid != os.getuid():
+        raise OSError(f"{path} isn't a directory owned by the search's user")
+
+
+def writeFile(path, text):
+    """writes the text to a new temporary file and moves it into place, so it's never read half written"""
+    fd, tempPath = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        os.fchmod(fd, 0o660)
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write(text)
+        os.replace(tempPath, path)
+    except BaseException:
+        os.remove(tempPath)
+        raise
+
+
+def writeJson(path, data):
+    """writes the json to its file"""
+    writeFile(path, json.dumps(data))
+
+
+def submitJob(batchID, parameters):
+    """given the batchID and the parameters of a web search, writes the job and adds it to the queue"""
+    makeDirectory(JOB_DIRECTORY)
+    makeDirectory(QUEUE_DIRECTORY)
+    makeDirectory(jobPath(batchID))
+    writeJson(jobPath(batchID, "request.json"), parameters)
+    writeStatus(batchID, {"state": "queued", "submitted": time.time(), "stages": []})
+    # queue entries are named by submission time so they're claimed in order
+    writeJson(
+        os.path.join(QUEUE_DIRECTORY, f"{time.time():017.6f}_{batchID}.json"),
+        {"batchID": batchID},
+    )
+
+
+def claimJob():
+    """claims the oldest queued job and returns its batchID and parameters, or None if the queue is empty"""
+    if not os.path.isdir(QUEUE_DIRECTORY):
+        return None
+    for entry in sorted(os.listdir(QUEUE_DIRECTORY)):
+        if not entry.endswith(".json"):
+            continue
+        batchID = entry[:-5].split("_", 1)[1]
+        try:
+            os.rename(
+                os.path.join(QUEUE_DIRECTORY, entry), jobPath(batchID, "claimed.json")
+            )
+        except (FileNotFoundError, ValueError):
+            # claimed by another worker first, or not a job
+            continue
+        # recorded so the job is failed if the worker stops before it runs it
+        status = readStatus(batchID) or {"submitted": time.time(), "stages": []}
+        status.pop("position", None)
+        status.update({"state": "claimed", "worker": os.getpid()})
+        writeStatus(batchID, status)
+        with open(jobPath(batchID, "request.json")) as json_file:
+            return batchID, json.load(json_file)
+    return None
+
+
+def queuePosition(batchID):
+    """returns the number of jobs queued ahead of the job"""
+    if not os.path.isdir(QUEUE_DIRECTORY):
+        return 0
+    entries = sorted(os.listdir(QUEUE_DIRECTORY))
+    for position, entry in enumerate(entries):
+        if entry.endswith("_" + batchID + ".json"):
+            return position
+    return 0
+
+
+def readStatus(batchID):
+    """returns the status of the job, or None if there's no such job"""
+    try:
+        with open(jobPath(batchID, "status.json")) as json_file:
+            status = json.load(json_file)
+    except (FileNotFoundError, ValueError):
+        return None
+    if status["state"] == "queued":
+        status["position"] = queuePosition(batchID)
+    return status
+
+
+def writeStatus(batchID, status):
+    writeJson(jobPath(batchID, "status.json"), status)
+
+
+def readResult(batchID):
+    """returns the HTML the job's search produced, or None if it hasn't finished"""
+    try:
+        with open(jobPath(batchID, "result.html")) as html_file:
+            return html_file.read()
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def finishJob(batchID, status, html):
+    """writes the result of the search before marking the job finished"""
+    writeFile(jobPath(batchID, "result.html"), html)
+    status["finished"] = time.time()
+    writeStatus(batchID, status)
+
+
+def markWorker(workerID):
+    """records that the worker is running, whether it's checking the queue or running a search"""
+    makeDirectory(JOB_DIRECTORY)
+    makeDirectory(WORKER_DIRECTORY)
+    writeFile(os.path.join(WORKER_DIRECTORY, str(workerID)), str(time.time()))
+
+
+def workersRunning():
+    """returns True if a worker has marked itself as running recently"""
+    if not os.path.isdir(WORKER_DIRECTORY):
+        return False
+    for worker in os.listdir(WORKER_DIRECTORY):
+        try:
+            if (
+                time.time() - os.path.getmtime(os.path.join(WORKER_DIRECTORY, worker))
+                < WORKER_TIMEOUT
+            ):
+                return True
+        except FileNotFoundError:
+            continue
+    return False
+
+
+def processRunning(pid):
+    """returns True if there's a running process with the pid"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running as another user
+        return True
+    return True
+
+
+def removeExpiredJobs():
+    """
+    removes the directories of jobs finished, or submitted and never finished, more than JOB_TTL
+    seconds ago (along with their queue entry), and marks the claimed and running jobs whose worker
+    has stopped as failed
+    """
+    if not os.path.isdir(JOB_DIRECTORY):
+        return
+    for batchID in os.listdir(JOB_DIRECTORY):
+        if not batchIDFormat.match(batchID):
+            continue
+        status = readStatus(batchID)
+        if not status:
+            continue
+        if (
+            "finished" not in status
+            and time.time() - status.get("submitted", 0) > JOB_TTL
+        ):
+            if os.path.isdir(QUEUE_DIRECTORY):
+                for entry in os.listdir(QUEUE_DIRECTORY):
+                    if entry.endswith("_" + batchID + ".json"):
+                        try:
+                            os.remove(os.path.join(QUEUE_DIRECTORY, entry))
+                        except FileNotFoundError:
+                            # claimed in the meantime
+                            pass
+            shutil.rmtree(jobPath(batchID), ignore_errors=True)
+        elif (
+            status["state"] in ["claimed", "running"]
+            and "worker" in status
+            and not processRunning(status["worker"])
+        ):
+            status["state"] = "failed"
+            finishJob(
+                batchID,
+                status,
+                "Error: the search stopped unexpectedly, please try again",
+            )
+        elif "finished" in status and time.time() - status["finished"] > JOB_TTL:
+            shutil.rmtree(jobPath(batchID), ignore_errors=True)
+
+
+class StageLogHandler(logging.Handler):
+    """records the stages logged by a running search in its job's status"""
+
+    def __init__(self, batchID, status):
+        super().__init__()
+        self.batchID = batchID
+        self.status = status
+
+    def emit(self, record):
+        match = stageMessage.match(record.getMessage())
+        if not match:
+            return
+        tabs, event, description = match.groups()
+        # the nesting of the stages is given by their indentation
+        level = len(tabs) // 2
+        stages = self.status["stages"]
+        if event == "STARTED":
+            stages.append(
+                {
+                    "stage": description.rstrip("."),
+                    "level": level,
+                    "started": record.created,
+                    "elapsed": None,
+                }
+            )
+        else:
+            for stage in reversed(stages):
+                if stage["level"] == level and stage["elapsed"] is None:
+                    stage["elapsed"] = round(record.created - stage["started"], 4)
+                    stage["result"] = description
+                    break
+        try:
+            writeStatus(self.batchID, self.status)
+        except OSError:
+            # the search doesn't depend on its progress being reported
+            pass
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3.7
+
+"""
+Shared jinja2 environment for the guide-finder's templates (jinja2-templates/)
+
+Templates are loaded through a single environment per process, so each is read and compiled
+once and reused by every render (and by every request in a long-lived process). The compiled
+templates are also cached as bytecode on disk, so a new process only recompiles the templates
+that have changed. Like jinja2.Template, the environment doesn't autoescape.
+"""
+
+import os
+import tempfile
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(os.path.dirname(dir_path), "jinja2-templates")
+# the web server and the search workers run as different users, each gets its own cache
+BYTECODE_PATH = os.path.join(tempfile.gettempdir(), f"forcast_jinja2_{os.getuid()}")
+
+_environment = None
+
+
+def getEnvironment():
+    """returns the process's jinja2 environment, creating it on first use"""
+    global _environment
+    if _environment is None:
+        os.makedirs(BYTECODE_PATH, mode=0o700, exist_ok=True)
+        _environment = Environment(
+            loader=FileSystemLoader(TEMPLATE_PATH),
+            bytecode_cache=FileSystemBytecodeCache(BYTECODE_PATH),
+            autoescape=False,
+        )
+    return _environment
+
+
+def render(template_name, template_values=None, **kwargs):
+    """given the name of a template in jinja2-templates, renders it with the values and returns the result"""
+    template = getEnvironment().get_template(template_name)
+    return template.render(template_values or {}, **kwargs)
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3.7
+
+"""
+Persistent WSGI application serving FORCAST's CGI endpoints
+
+Started as its own process, a CGI script costs its imports (pymongo, jinja2, and for the guide
+search pandas, sklearn, scipy and the inDelphi model), config files and mongo connections on
+every request. The application instead runs the endpoint scripts inside long-lived processes:
+each request executes the script as __main__ with the CGI environment, stdin and stdout of the
+request swapped in, so the scripts and their parameters are unchanged while the modules, models
+and connections they load are kept from one request to the next.
+
+The CGI scripts themselves become shims: relayRequest() forwards the request they were started
+with to the application and writes back its response, before any of their heavy imports. If the
+application isn't running, the script carries on and handles the request itself as before.
+
+Each script runs in its own directory, as it did under CGI, and the guide search's log is written
+to the file of the day each request is handled on.
+
+Each process handles one request at a time, so at most APP_SERVER_PROCESSES requests run at once
+and the rest wait for a free process. Unlike CGI, where every request had its own process, a few
+slow requests (searches run without the search workers, primer designs) can delay every other
+endpoint, so the number of processes should cover the slow requests expected at the same time.
+
+The application listens on a unix socket (APP_SOCKET) only accessible to the web server's group
+(SOCKET_GROUP), and runs as the web server's user, so the endpoints run with the same privileges
+they had as CGI scripts.
+
+Usage: AppServer.py [number of processes]
+    defaults to APP_SERVER_PROCESSES in paths.conf
+The application can also be mounted directly in a WSGI server (e.g. mod_wsgi) as `application`.
+"""
+
+import datetime
+import grp
+import http.client
+import io
+import logging
+import os
+import re
+import runpy
+import socket
+import socketserver
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+APP_SOCKET = os.path.join(tempfile.gettempdir(), "forcast_app.sock")
+# the group allowed to connect to the application, the cgi scripts run as the web server's user
+SOCKET_GROUP = os.environ.get("FORCAST_SOCKET_GROUP", "www-data")
+# set in the application's processes, where the scripts run rather than relay
+SERVER_FLAG = "FORCAST_APP_SERVER"
+# the scripts served, relative to ROOT_PATH
+ENDPOINTS = {
+    "src/guide-finder/GuideSearchAndScore.py",
+    "src/guide-finder/GuideInitialize.py",
+    "src/guide-finder/GuideAdd.py",
+    "src/guide-finder/GuideDownload.py",
+    "src/guide-finder/GuideOffTargets.py",
+    "src/primer-design/designPrimers.py",
+    "src/primer-design/FetchAPE.py",
+}
+ENDPOINTS.update(
+    "src/primer-design/web/ajaxCalls/" + script
+    for script in [
+        "addPrimers.py",
+        "blastPrimers.py",
+        "diceyInstalled.py",
+        "fetchEnsemblRelease.py",
+        "fetchGuides.py",
+        "fetchInstalledGenomes.py",
+        "fetchPrimers.py",
+        "fetchRelease.py",
+        "generateAPE.py",
+        "generateCSV.py",
+        "generateDOC.py",
+        "manuallyAddPrimer.py",
+        "placePrimers.py",
+        "primerQA.py",
+        "updateGuideLabel.py",
+        "updateGuideNote.py",
+        "updateGuides.py",
+        "updatePrimerNotes.py",
+        "updatePrimerStatus.py",
+    ]
+)
+# modules imported before the processes are forked, so they're loaded once and shared
+PRELOAD_PATHS = ["src/helpers", "src/guide-finder/core", "src/primer-design"]
+PRELOAD_MODULES = [
+    "Config",
+    "jinja2",
+    "bson",
+    "batch_results",
+    "find_grna",
+    "get_sequence",
+    "find_offtargets",
+    "offtarget_cache",
+    "precomputed_guides",
+    "score_offtargets",
+    "categorize_offtargets",
+    "search_jobs",
+    "templates",
+    "classes.Gene",
+    "classes.Guide",
+]
+# the guide search logs to a file per day in this directory
+LOG_DIRECTORY = "/var/log/FORCAST/GuideSearchAndScore"
+# headers of the application's response not passed back by the shim
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "date", "server"}
+
+headerLine = re.compile(r"^([!#$%&'*+.^_`|~0-9A-Za-z-]+):[ \t]*(.*)$")
+
+
+def endpointPath(scriptPath):
+    """returns the script's path relative to ROOT_PATH if it's an endpoint, otherwise None"""
+    relativePath = os.path.relpath(os.path.abspath(scriptPath), ROOT_PATH)
+    return relativePath if relativePath in ENDPOINTS else None
+
+
+def relayRequest(scriptPath):
+    """
+    called by an endpoint script started as a CGI process. Forwards the request to the application
+    and writes its response as the script's output, then exits. Returns (so the script handles the
+    request itself) when not run by the web server, when already inside the application, or when
+    the application can't be reached
+    """
+    if "REQUEST_METHOD" not in os.environ or SERVER_FLAG in os.environ:
+        return
+    path = endpointPath(scriptPath)
+    if not path:
+        return
+
+    connection = UnixHTTPConnection(APP_SOCKET, timeout=1)
+    try:
+        connection.connect()
+    except OSError:
+        return
+    # scripts like the primer design can run for minutes
+    connection.sock.settimeout(None)
+
+    url = "/" + path
+    if os.environ.get("QUERY_STRING"):
+        url += "?" + os.environ["QUERY_STRING"]
+    headers = {
+        name[5:].replace("_", "-").title(): value
+        for name, value in os.environ.items()
+        if name.startswith("HTTP_")
+    }
+    if os.environ.get("CONTENT_TYPE"):
+        headers["Content-Type"] = os.environ["CONTENT_TYPE"]
+    body = b""
+    if os.environ.get("CONTENT_LENGTH"):
+        body = sys.stdin.buffer.read(int(os.environ["CONTENT_LENGTH"]))
+    headers["Content-Length"] = str(len(body))
+
+    connection.request(os.environ["REQUEST_METHOD"], url, body, headers)
+    response = connection.getresponse()
+    output = f"Status: {response.status} {response.reason}\r\n"
+    for name, value in response.getheaders():
+        if name.lower() not in HOP_HEADERS:
+            output += f"{name}: {value}\r\n"
+    sys.stdout.flush()
+    sys.stdout.buffer.write((output + "\r\n").encode("latin-1"))
+    sys.stdout.buffer.write(response.read())
+    sys.stdout.buffer.flush()
+    connection.close()
+    sys.exit()
+
+
+def runScript(path, environ, body):
+    """runs the endpoint script with the request's CGI environment and body, returns what it prints"""
+    saved = (
+        dict(os.environ),
+        list(sys.path),
+        list(sys.argv),
+        sys.stdin,
+        sys.stdout,
+        sys.__stdout__,
+        sys.excepthook,
+        os.getcwd(),
+    )
+    scriptPath = os.path.join(ROOT_PATH, path)
+    output = io.BytesIO()
+    stdout = io.TextIOWrapper(output, encoding="utf-8", write_through=True)
+
+    os.environ.clear()
+    os.environ.update(
+        (name, value) for name, value in environ.items() if isinstance(value, str)
+    )
+    os.environ[SERVER_FLAG] = "1"
+    sys.path.insert(0, os.path.dirname(scriptPath))
+    sys.argv = [scriptPath]
+    sys.stdin = io.TextIOWrapper(io.BytesIO(body), encoding="utf-8")
+    sys.stdout = sys.__stdout__ = stdout
+    # the scripts use paths relative to their own directory, which CGI ran them in
+    os.chdir(os.path.dirname(scriptPath))
+    try:
+        runpy.run_path(scriptPath, run_name="__main__")
+    except SystemExit:
+        pass
+    except Exception:
+        logging.exception(f"Error running {path}")
+        if sys.excepthook is not sys.__excepthook__:
+            # the script enabled cgitb, which writes the traceback page as it would have
+            sys.excepthook(*sys.exc_info())
+        elif not output.getvalue():
+            stdout.write(
+                "Status: 500 Internal Server Error\nContent-Type: text/html\n\n"
+            )
+    finally:
+        sys.stdout.flush()
+        os.environ.clear()
+        os.environ.update(saved[0])
+        sys.path[:] = saved[1]
+        (
+            sys.argv,
+            sys.stdin,
+            sys.stdout,
+            sys.__stdout__,
+            sys.excepthook,
+        ) = saved[2:7]
+        os.chdir(saved[7])
+
+    return output.getvalue()
+
+
+def parseOutput(output):
+    """given the output of a CGI script, returns its status, headers, and body"""
+    ends = [
+        (output.find(separator), separator)
+        for separator in (b"\r\n\r\n", b"\n\n")
+        if separator in output
+    ]
+    if not ends:
+        return "500 Internal Server Error", [], b"Malformed script headers"
+    end, separator = min(ends)
+
+    status = "200 OK"
+    headers = []
+    for line in output[:end].decode("latin-1").splitlines():
+        match = headerLine.match(line.strip("\r"))
+        if not match:
+            return "500 Internal Server Error", [], b"Malformed script headers"
+        name, value = match.groups()
+        if name.lower() == "status":
+            status = value
+        else:
+            headers.append((name, value))
+
+    return status, headers, output[end + len(separator) :]
+
+
+def application(environ, start_response):
+    """WSGI entry point, runs the endpoint script requested"""
+    path = os.path.normpath(environ.get("PATH_INFO", "/")).lstrip("/")
+    if path not in ENDPOINTS:
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Not Found"]
+
+    body = b""
+    if environ.get("CONTENT_LENGTH"):
+        body = environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"]))
+    environ = dict(environ, SCRIPT_NAME="/" + path, SCRIPT_FILENAME=path, PATH_INFO="")
+
+    # the processes outlive the day they were started, so the log file is opened per request
+    logHandler = datedLogHandler()
+    logging.getLogger().addHandler(logHandler)
+    try:
+        time_0 = time.time()
+        status, headers, content = parseOutput(runScript(path, environ, body))
+        logging.debug(
+            f"[APP]\t\t{environ['REQUEST_METHOD']} {path} {status} in {str(round(time.time()-time_0,4))}s"
+        )
+    finally:
+        logging.getLogger().removeHandler(logHandler)
+        logHandler.close()
+
+    headers.append(("Content-Length", str(len(content))))
+    start_response(status, headers)
+    return [content]
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """http connection to the application's unix socket"""
+
+    def __init__(self, socketPath, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socketPath = socketPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(self.socketPath)
+        except OSError:
+            self.sock.close()
+            raise
+
+
+class UnixWSGIServer(WSGIServer):
+    """WSGI server listening on a unix socket only accessible to SOCKET_GROUP"""
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            # left behind by a server that wasn't shut down cleanly
+            os.remove(self.server_address)
+        # created without any access for others, rather than restricted once it exists
+        umask = os.umask(0o117)
+        try:
+            socketserver.TCPServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        try:
+            os.chown(self.server_address, -1, grp.getgrnam(SOCKET_GROUP).gr_gid)
+        except KeyError:
+            logging.warning(
+                f"No group {SOCKET_GROUP}, only the server's own group can connect"
+            )
+        self.server_name = "localhost"
+        self.server_port = 0
+        self.setup_environ()
+
+
+class QuietHandler(WSGIRequestHandler):
+    """request handler that doesn't log each request to stderr"""
+
+    def setup(self):
+        super().setup()
+        # unix socket clients have no address, the requests are relayed from this host
+        self.client_address = ("127.0.0.1", 0)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def datedLogHandler():
+    """returns a handler writing to today's guide search log"""
+    today = datetime.date.today()
+    logFile = os.path.join(
+        LOG_DIRECTORY, str(today.year), f"{today:%m}", f"{today:%d}.log"
+    )
+    os.makedirs(os.path.dirname(logFile), exist_ok=True)
+    return logging.FileHandler(logFile)
+
+
+def removeDatedLogHandlers():
+    """removes the handlers of the guide search log the modules added when they were imported"""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.FileHandler) and handler.baseFilename.startswith(
+            LOG_DIRECTORY + os.sep
+        ):
+            root.removeHandler(handler)
+            handler.close()
+
+
+def preload():
+    """imports the modules the endpoints use and loads the inDelphi model"""
+    for path in PRELOAD_PATHS:
+        sys.path.append(os.path.join(ROOT_PATH, path))
+    for module in PRELOAD_MODULES:
+        try:
+            __import__(module)
+        except Exception as e:
+            logging.warning(f"Unable to preload {module}: {e}")
+    try:
+        import score_offtargets
+
+        score_offtargets.inDelphiModel()
+    except Exception as e:
+        logging.warning(f"Unable to preload the inDelphi model: {e}")
+    # replaced by the handler of each request's day
+    removeDatedLogHandlers()
+
+
+def main():
+    if len(sys.argv) > 1:
+        processes = int(sys.argv[1])
+    else:
+        from Config import Config
+
+        processes = Config().APP_SERVER_PROCESSES
+
+    os.environ[SERVER_FLAG] = "1"
+    preload()
+    # each process handles one request at a time from the shared socket, so the number of
+    # processes is the number of requests handled at once
+    server = UnixWSGIServer(APP_SOCKET, QuietHandler)
+    server.set_app(application)
+    pool = [Process(target=server.serve_forever, daemon=True) for i in range(processes)]
+    for worker in pool:
+        worker.start()
+    while True:
+        # replace any process that died
+        for i, worker in enumerate(pool):
+            if not worker.is_alive():
+                pool[i] = Process(target=server.serve_forever, daemon=True)
+                pool[i].start()
+        time.sleep(5)
+
+
+if __name__ == "__main__":
+    main()
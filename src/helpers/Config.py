@@ -13,6 +13,11 @@ from urllib.parse import quote
 
 from pymongo import MongoClient
 
+# connections and files shared by every Config created in the process, so a long-running process
+# (AppServer.py, the search workers) doesn't reconnect or reread them for each request
+_clients = {}
+_chromSizes = {}
+
 
 class Config:
     def __init__(self, genome=None):
@@ -31,15 +36,8 @@ class Config:
         self.PRIMER3_DIR = os.path.join(
             self.ROOT_PATH, "src/primer-design/files/primer3Files"
         )
-        if self.config:
-            # if credentials are set, connect to mongodb using them
-            self.client = MongoClient(
-                "mongodb://%s:%s@localhost"
-                % (self.config["username"], self.config["password"])
-            )
-        else:
-            # generically connect to db
-            self.client = MongoClient()
+        # connect to mongodb (using the credentials if they're set)
+        self.client = getClient(self.config)
         # get the rgen collection (genome agnostic)
         self.rgenCollection = self.getRGENs()
 
@@ -53,6 +51,9 @@ class Config:
                 guideCollection,
                 primerCollection,
                 metadataCollection,
+                offTargetCache,
+                precomputedGuides,
+                precomputedRegions,
             ) = self.getAttributes()
             self.mongoDB = mongoDB
             self.release = release
@@ -60,11 +61,22 @@ class Config:
             self.guideCollection = guideCollection
             self.primerCollection = primerCollection
             self.metadataCollection = metadataCollection
+            self.offTargetCache = offTargetCache
+            self.precomputedGuides = precomputedGuides
+            self.precomputedRegions = precomputedRegions
             self.rgenCollection = self.getRGENs()
             self.organismName = self.getOrgName()
             self.chromSizes = self.getChromSizes()
 
     def setPaths(self):
+        self.BLAST = self.PRIMER3 = self.PRIMER3_CONFIG = ""
+        # threads per bwa aln search (shared between its shards) and the number of shards to align large batches in
+        self.BWA_THREADS = 2
+        self.BWA_SHARDS = 1
+        # number of processes running queued guide searches
+        self.SEARCH_WORKERS = 2
+        # number of processes of the application server (AppServer.py)
+        self.APP_SERVER_PROCESSES = 4
         f = open(os.path.join(self.ROOT_PATH, "config/paths.conf"))
         for line in f:
             if re.match(r"^BLAST_EXEC=", line):
@@ -73,6 +85,14 @@ class Config:
                 self.PRIMER3 = line.split("=")[1].strip()
             elif re.match(r"^PRIMER3_CONFIG=", line):
                 self.PRIMER3_CONFIG = line.split("=")[1].strip()
+            elif re.match(r"^BWA_THREADS=", line):
+                self.BWA_THREADS = max(1, int(line.split("=")[1].strip()))
+            elif re.match(r"^BWA_SHARDS=", line):
+                self.BWA_SHARDS = max(1, int(line.split("=")[1].strip()))
+            elif re.match(r"^SEARCH_WORKERS=", line):
+                self.SEARCH_WORKERS = max(1, int(line.split("=")[1].strip()))
+            elif re.match(r"^APP_SERVER_PROCESSES=", line):
+                self.APP_SERVER_PROCESSES = max(1, int(line.split("=")[1].strip()))
 
         if not self.BLAST:
             print("Error: path to BLAST executable not defined in paths.conf")
@@ -91,13 +111,20 @@ class Config:
 
     def getChromSizes(self):
         """return a paired list of all the available chromosomes for the organism along with their sizes"""
+        refSeqs = os.path.join(
+            self.ROOT_PATH, "jbrowse/data/" + self.genome, "seq/refSeqs.json"
+        )
+        # reuse the sizes already read unless the file has changed since
+        try:
+            modified = os.path.getmtime(refSeqs)
+        except OSError:
+            modified = None
+        if refSeqs in _chromSizes and _chromSizes[refSeqs][0] == modified:
+            return dict(_chromSizes[refSeqs][1])
+
         # check that the file exists
         try:
-            with open(
-                os.path.join(
-                    self.ROOT_PATH, "jbrowse/data/" + self.genome, "seq/refSeqs.json"
-                )
-            ) as json_file:
+            with open(refSeqs) as json_file:
                 data = json.load(json_file)
         except Exception as e:
             print(f"Error: unable to load refSeqs.json for {self.genome}")
@@ -115,21 +142,12 @@ class Config:
             except KeyError:
                 # old format had length key, catch so code runs on both
                 chr_sizes[chr["name"]] = chr["length"]
+        _chromSizes[refSeqs] = (modified, chr_sizes)
 
-        return chr_sizes
+        return dict(chr_sizes)
 
     def getAttributes(self):
-        if self.config:
-            # if credentials are set, connect to mongodb using them
-            client = MongoClient(
-                "mongodb://%s:%s@localhost"
-                % (self.config["username"], self.config["password"])
-            )
-        else:
-            # otherwise, attempt connecting without credentials
-            client = MongoClient()
-
-        db = client[self.genome]
+        db = self.client[self.genome]
         collections = db.list_collection_names()
 
         # get the release we're using from the most recent geneInfo collection
@@ -140,6 +158,9 @@ class Config:
         nameGuideCol = "gRNAResultCollection"
         namePrimerCol = "primerCollection"
         metadataCol = "metadata"
+        offTargetCacheCol = "offTargetCache"
+        precomputedGuidesCol = "precomputedGuides"
+        precomputedRegionsCol = "precomputedRegions"
 
         return (
             db,
@@ -148,6 +169,9 @@ class Config:
             db[nameGuideCol],
             db[namePrimerCol],
             db[metadataCol],
+            db[offTargetCacheCol],
+            db[precomputedGuidesCol],
+            db[precomputedRegionsCol],
         )
 
     def getOrgName(self):
@@ -210,16 +234,23 @@ def getCredentials():
     return config
 
 
-def getCurrentGeneCollection(genome):
-    # get credentials and connect to mongodb
-    config = getCredentials()
+def getClient(config):
+    """returns the process's connection to mongodb, using the credentials if they're set"""
     if config:
-        client = MongoClient(
-            "mongodb://%s:%s@localhost" % (config["username"], config["password"])
-        )
+        uri = "mongodb://%s:%s@localhost" % (config["username"], config["password"])
     else:
-        # if no credentials defined
-        client = MongoClient()
+        uri = None
+    # a client can't be shared with a forked process, so each process opens its own
+    key = (os.getpid(), uri)
+    if key not in _clients:
+        _clients[key] = MongoClient(uri) if uri else MongoClient()
+
+    return _clients[key]
+
+
+def getCurrentGeneCollection(genome):
+    # get credentials and connect to mongodb
+    client = getClient(getCredentials())
 
     db = client[genome]
     collections = db.list_collection_names()
@@ -237,13 +268,7 @@ def fetchCurrentRelease(genome, collections=None):
     # optionally, if function calling already has list of connections, they can be passed
     # otherwise, connect to mongodb and get them
     if not collections:
-        config = getCredentials()
-        if config:
-            client = MongoClient(
-                "mongodb://%s:%s@localhost" % (config["username"], config["password"])
-            )
-        else:
-            client = MongoClient()
+        client = getClient(getCredentials())
         db = client[genome]
         collections = db.list_collection_names()
 
@@ -260,13 +285,7 @@ def fetchCurrentRelease(genome, collections=None):
 
 def fetchInstalledGenomes():
     # get a list of the installed genomes in the mongodb
-    config = getCredentials()
-    if config:
-        client = MongoClient(
-            "mongodb://%s:%s@localhost" % (config["username"], config["password"])
-        )
-    else:
-        client = MongoClient()
+    client = getClient(getCredentials())
 
     genomes = []
     dbs = sorted(client.database_names(), key=lambda v: v.upper())
@@ -4,12 +4,17 @@ import cgi
 import os.path
 import sys
 
-import requests
-
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../helpers"))
+import AppServer
+
+# hand the request to the application server when it's running
+if __name__ == "__main__":
+    AppServer.relayRequest(__file__)
+
 # cgi debug module
 import cgitb
 
+import requests
 from classes.Gene import Gene, printError
 from Config import Config
 
@@ -4,11 +4,16 @@ import cgi
 import os
 import sys
 
-from bson.objectid import ObjectId
-
 # import external classes based on relative file location
 dir_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(dir_path, "../../../helpers"))
+import AppServer
+
+# hand the request to the application server when it's running
+if __name__ == "__main__":
+    AppServer.relayRequest(__file__)
+
+from bson.objectid import ObjectId
 from Config import Config
 
 sys.path.append(os.path.join(dir_path, "../.."))
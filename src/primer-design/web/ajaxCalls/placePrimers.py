@@ -12,6 +12,13 @@ import sys
 
 # import external classes based on relative file location
 dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(dir_path, "../../../helpers"))
+import AppServer
+
+# hand the request to the application server when it's running
+if __name__ == "__main__":
+    AppServer.relayRequest(__file__)
+
 sys.path.append(os.path.join(dir_path, "../.."))
 from classes.BlastDB import BlastDB
 
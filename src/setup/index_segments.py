@@ -0,0 +1,29 @@
+#!/usr/bin/env python3.7
+
+import os
+import sys
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(dir_path, "../guide-finder/core"))
+from categorize_offtargets import SegmentIndex, segmentIndexPath
+
+
+def index_segments(segments_filename: str) -> None:
+    """
+    Writes the binary index of a segments.bed file (<org>.segments.npz) used to categorize off-targets
+    """
+    index_filename = segmentIndexPath(segments_filename)
+    SegmentIndex.fromBed(segments_filename).save(index_filename)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        for file in sys.argv[1:]:
+            print(f"Indexing {file}...", file=sys.stderr)
+            index_segments(file)
+    else:
+        print(
+            f"Usage: {sys.argv[0]} <org.segments.bed> [...additional.segments.bed]",
+            file=sys.stderr,
+        )
+        exit(1)
@@ -29,6 +29,8 @@ python3.7 "$SETUP_BIN/process_gff3.py" $GFF
 rm "$FASTA" $GFF
 # *.gff3 is always the non-regulatory build that is always present
 "$SETUP_BIN/create_segments.sh" *.fa.fai *.processed.gff3 $ASSEMBLY
+# binary index of the segments used to categorize off-targets, creates $ASSEMBLY.segments.npz
+python3.7 "$SETUP_BIN/index_segments.py" $ASSEMBLY.segments.bed
 
 mkdir -p ../blastdb
 makeblastdb -in $ASSEMBLY.fa -input_type fasta -dbtype nucl \